@@ -0,0 +1,37 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Benchmarks of the workflow engine hot paths.
+
+Run all of them using:
+
+    python -m benchmarks.run --output results.json
+
+See `python -m benchmarks.run --help` for choosing the scenarios, shapes
+and sizes. Every benchmark runs in its own subprocess, against the
+in-process REST and AMQP stand-ins from benchmarks.fakes, so that no
+manager is needed, and the peak RSS is that of the benchmark only.
+
+Micro-benchmarks of specific hot paths are in their own modules:
+    - benchmarks.hierarchy: type derivation checks, and graph construction
+      on relationship-heavy deployments
+    - benchmarks.json_codec: encoding and decoding task messages, node
+      instance listings and event batches, with every installed codec
+    - benchmarks.amqp_latency: latency of publishing from a worker thread
+    - benchmarks.amqp_throughput: throughput of many threads publishing
+      on one channel, and on a channel each
+The AMQP ones run against a RabbitMQ broker given by --host, or against
+an in-memory broker with injected latency.
+"""
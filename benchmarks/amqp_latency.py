@@ -0,0 +1,161 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Benchmark the latency of publishing from a worker thread.
+
+Messages are published from a thread other than the connection thread,
+waiting for each to be confirmed, like operation results and events are.
+Measures the time from calling publish until it returns, for:
+    - wakeup: AMQPConnection, where scheduling the publish wakes up the
+      connection thread
+    - polling: the connection thread checking for scheduled publishes
+      every 200ms, as it did before
+
+Run against a RabbitMQ broker with
+`python -m benchmarks.amqp_latency --host <broker host>`. Without --host,
+the in-memory broker from cloudify.tests.mocks.mock_broker is used, with
+the one-way network latency given by --latency.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from cloudify import amqp_client
+from cloudify.tests.mocks.mock_broker import MockBroker
+
+EXCHANGE = 'cloudify-benchmark-latency'
+DEFAULT_MESSAGES = 200
+# time between the publishes, so that they don't all come right after
+# the connection thread wakes up
+DEFAULT_INTERVAL = 0.01
+# one-way latency of the in-memory broker: a LAN round trip
+DEFAULT_MOCK_LATENCY = 0.0002
+
+
+class _PollingConnection(amqp_client.AMQPConnection):
+    """The connection thread polls for scheduled methods, every 200ms"""
+    POLL_INTERVAL = 0.2
+
+    def _schedule(self, envelope):
+        self._connection_tasks_queue.put(envelope)
+
+
+class _TemporarySendHandler(amqp_client.SendHandler):
+    exchange_settings = {
+        'auto_delete': True,
+        'durable': False,
+    }
+
+
+def add_broker_arguments(parser):
+    parser.add_argument('--host',
+                        help='the broker host; without it, an in-memory '
+                             'broker is used')
+    parser.add_argument('--user', default='guest')
+    parser.add_argument('--password', default='guest')
+    parser.add_argument('--vhost', default='/')
+    parser.add_argument('--latency', type=float,
+                        default=DEFAULT_MOCK_LATENCY,
+                        help='one-way latency of the in-memory broker, '
+                             'in seconds')
+
+
+@contextmanager
+def broker(args):
+    """Yield the AMQPParams of the broker given by the arguments"""
+    if args.host:
+        yield amqp_client.AMQPParams(
+            amqp_host=args.host,
+            amqp_user=args.user,
+            amqp_pass=args.password,
+            amqp_vhost=args.vhost)
+    else:
+        with MockBroker(latency=args.latency).patched():
+            yield amqp_client.AMQPParams(amqp_host='localhost')
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+def _publish_from_thread(connection, messages, interval):
+    latencies = []
+
+    def _publish():
+        for i in range(messages):
+            start = time.time()
+            connection.publish({
+                'exchange': EXCHANGE,
+                'routing_key': '',
+                'body': json.dumps({'message': i})
+            })
+            latencies.append(time.time() - start)
+            time.sleep(interval)
+
+    worker = threading.Thread(target=_publish)
+    worker.start()
+    worker.join()
+    return latencies
+
+
+def run(connection_cls, amqp_params, messages, interval):
+    handler = _TemporarySendHandler(EXCHANGE, exchange_type='fanout')
+    connection = connection_cls([handler], amqp_params=amqp_params)
+    with connection:
+        latencies = _publish_from_thread(connection, messages, interval)
+    return {
+        'messages': messages,
+        'mean': sum(latencies) / len(latencies),
+        'p50': _percentile(latencies, 50),
+        'p90': _percentile(latencies, 90),
+        'p99': _percentile(latencies, 99),
+        'max': max(latencies)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_broker_arguments(parser)
+    parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES,
+                        help='how many messages to publish in each mode')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help='seconds between the publishes')
+    args = parser.parse_args(argv)
+    results = {}
+    with broker(args) as amqp_params:
+        for mode, connection_cls in [('wakeup', amqp_client.AMQPConnection),
+                                     ('polling', _PollingConnection)]:
+            result = run(connection_cls, amqp_params, args.messages,
+                         args.interval)
+            sys.stderr.write('{0}: p50 {1:.4f}s, p99 {2:.4f}s\n'.format(
+                mode, result['p50'], result['p99']))
+            results[mode] = result
+    sys.stdout.write(json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'broker': args.host or 'in-memory',
+        'results': results
+    }, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
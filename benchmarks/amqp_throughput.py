@@ -0,0 +1,116 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Benchmark the throughput of pipelined publishing from many threads.
+
+N threads publish concurrently on one connection, without waiting for
+each message to be confirmed, like the threads of a workflow sending
+logs. Measures the messages confirmed per second, with:
+    - shared: all the threads publishing on a single channel
+    - channels: every thread publishing on its own channel
+
+Run against a RabbitMQ broker with
+`python -m benchmarks.amqp_throughput --host <broker host>`, or without
+--host against the in-memory broker, like benchmarks.amqp_latency.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+from cloudify import amqp_client
+
+from benchmarks.amqp_latency import (
+    EXCHANGE,
+    _TemporarySendHandler,
+    add_broker_arguments,
+    broker
+)
+
+DEFAULT_THREADS = (1, 4, 16)
+DEFAULT_MESSAGES = 500
+DEFAULT_WINDOW = amqp_client.DEFAULT_PUBLISH_WINDOW
+
+
+def _publish(connection, messages):
+    # like logs: don't wait for every message, but only publish_window
+    # messages can be waiting for their confirms
+    confirmations = [connection.publish({
+        'exchange': EXCHANGE,
+        'routing_key': '',
+        'body': json.dumps({'message': i})
+    }, wait=False) for i in range(messages)]
+    for confirmation in confirmations:
+        confirmation.wait()
+
+
+def run(amqp_params, threads, channels, messages, window):
+    handler = _TemporarySendHandler(EXCHANGE, exchange_type='fanout')
+    connection = amqp_client.AMQPConnection(
+        [handler], amqp_params=amqp_params,
+        publish_window=window, publish_channels=channels)
+    with connection:
+        workers = [threading.Thread(target=_publish,
+                                    args=(connection, messages))
+                   for _ in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.time() - start
+    return {
+        'threads': threads,
+        'channels': channels,
+        'messages': threads * messages,
+        'duration': duration,
+        'messages_per_second': threads * messages / duration
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_broker_arguments(parser)
+    parser.add_argument('--threads', default=DEFAULT_THREADS,
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        help='numbers of publishing threads')
+    parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES,
+                        help='how many messages every thread publishes')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                        help='unconfirmed messages allowed per channel')
+    args = parser.parse_args(argv)
+    results = []
+    with broker(args) as amqp_params:
+        for threads in args.threads:
+            for mode, channels in [('shared', 1), ('channels', threads)]:
+                result = run(amqp_params, threads, channels, args.messages,
+                             args.window)
+                result['mode'] = mode
+                sys.stderr.write('{0} threads, {1}: {2:.0f} msg/s\n'.format(
+                    threads, mode, result['messages_per_second']))
+                results.append(result)
+    sys.stdout.write(json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'broker': args.host or 'in-memory',
+        'results': results
+    }, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""In-process stand-ins for the REST service and for AMQP.
+
+Everything sent to the stand-ins is serialized to JSON and back, like it
+would be when sent to the real services, so that the cost of that is
+included in the benchmarks.
+"""
+
+import json
+import threading
+import uuid
+from contextlib import contextmanager
+
+from cloudify import amqp_client, amqp_client_utils, manager
+from cloudify._compat import queue
+from cloudify.state import current_workflow_ctx
+from cloudify.workflows import tasks, workflow_context
+from cloudify_rest_client.executions import Execution
+from cloudify_rest_client.nodes import Node
+from cloudify_rest_client.node_instances import NodeInstance
+from cloudify_rest_client.operations import Operation, TasksGraph
+from cloudify_rest_client.responses import ListResponse
+
+DEPLOYMENT_ID = 'benchmark'
+
+
+def _roundtrip(data):
+    return json.loads(json.dumps(data))
+
+
+def _list_response(items):
+    return ListResponse(items, {'pagination': {
+        'total': len(items), 'size': len(items), 'offset': 0}})
+
+
+class _FakeNodesClient(object):
+    def __init__(self, nodes):
+        self._nodes = dict((node['id'], json.dumps(node)) for node in nodes)
+
+    def list(self, **kwargs):
+        return _list_response([Node(json.loads(node))
+                               for node in self._nodes.values()])
+
+    def get(self, deployment_id, node_id, **kwargs):
+        return Node(json.loads(self._nodes[node_id]))
+
+
+class _FakeNodeInstancesClient(object):
+    def __init__(self, node_instances):
+        self._lock = threading.Lock()
+        self._instances = dict((instance['id'], json.dumps(instance))
+                               for instance in node_instances)
+
+    def list(self, **kwargs):
+        return _list_response([NodeInstance(json.loads(instance))
+                               for instance in self._instances.values()])
+
+    def get(self, node_instance_id, **kwargs):
+        return NodeInstance(json.loads(self._instances[node_instance_id]))
+
+    def update(self, node_instance_id, state=None, runtime_properties=None,
+               version=None, **kwargs):
+        with self._lock:
+            instance = json.loads(self._instances[node_instance_id])
+            if state is not None:
+                instance['state'] = state
+            if runtime_properties is not None:
+                instance['runtime_properties'] = runtime_properties
+            instance['version'] = instance.get('version', 0) + 1
+            self._instances[node_instance_id] = json.dumps(instance)
+        return NodeInstance(instance)
+
+
+class _FakeOperationsClient(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def _store(self, graph_id, operation):
+        operation = _roundtrip(operation)
+        operation['graph_id'] = graph_id
+        operation.setdefault('state', tasks.TASK_PENDING)
+        with self._lock:
+            self._operations[operation['id']] = json.dumps(operation)
+        return Operation(operation)
+
+    def list(self, graph_id):
+        return _list_response([
+            Operation(op) for op in (
+                json.loads(op) for op in self._operations.values())
+            if op['graph_id'] == graph_id])
+
+    def get(self, operation_id):
+        return Operation(json.loads(self._operations[operation_id]))
+
+    def create(self, operation_id, graph_id, name, type, parameters,
+               dependencies):
+        return self._store(graph_id, {
+            'id': operation_id,
+            'name': name,
+            'type': type,
+            'parameters': parameters,
+            'dependencies': dependencies
+        })
+
+    def update(self, operation_id, state):
+        with self._lock:
+            operation = json.loads(self._operations[operation_id])
+            operation['state'] = state
+            self._operations[operation_id] = json.dumps(operation)
+        return Operation(operation)
+
+    def delete(self, operation_id):
+        with self._lock:
+            self._operations.pop(operation_id, None)
+
+
+class _FakeTasksGraphsClient(object):
+    def __init__(self, operations):
+        self._operations = operations
+        self._graphs = {}
+
+    def list(self, execution_id, name):
+        return _list_response([
+            TasksGraph(graph) for graph in self._graphs.values()
+            if graph['execution_id'] == execution_id and
+            graph['name'] == name])
+
+    def create(self, execution_id, name, operations=None):
+        graph = {
+            'id': str(uuid.uuid4()),
+            'execution_id': execution_id,
+            'name': name
+        }
+        self._graphs[graph['id']] = graph
+        for operation in operations or []:
+            self._operations._store(graph['id'], operation)
+        return TasksGraph(graph)
+
+
+class _FakeExecutionsClient(object):
+    def __init__(self):
+        self._executions = {}
+
+    def get(self, execution_id, **kwargs):
+        return Execution(self._executions.get(
+            execution_id, {'id': execution_id, 'status': 'started'}))
+
+    def update(self, execution_id, status, error=None):
+        execution = {'id': execution_id, 'status': status, 'error': error}
+        self._executions[execution_id] = execution
+        return Execution(execution)
+
+
+class _FakeManagerClient(object):
+    def get_context(self):
+        return {'context': {'cloudify': {}}}
+
+    def get_config(self, **kwargs):
+        return []
+
+
+class _FakeDeploymentsClient(object):
+    def get(self, deployment_id, **kwargs):
+        return {'id': deployment_id, 'scaling_groups': {}}
+
+
+class _FakePluginsClient(object):
+    def list(self, **kwargs):
+        return _list_response([])
+
+
+class FakeRestClient(object):
+    """The parts of CloudifyClient that workflows use, kept in memory"""
+
+    def __init__(self, nodes=None, node_instances=None):
+        self.nodes = _FakeNodesClient(nodes or [])
+        self.node_instances = _FakeNodeInstancesClient(node_instances or [])
+        self.operations = _FakeOperationsClient()
+        self.tasks_graphs = _FakeTasksGraphsClient(self.operations)
+        self.executions = _FakeExecutionsClient()
+        self.manager = _FakeManagerClient()
+        self.deployments = _FakeDeploymentsClient()
+        self.plugins = _FakePluginsClient()
+
+
+class FakeEventsPublisher(object):
+    """Stand-in for amqp_client.CloudifyEventsPublisher"""
+
+    def __init__(self, *args, **kwargs):
+        self.published = 0
+
+    def publish_message(self, message, message_type='event', wait=None):
+        json.dumps(message)
+        self.published += 1
+
+    def publish_batch(self, messages, message_type='event', wait=None):
+        json.dumps(messages)
+        self.published += len(messages)
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class _FakeAMQPClient(object):
+    def add_handler(self, handler):
+        pass
+
+    def consume_in_thread(self):
+        pass
+
+    def close(self, wait=True):
+        pass
+
+
+class _FakeAgentHandler(object):
+    """Stand-in for CallbackRequestResponseHandler.
+
+    Sent tasks are answered by the agents thread, as if the operation
+    succeeded.
+    """
+
+    def __init__(self, agents):
+        self._agents = agents
+        self.callbacks = {}
+
+    def make_response_queue(self, correlation_id):
+        pass
+
+    def publish(self, message, routing_key='', correlation_id=None,
+                headers=None):
+        self._agents.put(self, json.dumps(message), correlation_id)
+
+    def publish_batch(self, messages, routing_key='', headers=None):
+        for message, correlation_id in messages:
+            self.publish(message, routing_key, correlation_id)
+
+
+class FakeAgents(workflow_context._TaskDispatcher):
+    """A task dispatcher sending tasks to in-process fake agents.
+
+    This is a _TaskDispatcher, so sending tasks, and handling the
+    responses, is the same as with real agents.
+    """
+
+    def __init__(self):
+        super(FakeAgents, self).__init__()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self.handled = 0
+
+    def make_subtask(self, tenant, target, task_id, queue, kwargs):
+        return {
+            'id': task_id,
+            'tenant': tenant,
+            'target': target,
+            'queue': queue,
+            'task': {
+                'id': task_id,
+                'cloudify_task': {'kwargs': kwargs},
+            },
+            'client': _FakeAMQPClient(),
+            'handler': _FakeAgentHandler(self)
+        }
+
+    def put(self, handler, body, correlation_id):
+        self._queue.put((handler, body, correlation_id))
+
+    def _run(self):
+        while True:
+            handler, body, correlation_id = self._queue.get()
+            json.loads(body)
+            response = json.loads(json.dumps({'ok': True, 'result': None}))
+            self.handled += 1
+            handler.callbacks[correlation_id](response)
+
+
+@contextmanager
+def _patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+@contextmanager
+def fake_manager(nodes=None, node_instances=None, **context):
+    """Run a remote workflow against the stand-ins.
+
+    :param nodes: raw nodes of the deployment, as returned by REST
+    :param node_instances: raw node instances of the deployment
+    :param context: overrides of the workflow's cloudify context
+    :return: a context manager, yielding the CloudifyWorkflowContext
+             (which is also pushed as the current workflow context)
+    """
+    client = FakeRestClient(nodes, node_instances)
+
+    def get_rest_client(*args, **kwargs):
+        return client
+
+    cloudify_context = {
+        'type': 'workflow',
+        'local': False,
+        'deployment_id': DEPLOYMENT_ID,
+        'blueprint_id': DEPLOYMENT_ID,
+        'execution_id': str(uuid.uuid4()),
+        'workflow_id': 'benchmark',
+        'tenant': {'name': 'default_tenant'},
+        'rest_token': 'benchmark',
+        'task_retries': 0
+    }
+    cloudify_context.update(context)
+    with _patched(manager, 'get_rest_client', get_rest_client), \
+            _patched(workflow_context, 'get_rest_client', get_rest_client), \
+            _patched(tasks, 'get_rest_client', get_rest_client), \
+            _patched(amqp_client, 'create_events_publisher',
+                     FakeEventsPublisher):
+        amqp_client_utils.init_events_publisher()
+        try:
+            ctx = workflow_context.CloudifyWorkflowContext(cloudify_context)
+            ctx.internal.handler._dispatcher = FakeAgents()
+            with current_workflow_ctx.push(ctx):
+                ctx.internal.start_local_tasks_processing()
+                try:
+                    yield ctx
+                finally:
+                    ctx.internal.stop_local_tasks_processing()
+        finally:
+            amqp_client_utils.close_amqp_client()
@@ -0,0 +1,131 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Benchmark type derivation checks, and graph construction.
+
+For relationship-heavy synthetic deployments, measures:
+    - build: building the install graph using LifecycleProcessor
+    - checks: the derivation checks that workflows make while building
+      graphs (is the node a host, which relationships are contained_in),
+      for every node instance and relationship, done with is_derived_from
+    - list_checks: the same checks, done as membership tests on the
+      type_hierarchy lists, as they were before the hierarchies were
+      interned as frozensets
+
+Every round of checks runs on new copies of the raw nodes and instances,
+so that the cost of converting the hierarchies to sets, and of creating
+the workflow objects, is included in both.
+
+Run with `python -m benchmarks.hierarchy`.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from cloudify import constants
+from cloudify.plugins import lifecycle
+from cloudify.workflows.simulator import lifecycle_graph
+from cloudify.workflows.workflow_context import (
+    WorkflowNodesAndInstancesContainer)
+from cloudify_rest_client.nodes import Node
+from cloudify_rest_client.node_instances import NodeInstance
+
+from benchmarks import plans
+from benchmarks.fakes import fake_manager
+
+DEFAULT_SIZES = (500, 2000)
+CONTAINED_IN = 'cloudify.relationships.contained_in'
+
+# how many times to repeat the checks, so that they take long enough
+# to be measured
+CHECK_ROUNDS = 20
+
+
+def _checks(instances):
+    for instance in instances:
+        lifecycle.is_host_node(instance)
+        for relationship in instance.relationships:
+            relationship.relationship.is_derived_from(CONTAINED_IN)
+
+
+def _list_checks(instances):
+    for instance in instances:
+        constants.COMPUTE_NODE_TYPE in instance.node.type_hierarchy
+        for relationship in instance.relationships:
+            CONTAINED_IN in relationship.relationship._relationship[
+                'type_hierarchy']
+
+
+def _fresh_instances(ctx, nodes, node_instances):
+    """Instances of a new container, none of which were checked yet"""
+    container = WorkflowNodesAndInstancesContainer(
+        ctx, [Node(node) for node in nodes],
+        [NodeInstance(instance) for instance in node_instances])
+    return container.node_instances
+
+
+def _rounds(func, ctx, nodes, node_instances):
+    rounds = [_fresh_instances(ctx, nodes, node_instances)
+              for _ in range(CHECK_ROUNDS)]
+    return _measure(lambda: [func(instances) for instances in rounds])
+
+
+def _measure(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def run(size):
+    nodes, node_instances = plans.deployment_plan('relationships', size)
+    with fake_manager(nodes, node_instances) as ctx:
+        build = _measure(lifecycle_graph, ctx.node_instances)
+        checks = sum(1 + len(list(instance.relationships))
+                     for instance in ctx.node_instances) * CHECK_ROUNDS
+        set_time = _rounds(_checks, ctx, nodes, node_instances)
+        list_time = _rounds(_list_checks, ctx, nodes, node_instances)
+    return {
+        'node_instances': size,
+        'build': build,
+        'checks': checks,
+        'checks_per_second': checks / set_time if set_time else None,
+        'list_checks_per_second': checks / list_time if list_time else None
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        help='numbers of node instances')
+    args = parser.parse_args(argv)
+    results = []
+    for size in args.sizes:
+        result = run(size)
+        sys.stderr.write('{0} instances: build {1:.2f}s\n'.format(
+            size, result['build']))
+        results.append(result)
+    sys.stdout.write(json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
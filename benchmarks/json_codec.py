@@ -0,0 +1,205 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Benchmark the JSON codecs on representative payloads.
+
+For every codec from cloudify.codec that is installed, measures how many
+times per second each payload is encoded (dumps) and decoded (loads):
+    - task: an operation task message, with its cloudify context
+    - node_instances: a REST listing of 1000 node instances
+    - events: a batch of 100 log records, as sent to the logs exchange
+
+Run with `python -m benchmarks.json_codec`.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from cloudify import codec
+
+# how long to repeat each measurement, in seconds
+DEFAULT_DURATION = 1
+
+
+def _task():
+    context = {
+        'type': 'operation',
+        'task_id': 'f1b2c3d4-e5f6-4a5b-8c7d-9e0f1a2b3c4d',
+        'task_name': 'cloudify.plugins.lifecycle.install',
+        'task_target': 'vm_abc123',
+        'execution_id': '0a1b2c3d-4e5f-4a6b-8c7d-8e9f0a1b2c3d',
+        'workflow_id': 'install',
+        'blueprint_id': 'app',
+        'deployment_id': 'app-1',
+        'node_id': 'vm',
+        'node_name': 'vm',
+        'node_instance_id': 'vm_abc123',
+        'plugin': {
+            'name': 'openstack',
+            'package_name': 'cloudify-openstack-plugin',
+            'package_version': '3.2.16',
+            'source': None,
+            'executor': 'central_deployment_agent'
+        },
+        'operation': {
+            'name': 'cloudify.interfaces.lifecycle.create',
+            'retry_number': 0,
+            'max_retries': 60
+        },
+        'tenant': {'name': 'default_tenant'},
+        'rest_token': 'x' * 64,
+        'execution_token': 'y' * 64,
+        'local': False,
+        'bypass_maintenance': False,
+        'has_intrinsic_functions': False
+    }
+    return {
+        'id': context['task_id'],
+        'tenant': context['tenant'],
+        'target': 'vm_abc123',
+        'queue': 'vm_abc123',
+        'task': {
+            'id': context['task_id'],
+            'cloudify_task': {'kwargs': {
+                '__cloudify_context': context,
+                'resource_config': {
+                    'name': 'server',
+                    'flavor_id': 'm1.medium',
+                    'image_id': 'centos-7',
+                    'networks': [{'uuid': 'net-{0}'.format(i)}
+                                 for i in range(4)],
+                    'metadata': dict(('key{0}'.format(i), i)
+                                     for i in range(20))
+                },
+                'use_external_resource': False
+            }}
+        }
+    }
+
+
+def _node_instances(size=1000):
+    return {
+        'items': [{
+            'id': 'vm_{0}'.format(i),
+            'node_id': 'vm',
+            'deployment_id': 'app-1',
+            'host_id': 'vm_{0}'.format(i),
+            'state': 'started',
+            'version': 7,
+            'scaling_groups': [],
+            'runtime_properties': {
+                'ip': '10.0.{0}.{1}'.format(i // 256, i % 256),
+                'external_id': 'server-{0}'.format(i),
+                'ports': list(range(8)),
+                'cloudify_agent': {'name': 'vm_{0}'.format(i),
+                                   'queue': 'vm_{0}'.format(i)}
+            },
+            'relationships': [{
+                'target_id': 'network_1',
+                'target_name': 'network',
+                'type': 'cloudify.relationships.connected_to'
+            }]
+        } for i in range(size)],
+        'metadata': {'pagination': {'total': size, 'size': size,
+                                    'offset': 0}}
+    }
+
+
+def _events(size=100):
+    return {'batch': [{
+        'context': {
+            'execution_id': '0a1b2c3d-4e5f-4a6b-8c7d-8e9f0a1b2c3d',
+            'workflow_id': 'install',
+            'deployment_id': 'app-1',
+            'node_id': 'vm',
+            'node_instance_id': 'vm_abc123',
+            'operation': 'cloudify.interfaces.lifecycle.create',
+            'task_id': 'f1b2c3d4-e5f6-4a5b-8c7d-9e0f1a2b3c4d'
+        },
+        'logger': 'ctx.f1b2c3d4',
+        'level': 'info',
+        'message': {'text': 'Creating server: attempt {0}'.format(i)},
+        'timestamp': '2020-06-01T12:00:00.000Z',
+        'message_code': None,
+        'type': 'cloudify_log'
+    } for i in range(size)]}
+
+
+PAYLOADS = [
+    ('task', _task),
+    ('node_instances', _node_instances),
+    ('events', _events),
+]
+
+
+def _per_second(func, arg, duration):
+    calls = 0
+    start = time.time()
+    while True:
+        func(arg)
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return calls / elapsed
+
+
+def run(json_codec, duration=DEFAULT_DURATION):
+    results = {}
+    for name, make_payload in PAYLOADS:
+        payload = make_payload()
+        encoded = json_codec.dumps(payload)
+        results[name] = {
+            'bytes': len(encoded),
+            'dumps_per_second': _per_second(
+                json_codec.dumps, payload, duration),
+            'loads_per_second': _per_second(
+                json_codec.loads, encoded, duration)
+        }
+    return results
+
+
+def _available_codecs():
+    for name, codec_cls in sorted(codec.CODECS.items()):
+        try:
+            yield name, codec_cls()
+        except ImportError:
+            sys.stderr.write('{0}: not installed\n'.format(name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION,
+                        help='seconds to repeat each measurement')
+    args = parser.parse_args(argv)
+    results = {}
+    for name, json_codec in _available_codecs():
+        results[name] = run(json_codec, args.duration)
+        for payload, result in sorted(results[name].items()):
+            sys.stderr.write(
+                '{0} {1}: dumps {2:.0f}/s, loads {3:.0f}/s\n'.format(
+                    name, payload, result['dumps_per_second'],
+                    result['loads_per_second']))
+    sys.stdout.write(json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
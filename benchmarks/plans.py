@@ -0,0 +1,191 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Synthetic deployment plans and tasks graphs.
+
+Shapes:
+    - wide: independent node instances, or tasks
+    - deep: a chain, where every node instance (or task) depends on
+      the previous one
+    - relationships: layers, where every node instance (or task) depends
+      on several random ones from the previous layer
+"""
+
+import random
+
+from cloudify.constants import MGMTWORKER_QUEUE
+
+SHAPES = ('wide', 'deep', 'relationships')
+
+# how many node instances/tasks does every one in the relationships
+# shape depend on, and how many layers are there
+FAN_IN = 5
+LAYERS = 10
+
+PLUGIN = 'benchmark'
+OPERATION_MAPPING = 'benchmarks.noop'
+
+LIFECYCLE_OPERATIONS = [
+    'cloudify.interfaces.lifecycle.create',
+    'cloudify.interfaces.lifecycle.configure',
+    'cloudify.interfaces.lifecycle.start',
+    'cloudify.interfaces.lifecycle.stop',
+    'cloudify.interfaces.lifecycle.delete',
+]
+NOP_OPERATIONS = [
+    'cloudify.interfaces.lifecycle.precreate',
+    'cloudify.interfaces.lifecycle.poststart',
+    'cloudify.interfaces.lifecycle.prestop',
+    'cloudify.interfaces.lifecycle.postdelete',
+    'cloudify.interfaces.validation.create',
+    'cloudify.interfaces.validation.delete',
+    'cloudify.interfaces.monitoring.start',
+    'cloudify.interfaces.monitoring.stop',
+]
+RELATIONSHIP_OPERATIONS = [
+    'cloudify.interfaces.relationship_lifecycle.preconfigure',
+    'cloudify.interfaces.relationship_lifecycle.postconfigure',
+    'cloudify.interfaces.relationship_lifecycle.establish',
+    'cloudify.interfaces.relationship_lifecycle.unlink',
+]
+RELATIONSHIP_TYPE = 'benchmark.relationships.connected_to'
+
+# hierarchies as deep as those of types from plugins, so that checking
+# derivation costs what it does in real deployments
+NODE_TYPE_HIERARCHY = [
+    'cloudify.nodes.Root',
+    'cloudify.nodes.SoftwareComponent',
+    'cloudify.nodes.ApplicationServer',
+    'cloudify.nodes.WebServer',
+    'benchmark.nodes.Server',
+    'benchmark.nodes.ApplicationServer',
+]
+RELATIONSHIP_TYPE_HIERARCHY = [
+    'cloudify.relationships.depends_on',
+    'cloudify.relationships.connected_to',
+    RELATIONSHIP_TYPE,
+]
+
+
+def _dependencies(shape, index, count, rng):
+    """Indexes of the items that item number index depends on"""
+    if shape == 'wide' or index == 0:
+        return []
+    if shape == 'deep':
+        return [index - 1]
+    layer_size = max(1, count // LAYERS)
+    layer = index // layer_size
+    if layer == 0:
+        return []
+    previous = list(range((layer - 1) * layer_size, layer * layer_size))
+    return rng.sample(previous, min(FAN_IN, len(previous)))
+
+
+def _operation(mapping):
+    return {
+        'operation': mapping,
+        'plugin': PLUGIN,
+        'executor': 'central_deployment_agent',
+        'inputs': {'some_input': 'value', 'nested': {'key': [1, 2, 3]}},
+        'has_intrinsic_functions': False,
+        'max_retries': 0,
+        'retry_interval': 30,
+    }
+
+
+def _operations(names, mapping):
+    return dict((name, _operation(mapping)) for name in names)
+
+
+def deployment_plan(shape, node_instances, seed=0):
+    """Nodes and node instances of a synthetic deployment.
+
+    Every node has a single instance. Nodes depend on each other
+    according to shape, using a relationship with operations on both
+    the source and the target, which makes relationship-heavy plans.
+
+    :return: a (nodes, node instances) tuple of raw (REST) dicts
+    """
+    rng = random.Random(seed)
+    nodes, instances = [], []
+    operations = _operations(LIFECYCLE_OPERATIONS, OPERATION_MAPPING)
+    operations.update(_operations(NOP_OPERATIONS, ''))
+    relationship_operations = _operations(
+        RELATIONSHIP_OPERATIONS, OPERATION_MAPPING)
+    for index in range(node_instances):
+        node_id = 'node_{0}'.format(index)
+        targets = ['node_{0}'.format(target) for target in
+                   _dependencies(shape, index, node_instances, rng)]
+        nodes.append({
+            'id': node_id,
+            'deployment_id': 'benchmark',
+            'type': NODE_TYPE_HIERARCHY[-1],
+            # a copy for every node, like deserialized REST responses
+            'type_hierarchy': list(NODE_TYPE_HIERARCHY),
+            'properties': {},
+            'operations': operations,
+            'plugins': [{'name': PLUGIN, 'package_name': None,
+                         'executor': 'central_deployment_agent'}],
+            'number_of_instances': 1,
+            'relationships': [{
+                'target_id': target,
+                'type': RELATIONSHIP_TYPE,
+                'type_hierarchy': list(RELATIONSHIP_TYPE_HIERARCHY),
+                'properties': {},
+                'source_operations': relationship_operations,
+                'target_operations': relationship_operations,
+            } for target in targets]
+        })
+        instances.append({
+            'id': '{0}_instance'.format(node_id),
+            'node_id': node_id,
+            'deployment_id': 'benchmark',
+            'host_id': None,
+            'state': 'uninitialized',
+            'version': 1,
+            'index': 0,
+            'runtime_properties': {},
+            'relationships': [{
+                'target_id': '{0}_instance'.format(target),
+                'target_name': target,
+                'type': RELATIONSHIP_TYPE
+            } for target in targets]
+        })
+    return nodes, instances
+
+
+def tasks_graph(ctx, shape, size, seed=0):
+    """A graph of size remote tasks, which depend on each other as per shape
+
+    :param ctx: the workflow context to create the tasks in
+    """
+    rng = random.Random(seed)
+    graph = ctx.graph_mode()
+    tasks = []
+    for index in range(size):
+        task = ctx.execute_task(
+            OPERATION_MAPPING,
+            local=False,
+            task_queue=MGMTWORKER_QUEUE,
+            task_target=MGMTWORKER_QUEUE,
+            kwargs={'index': index},
+            node_context={'executor': 'central_deployment_agent',
+                          'plugin': {'name': PLUGIN}},
+            send_task_events=False)
+        graph.add_task(task)
+        for dependency in _dependencies(shape, index, size, rng):
+            graph.add_dependency(task, tasks[dependency])
+        tasks.append(task)
+    return graph
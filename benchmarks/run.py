@@ -0,0 +1,224 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Run the workflow engine benchmarks.
+
+Scenarios:
+    - lifecycle: build the install graph of a synthetic deployment using
+      LifecycleProcessor, store it, restore it, and execute it
+    - graph: build a synthetic graph of remote tasks, store it, restore
+      it, and execute it
+
+Sizes are numbers of tasks. Lifecycle deployments get one node instance
+per LIFECYCLE_TASKS_PER_INSTANCE tasks, and the actual number of tasks
+is reported.
+
+The result is a JSON document, with an entry for every benchmark: the
+wall and CPU time of every phase, the CPU time of the scheduling (main)
+thread, execution throughput in tasks per second, and the peak RSS.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import mock
+
+from cloudify.state import workflow_ctx
+from cloudify.workflows import tasks_graph
+from cloudify.workflows.simulator import lifecycle_graph
+
+from benchmarks import plans
+from benchmarks.fakes import fake_manager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+SCENARIOS = ('lifecycle', 'graph')
+DEFAULT_SIZES = (1000, 10000)
+LIFECYCLE_TASKS_PER_INSTANCE = 25
+DEFAULT_TIMEOUT = 600
+
+
+def _thread_cpu():
+    if resource is not None and hasattr(resource, 'RUSAGE_THREAD'):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return None
+
+
+def _process_cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _peak_rss():
+    """Peak RSS of this process, in bytes"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Phases(object):
+    def __init__(self):
+        self.phases = {}
+
+    def measure(self, phase, func, *args, **kwargs):
+        wall, cpu, thread_cpu = time.time(), _process_cpu(), _thread_cpu()
+        result = func(*args, **kwargs)
+        measured = {
+            'wall': time.time() - wall,
+            'cpu': _process_cpu() - cpu,
+        }
+        if thread_cpu is not None:
+            measured['scheduler_cpu'] = _thread_cpu() - thread_cpu
+        self.phases[phase] = measured
+        return result
+
+
+def _store_restore_execute(ctx, graph, phases, name):
+    phases.measure('store', graph.store, name=name)
+    stored = ctx.get_tasks_graph(name)
+    restored = phases.measure(
+        'restore', tasks_graph.TaskDependencyGraph.restore,
+        workflow_ctx, stored)
+    phases.measure('execute', restored.execute)
+    return len(list(graph.tasks_iter()))
+
+
+def run_lifecycle(shape, size, phases):
+    nodes, node_instances = plans.deployment_plan(
+        shape, max(1, size // LIFECYCLE_TASKS_PER_INSTANCE))
+    with fake_manager(nodes, node_instances) as ctx:
+        graph = phases.measure('build', lifecycle_graph, ctx.node_instances)
+        return _store_restore_execute(ctx, graph, phases, 'benchmark')
+
+
+def run_graph(shape, size, phases):
+    with fake_manager() as ctx:
+        graph = phases.measure('build', plans.tasks_graph, ctx, shape, size)
+        return _store_restore_execute(ctx, graph, phases, 'benchmark')
+
+
+def run_single(scenario, shape, size, poll_interval):
+    # the graph sleeps between checking for terminated tasks. Shorten it
+    # so that the benchmark measures the scheduler, and not the sleeping
+    phases = _Phases()
+    runner = {'lifecycle': run_lifecycle, 'graph': run_graph}[scenario]
+    with mock.patch.object(tasks_graph, 'POLL_INTERVAL', poll_interval):
+        task_count = runner(shape, size, phases)
+    execute = phases.phases['execute']['wall']
+    return {
+        'scenario': scenario,
+        'shape': shape,
+        'size': size,
+        'tasks': task_count,
+        'poll_interval': poll_interval,
+        'phases': phases.phases,
+        'throughput': task_count / execute if execute else None,
+        'peak_rss': _peak_rss()
+    }
+
+
+def _run_in_subprocess(scenario, shape, size, poll_interval, timeout):
+    command = [sys.executable, '-m', 'benchmarks.run',
+               '--single', scenario, shape, str(size),
+               '--poll-interval', str(poll_interval)]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    # read the output while the child runs, so that it doesn't block
+    # on a full pipe
+    output = []
+    reader = threading.Thread(
+        target=lambda: output.append(proc.stdout.read()))
+    reader.daemon = True
+    reader.start()
+    reader.join(timeout)
+    if reader.is_alive():
+        proc.kill()
+        proc.wait()
+        reader.join()
+        return {'scenario': scenario, 'shape': shape, 'size': size,
+                'error': 'timed out after {0} seconds'.format(timeout)}
+    proc.wait()
+    output = output[0].decode('utf-8')
+    if proc.returncode != 0:
+        return {'scenario': scenario, 'shape': shape, 'size': size,
+                'error': 'exited with code {0}'.format(proc.returncode)}
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _csv(value):
+    return [item for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', type=_csv, default=SCENARIOS)
+    parser.add_argument('--shapes', type=_csv, default=plans.SHAPES)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        type=lambda value: [int(v) for v in _csv(value)])
+    parser.add_argument('--poll-interval', type=float, default=0,
+                        help='seconds the graph sleeps between iterations '
+                             '(the engine default is 0.1)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds after which a benchmark is stopped')
+    parser.add_argument('--output', help='write the results to this file, '
+                                         'instead of stdout')
+    parser.add_argument('--single', nargs=3,
+                        metavar=('SCENARIO', 'SHAPE', 'SIZE'),
+                        help='run a single benchmark in this process')
+    args = parser.parse_args(argv)
+
+    if args.single:
+        scenario, shape, size = args.single
+        result = run_single(scenario, shape, int(size), args.poll_interval)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+
+    results = []
+    for scenario in args.scenarios:
+        for shape in args.shapes:
+            for size in args.sizes:
+                result = _run_in_subprocess(
+                    scenario, shape, size, args.poll_interval, args.timeout)
+                sys.stderr.write('{0} {1} {2}: {3}\n'.format(
+                    scenario, shape, size,
+                    result.get('error') or '{0:.1f} tasks/s'.format(
+                        result['throughput'] or 0)))
+                results.append(result)
+    report = json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
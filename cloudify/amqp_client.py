@@ -13,29 +13,65 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
-from collections import deque
+from collections import deque, OrderedDict
 import copy
-import json
+import itertools
 import logging
 import os
 import random
+import socket
 import ssl
 import sys
 import threading
 import time
 import uuid
+import weakref
+import zlib
 
 import pika
 import pika.exceptions
+from pika.adapters import select_connection
 
 from cloudify import exceptions
 from cloudify import broker_config
+from cloudify import codec
+from cloudify import metrics
+from cloudify import tracing
 from cloudify._compat import queue
 from cloudify.constants import EVENTS_EXCHANGE_NAME, LOGS_EXCHANGE_NAME
 
 
 logger = logging.getLogger(__name__)
 
+publish_latency = metrics.histogram(
+    'cloudify_amqp_publish_seconds',
+    'Time from scheduling an AMQP publish, until it was confirmed')
+
+# when set, message bodies larger than this many bytes are compressed,
+# but only when the receiver is known to decompress them: responses if
+# the request said it accepts that, and requests if the responses from
+# the same exchange did. Any of the consumers of an exchange can get a
+# request, and one that doesn't decompress, and didn't respond yet, would
+# drop compressed requests: so only set this once all the consumers
+# (eg. every agent and mgmtworker in a cluster) are upgraded
+COMPRESS_THRESHOLD_ENV = 'CLOUDIFY_AMQP_COMPRESS_THRESHOLD'
+# logs and events consumers don't say whether they decompress; only set
+# this when all of them do (see unpack_messages)
+COMPRESS_EVENTS_ENV = 'CLOUDIFY_AMQP_COMPRESS_EVENTS'
+# the content_encoding of compressed bodies, and the value of the header
+# that a request or a response sets to accept compressed messages
+ZLIB_ENCODING = 'zlib'
+ACCEPT_ENCODING_HEADER = 'accept_encoding'
+
+# exchanges (ie. agents) by whether their responses accepted compressed
+# messages, so that requests sent to them can be compressed. Once any
+# response from an exchange didn't, its requests are never compressed
+_accepting_compressed = {}
+
+# how many pipelined messages can be published and not yet confirmed by
+# the broker, before publishing blocks; see AMQPConnection.publish_window
+DEFAULT_PUBLISH_WINDOW = 100
+
 if sys.version_info >= (2, 7):
     # requires 2.7+
     def wait_for_event(evt, poll_interval=0.5):
@@ -56,6 +92,38 @@ else:
         evt.wait()
 
 
+def encode_body(message, properties, compress=True):
+    """Serialize the message, to be the body of an AMQP message.
+
+    If the body is large, it's compressed, and properties.content_encoding
+    is set accordingly; see COMPRESS_THRESHOLD_ENV.
+
+    :param compress: whether the receiver can decompress the body
+    """
+    body = codec.dumps(message)
+    threshold = os.environ.get(COMPRESS_THRESHOLD_ENV)
+    if compress and threshold and len(body) > int(threshold):
+        body = zlib.compress(body.encode('utf-8'))
+        properties.content_encoding = ZLIB_ENCODING
+    return body
+
+
+def decode_body(body, properties):
+    """The body of a received message, decompressed if needed"""
+    if getattr(properties, 'content_encoding', None) == ZLIB_ENCODING:
+        body = zlib.decompress(body)
+    return body
+
+
+def _accepts_compressed(properties):
+    headers = properties.headers or {}
+    return headers.get(ACCEPT_ENCODING_HEADER) == ZLIB_ENCODING
+
+
+def _compress_events():
+    return os.environ.get(COMPRESS_EVENTS_ENV, '').lower() in ('1', 'true')
+
+
 class AMQPParams(object):
     def __init__(self,
                  amqp_host=None,
@@ -104,6 +172,188 @@ class ConnectionTimeoutError(Exception):
     """Timeout trying to connect"""
 
 
+class PublishConfirmation(object):
+    """The broker's confirmation of a single published message.
+
+    Returned from AMQPConnection.publish, when the connection pipelines
+    publishes. The message is durable once the confirmation is done
+    without an error.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.error = None
+        self.published_at = time.time()
+        self._done = threading.Event()
+        # the publish window that this message holds a slot of, if any
+        self._slots = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_result(self, error=None):
+        if error is None:
+            publish_latency.observe(time.time() - self.published_at)
+        self.error = error
+        self._done.set()
+        slots, self._slots = self._slots, None
+        if slots is not None:
+            slots.release()
+
+    def wait(self, timeout=None):
+        """Wait for the broker to confirm the message.
+
+        :param timeout: seconds to wait; wait indefinitely if None
+        :raises queue.Empty: if the message wasn't confirmed in time
+        :raises pika.exceptions.NackError: if the broker rejected the message
+        """
+        if timeout is None:
+            wait_for_event(self._done)
+        elif not self._done.wait(timeout):
+            raise queue.Empty()
+        if self.error is not None:
+            raise self.error
+
+
+class _PublishChannel(object):
+    """A channel that pipelined messages are published on.
+
+    Messages are published without waiting for each confirm, and confirms
+    are matched to the messages by their delivery tag. Every channel has
+    its own window of unconfirmed messages, so that a channel waiting for
+    confirms doesn't hold up publishers on the other channels.
+    """
+
+    def __init__(self, window):
+        self.slots = threading.Semaphore(window)
+        # messages to publish; appended to by any thread, and sent by the
+        # connection thread
+        self.pending = deque()
+        self._channel = None
+        self._delivery_tag = 0
+        self._unconfirmed = OrderedDict()
+
+    def open(self, pika_connection):
+        self._channel = pika_connection.channel()
+        # BlockingChannel.confirm_delivery would make every publish wait for
+        # its confirm, so confirms are enabled on the underlying channel
+        # instead, and handled by _on_confirm
+        self._channel._impl.confirm_delivery(self._on_confirm, nowait=True)
+        self._delivery_tag = 0
+        # messages that were sent on the previous connection but weren't
+        # confirmed, might have been lost: send them again, first
+        self.pending.extendleft(reversed(list(self._unconfirmed.values())))
+        self._unconfirmed.clear()
+
+    def has_unconfirmed(self):
+        return bool(self._unconfirmed)
+
+    def send_next(self):
+        """Publish the next pending message, return whether there was one"""
+        try:
+            confirmation = self.pending.popleft()
+        except IndexError:
+            return False
+        try:
+            self._channel.publish(**confirmation.message)
+        except pika.exceptions.ConnectionClosed:
+            # it will be sent again after reconnecting
+            self.pending.appendleft(confirmation)
+            raise
+        except Exception as e:
+            confirmation.set_result(e)
+            raise
+        # on a channel in confirm mode, the broker numbers published
+        # messages consecutively, starting from 1
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = confirmation
+        return True
+
+    def _on_confirm(self, method_frame):
+        """Resolve the messages that the broker acked or nacked"""
+        method = method_frame.method
+        error = None
+        if isinstance(method, pika.spec.Basic.Nack):
+            logger.warning('Message was nacked by the broker: %s', method)
+            error = pika.exceptions.NackError([])
+        if method.multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            confirmation = self._unconfirmed.pop(tag, None)
+            if confirmation is not None:
+                confirmation.set_result(error)
+
+    def fail(self, error):
+        """Resolve all the messages that weren't confirmed, with the error"""
+        confirmations = list(self._unconfirmed.values())
+        self._unconfirmed.clear()
+        while self.pending:
+            confirmations.append(self.pending.popleft())
+        for confirmation in confirmations:
+            confirmation.set_result(error)
+
+
+def _socketpair():
+    """A pair of connected, non-blocking sockets"""
+    try:
+        read_sock, write_sock = socket.socketpair()
+    except AttributeError:
+        # no socketpair on windows before python 3.5, use UDP instead
+        read_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        read_sock.bind(('localhost', 0))
+        write_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        write_sock.connect(read_sock.getsockname())
+    read_sock.setblocking(0)
+    write_sock.setblocking(0)
+    return read_sock, write_sock
+
+
+class _Wakeup(object):
+    """Wakes the connection thread up, while it's waiting for I/O.
+
+    The read end of a socket pair is polled together with the broker
+    connection, so writing to the other end from any thread makes
+    process_data_events return.
+    """
+
+    def __init__(self):
+        self._read, self._write = _socketpair()
+        self._pika_connection = None
+
+    def register(self, pika_connection):
+        self._pika_connection = pika_connection
+        pika_connection._impl.ioloop.add_handler(
+            self._read.fileno(), self._on_readable, select_connection.READ)
+
+    def _on_readable(self, fileno, events):
+        try:
+            while self._read.recv(512):
+                pass
+        except socket.error:
+            pass
+        # process_data_events only returns when there's an event to
+        # dispatch, so give it one
+        self._pika_connection.add_timeout(0, lambda: None)
+
+    def wake(self):
+        try:
+            self._write.send(b'x')
+        except socket.error:
+            # either the buffer is full, so the connection thread is going
+            # to wake up anyway, or the connection thread is already gone
+            pass
+
+    def close(self):
+        self._read.close()
+        self._write.close()
+
+
 def _get_daemon_factory():
     """
     We need the factory to dynamically load daemon config, to support
@@ -121,8 +371,16 @@ def _get_daemon_factory():
 class AMQPConnection(object):
     MAX_BACKOFF = 30
 
+    # on close, how long to wait for confirms of pipelined messages that
+    # were already sent
+    CLOSE_CONFIRM_TIMEOUT = 5
+
+    # how long the connection thread waits for I/O at a time; None means
+    # indefinitely, because scheduling a channel method wakes it up
+    POLL_INTERVAL = None
+
     def __init__(self, handlers, name=None, amqp_params=None,
-                 connect_timeout=10):
+                 connect_timeout=10, publish_window=None, publish_channels=1):
         self._handlers = handlers
         self.name = name
         self._connection_params = self._get_connection_params()
@@ -141,6 +399,19 @@ class AMQPConnection(object):
         # publishing messages or sending ACKs, which needs to be done from
         # the connection thread
         self._connection_tasks_queue = queue.Queue()
+        self._wakeup = None
+
+        # with a publish window, messages are pipelined: they're published on
+        # separate channels without waiting for each confirm, see
+        # _PublishChannel. Every publishing thread (or handler) is assigned
+        # one of the publish_channels
+        self.publish_window = publish_window
+        self._publish_channels = [
+            _PublishChannel(publish_window) for _ in range(publish_channels)
+        ] if publish_window else []
+        self._channel_keys = weakref.WeakKeyDictionary()
+        self._channel_counter = itertools.count()
+        self._channel_keys_lock = threading.Lock()
 
     def _get_connection_params(self):
         params = self._amqp_params.as_pika_params()
@@ -180,8 +451,12 @@ class AMQPConnection(object):
             self.connect_wait.set()
             raise e
 
+        if self._wakeup is not None:
+            self._wakeup.register(self._pika_connection)
         out_channel = self._pika_connection.channel()
         out_channel.confirm_delivery()
+        for publish_channel in self._publish_channels:
+            publish_channel.open(self._pika_connection)
         for handler in self._handlers:
             handler.register(self, out_channel)
             logger.info('Registered handler for {0} [{1}]'
@@ -203,11 +478,20 @@ class AMQPConnection(object):
             return connection
 
     def consume(self):
+        self._wakeup = _Wakeup()
+        try:
+            self._consume()
+        finally:
+            wakeup, self._wakeup = self._wakeup, None
+            wakeup.close()
+
+    def _consume(self):
         out_channel = self.connect()
         while not self._closed:
             try:
-                self._pika_connection.process_data_events(0.2)
                 self._process_publish(out_channel)
+                self._send_pending()
+                self._pika_connection.process_data_events(self.POLL_INTERVAL)
             except pika.exceptions.ChannelClosed as e:
                 # happens when we attempt to use an exchange/queue that is not
                 # declared - nothing we can do to help it, just exit
@@ -218,6 +502,8 @@ class AMQPConnection(object):
                 out_channel = self.connect()
                 continue
         self._process_publish(out_channel)
+        self._send_pending()
+        self._wait_for_confirms()
         self._pika_connection.close()
 
     def consume_in_thread(self):
@@ -264,7 +550,7 @@ class AMQPConnection(object):
                     return
                 # if we couldn't send the message because the connection
                 # was down, requeue it to be sent again later
-                self._connection_tasks_queue.put(envelope)
+                self._schedule(envelope)
                 raise
             except Exception as e:
                 if err_queue:
@@ -274,8 +560,46 @@ class AMQPConnection(object):
                 if err_queue:
                     err_queue.put(None)
 
+    def _send_pending(self):
+        """Publish the pending pipelined messages.
+
+        The channels take turns sending one message each, so that a thread
+        publishing a lot of messages doesn't hold up the others.
+        """
+        sent = True
+        while sent:
+            sent = False
+            for publish_channel in self._publish_channels:
+                if publish_channel.send_next():
+                    sent = True
+
+    def _wait_for_confirms(self):
+        """Before closing, wait for the pipelined messages to be confirmed"""
+        deadline = time.time() + self.CLOSE_CONFIRM_TIMEOUT
+        try:
+            while time.time() < deadline and any(
+                    publish_channel.has_unconfirmed()
+                    for publish_channel in self._publish_channels):
+                self._pika_connection.process_data_events(0.2)
+        except pika.exceptions.AMQPError as e:
+            logger.debug('Error waiting for publish confirms: %s', e)
+        for publish_channel in self._publish_channels:
+            publish_channel.fail(exceptions.ClosedAMQPClientException(
+                'Connection closed before the message was confirmed'))
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            wakeup.wake()
+
+    def _schedule(self, envelope):
+        """Add a method to be run in the connection thread"""
+        self._connection_tasks_queue.put(envelope)
+        self._wake()
+
     def close(self, wait=True):
         self._closed = True
+        self._wake()
         if self._consumer_thread and wait:
             self._consumer_thread.join()
             self._consumer_thread = None
@@ -298,8 +622,7 @@ class AMQPConnection(object):
         Use this to schedule a channel method such as .publish or .basic_ack
         to be called from the connection thread.
         """
-        if wait and self._consumer_thread \
-                and self._consumer_thread is threading.current_thread():
+        if wait and self._in_consumer_thread():
             # when sending from the connection thread, we can't wait because
             # then we wouldn't allow the actual send loop (._process_publish)
             # to run, because we'd block on the err_queue here
@@ -317,15 +640,24 @@ class AMQPConnection(object):
             'err_queue': err_queue,
             'channel': channel
         }
-        self._connection_tasks_queue.put(envelope)
+        self._schedule(envelope)
         if err_queue:
             err = err_queue.get(timeout=timeout)
             if isinstance(err, Exception):
                 raise err
 
-    def publish(self, message, wait=True, timeout=None):
+    def _in_consumer_thread(self):
+        return self._consumer_thread is not None \
+            and self._consumer_thread is threading.current_thread()
+
+    def publish(self, message, wait=True, timeout=None, channel_key=None):
         """Schedule a message to be sent.
 
+        If the connection has a publish window, the message is pipelined:
+        this returns as soon as the message is scheduled, unless there's
+        already publish_window messages waiting for their confirms on its
+        channel.
+
         :param message: Kwargs for the pika basic_publish call. Should at
                         least contain the "body" and "exchange" keys, and
                         it might contain other keys such as "routing_key"
@@ -333,6 +665,11 @@ class AMQPConnection(object):
         :param wait: Whether to wait for the message to actually be sent.
                      If true, an exception will be raised if the message
                      cannot be sent.
+        :param channel_key: pipelined messages with the same key are
+                            published on the same channel, in order. By
+                            default, that's the current thread.
+        :return: a PublishConfirmation if the message is pipelined,
+                 None otherwise
         """
         properties = message.get('properties') or pika.BasicProperties()
         if properties.delivery_mode is None:
@@ -342,7 +679,40 @@ class AMQPConnection(object):
             # it's on a durable queue).
             properties.delivery_mode = 2
         message['properties'] = properties
+        if self.publish_window:
+            if wait and self._in_consumer_thread():
+                raise RuntimeError(
+                    'Cannot wait when sending from the connection thread')
+            publish_channel = self._get_publish_channel(
+                channel_key or threading.current_thread())
+            confirmation = PublishConfirmation(message)
+            # the connection thread can't wait for a slot, because it's the
+            # one that receives the confirms
+            if not self._in_consumer_thread():
+                publish_channel.slots.acquire()
+                confirmation._slots = publish_channel.slots
+            publish_channel.pending.append(confirmation)
+            self._wake()
+            if wait:
+                confirmation.wait(timeout)
+            return confirmation
+
+        start = time.time()
         self.channel_method('publish', wait=wait, timeout=timeout, **message)
+        if wait:
+            # without waiting, we don't know when the message was sent
+            publish_latency.observe(time.time() - start)
+
+    def _get_publish_channel(self, key):
+        with self._channel_keys_lock:
+            try:
+                return self._channel_keys[key]
+            except KeyError:
+                index = next(self._channel_counter)
+                publish_channel = self._publish_channels[
+                    index % len(self._publish_channels)]
+                self._channel_keys[key] = publish_channel
+                return publish_channel
 
     def ack(self, channel, delivery_tag, wait=True, timeout=None):
         self.channel_method('basic_ack', wait=wait, timeout=timeout,
@@ -353,6 +723,45 @@ class AMQPConnection(object):
 # If a response is not sent, the reply queue will also be deleted
 NO_RESPONSE = object()
 
+# a message body containing this key is a batch of tasks, see
+# _RequestResponseHandlerBase.publish_batch, or of logs or events, see
+# SendHandler.publish_batch
+BATCH_KEY = 'batch'
+
+# at most this many tasks are sent in a single batch message; a consumer
+# takes all of a message's tasks at once, so this bounds how many tasks
+# it holds beyond what its workers are running
+MAX_BATCH_SIZE = 100
+
+
+def unpack_messages(body, properties=None):
+    """The logs or events in a message body, sent by a SendHandler.
+
+    A body is either a single log or event, or a batch of them.
+    """
+    message = codec.loads(decode_body(body, properties))
+    if isinstance(message, dict) and BATCH_KEY in message:
+        return message[BATCH_KEY]
+    return [message]
+
+
+class _BatchDelivery(object):
+    """Delivery tag of a batch message, shared by all the tasks in it.
+
+    The batch message is only acked after all of its tasks were acked.
+    """
+
+    def __init__(self, delivery_tag, size):
+        self.delivery_tag = delivery_tag
+        self._remaining = size
+        self._lock = threading.Lock()
+
+    def task_acked(self):
+        """Mark one task as acked, return whether the batch is done"""
+        with self._lock:
+            self._remaining -= 1
+            return self._remaining == 0
+
 
 class TaskConsumer(object):
     routing_key = ''
@@ -362,13 +771,30 @@ class TaskConsumer(object):
         self.threadpool_size = threadpool_size
         self.exchange = queue
         self.queue = '{0}_{1}'.format(queue, self.routing_key)
-        self._sem = threading.Semaphore(threadpool_size)
         self._connection = None
         self.exchange_type = exchange_type
-        self._tasks_buffer = deque()
+        # tasks are handed off to threadpool_size worker threads, started
+        # when the first task is received
+        self._tasks = None
+        self._workers = []
+        # tasks handed off, and not taken by a worker yet. A batch message
+        # holds many tasks, so prefetch_count doesn't bound them: when
+        # more than threadpool_size are waiting, consuming is paused, so
+        # that further messages wait in the broker rather than in memory
+        self._queued = 0
+        self._paused = False
+        self._queued_lock = threading.Lock()
+        self._channel = None
+        # only used from the connection thread, see _update_consuming
+        self._consumer_tag = None
 
     def register(self, connection, channel):
         self._connection = connection
+        self._channel = channel
+        self._consumer_tag = None
+        # a message is only acked once a worker has taken its task (or even
+        # later, with late_ack), so without batches, this also bounds how
+        # many tasks wait for a worker
         channel.basic_qos(prefetch_count=self.threadpool_size)
         channel.confirm_delivery()
         channel.exchange_declare(exchange=self.exchange,
@@ -381,26 +807,92 @@ class TaskConsumer(object):
         channel.queue_bind(queue=self.queue,
                            exchange=self.exchange,
                            routing_key=self.routing_key)
-        channel.basic_consume(self.process, self.queue)
+        self._update_consuming(connection, channel)
+
+    def _update_consuming(self, connection, channel):
+        """Start or stop consuming, as decided by _paused.
+
+        Called from the connection thread. Calling it again is harmless,
+        so the calls scheduled by the workers don't need to be ordered
+        with reconnects.
+        """
+        with self._queued_lock:
+            paused = self._paused
+        if paused and self._consumer_tag is not None:
+            self._channel.basic_cancel(self._consumer_tag)
+            self._consumer_tag = None
+        elif not paused and self._consumer_tag is None:
+            self._consumer_tag = self._channel.basic_consume(
+                self.process, self.queue)
 
     def process(self, channel, method, properties, body):
+        if self._paused:
+            # delivered before consuming was paused: leave it in the broker
+            # until there's room for it
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            return
         try:
-            full_task = json.loads(body)
-        except ValueError:
+            full_task = codec.loads(decode_body(body, properties))
+        except (ValueError, zlib.error):
             logger.error('Error parsing task: {0}'.format(body))
+            # it won't parse any better when delivered again
+            channel.basic_nack(method.delivery_tag, requeue=False)
             return
 
-        task_args = (channel, properties, full_task, method.delivery_tag)
-        if self._sem.acquire(blocking=False):
-            self._run_task(task_args)
-        else:
-            self._tasks_buffer.append(task_args)
+        if isinstance(full_task, dict) and BATCH_KEY in full_task:
+            self._process_batch(channel, method, properties,
+                                full_task[BATCH_KEY])
+            return
+        self._submit((channel, properties, full_task, method.delivery_tag))
 
-    def _process_message(self, channel, properties, full_task, delivery_tag):
+    def _process_batch(self, channel, method, batch_properties, batch):
+        """Process each task in a batch as if it was sent separately.
+
+        Every task is handled and responded to on its own, with its own
+        reply_to and correlation_id.
+        """
+        if not batch:
+            channel.basic_ack(method.delivery_tag)
+            return
+        delivery = _BatchDelivery(method.delivery_tag, len(batch))
+        accepts_compressed = _accepts_compressed(batch_properties)
+        for item in batch:
+            headers = item.get('headers')
+            if accepts_compressed:
+                headers = dict(headers or {})
+                headers[ACCEPT_ENCODING_HEADER] = ZLIB_ENCODING
+            properties = pika.BasicProperties(
+                reply_to=item.get('reply_to'),
+                correlation_id=item.get('correlation_id'),
+                headers=headers)
+            self._submit((channel, properties, item['task'], delivery))
+
+    def _submit(self, task_args):
+        self._run_task(task_args)
+
+    def _ack(self, channel, delivery_tag):
+        if isinstance(delivery_tag, _BatchDelivery):
+            if not delivery_tag.task_acked():
+                return
+            delivery_tag = delivery_tag.delivery_tag
+        self._connection.ack(channel, delivery_tag)
+
+    def _process_message(self, channel, properties, full_task, delivery_tag,
+                         queued_at=None):
+        """Handle the task, and respond to it.
+
+        :param queued_at: when the task was handed off to the worker
+                          threads, to report how long it waited
+        """
+        started_at = time.time()
         if not self.late_ack:
-            self._connection.ack(channel, delivery_tag)
+            self._ack(channel, delivery_tag)
         try:
-            result = self.handle_task(full_task)
+            with tracing.span(
+                    'handle task', category='amqp', queue=self.queue,
+                    parent=tracing.SpanContext.from_headers(
+                        properties.headers)):
+                result = self.handle_task(full_task)
         except Exception as e:
             result = {'ok': False, 'error': repr(e)}
             logger.exception(
@@ -408,38 +900,83 @@ class TaskConsumer(object):
                 '{0!r}\nbody: {1}'.format(e, full_task)
             )
         if self.late_ack:
-            self._connection.ack(channel, delivery_tag)
+            self._ack(channel, delivery_tag)
         if properties.reply_to:
             if result is NO_RESPONSE:
                 self.delete_queue(properties.reply_to)
             else:
+                # the requester can send compressed requests from now on
+                response_properties = pika.BasicProperties(
+                    correlation_id=properties.correlation_id,
+                    headers={ACCEPT_ENCODING_HEADER: ZLIB_ENCODING})
+                result = self._with_timings(result, queued_at, started_at)
+                body = encode_body(result, response_properties,
+                                   compress=_accepts_compressed(properties))
                 self._connection.publish({
                     'exchange': self.exchange,
                     'routing_key': properties.reply_to,
-                    'properties': pika.BasicProperties(
-                        correlation_id=properties.correlation_id),
-                    'body': json.dumps(result)
+                    'properties': response_properties,
+                    'body': body
                 })
 
-        if not self._maybe_run_next_task():
-            self._sem.release()
+    @staticmethod
+    def _with_timings(result, queued_at, started_at):
+        """The response, with how long the task waited, and was handled.
 
-    def _run_task(self, task_args):
-        new_thread = threading.Thread(
-            target=self._process_message,
-            args=task_args
-        )
-        new_thread.daemon = True
-        new_thread.start()
+        They're added to the timings that the handler returned, if any;
+        the workflow records them, see cloudify.workflows.timings
+        """
+        if not isinstance(result, dict):
+            return result
+        timings = dict(result.get('timings') or {})
+        timings['handle'] = time.time() - started_at
+        if queued_at is not None:
+            timings['queue'] = started_at - queued_at
+        return dict(result, timings=timings)
 
-    def _maybe_run_next_task(self):
-        try:
-            task_args = self._tasks_buffer.popleft()
-        except IndexError:
-            return False
-        else:
-            self._run_task(task_args)
-            return True
+    def _run_task(self, task_args):
+        """Hand the task off to a worker thread"""
+        if not self._workers:
+            self._start_workers()
+        with self._queued_lock:
+            self._queued += 1
+            pause = not self._paused and \
+                self._queued > self.threadpool_size
+            if pause:
+                self._paused = True
+        self._tasks.put(task_args + (time.time(), ))
+        if pause:
+            self._connection.channel_method(self._update_consuming,
+                                            wait=False)
+
+    def _task_taken(self):
+        with self._queued_lock:
+            self._queued -= 1
+            resume = self._paused and \
+                self._queued <= self.threadpool_size
+            if resume:
+                self._paused = False
+        if resume:
+            self._connection.channel_method(self._update_consuming,
+                                            wait=False)
+
+    def _start_workers(self):
+        self._tasks = queue.Queue()
+        for _ in range(self.threadpool_size):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task_args = self._tasks.get()
+            self._task_taken()
+            try:
+                self._process_message(*task_args)
+            except Exception:
+                # eg. the response couldn't be sent; the worker must go on
+                logger.exception('Error processing task')
 
     def handle_task(self, full_task):
         raise NotImplementedError()
@@ -480,15 +1017,45 @@ class SendHandler(object):
         msg = u'[{0}] {1}'.format(exec_id, text) if exec_id else text
         log_func(msg)
 
-    def publish(self, message, **kwargs):
+    def publish(self, message, wait=None, **kwargs):
+        """Publish the message.
+
+        :param wait: whether to wait for the message to be sent; by
+                     default, wait_for_publish
+        :return: what AMQPConnection.publish returns
+        """
         if 'message' in message:
             # message is textual, let's log it
             self._log_message(message)
-        self._connection.publish({
+        properties = pika.BasicProperties()
+        return self._connection.publish({
             'exchange': self.exchange,
-            'body': json.dumps(message),
+            'body': encode_body(message, properties,
+                                compress=_compress_events()),
+            'properties': properties,
             'routing_key': self.routing_key
-        }, wait=self.wait_for_publish)
+        }, wait=self._wait(wait), channel_key=self)
+
+    def publish_batch(self, messages, wait=None):
+        """Publish several messages as a single AMQP message.
+
+        The messages are kept in order. The consumer must unpack them,
+        see unpack_messages.
+        """
+        for message in messages:
+            if 'message' in message:
+                self._log_message(message)
+        properties = pika.BasicProperties()
+        return self._connection.publish({
+            'exchange': self.exchange,
+            'body': encode_body({BATCH_KEY: messages}, properties,
+                                compress=_compress_events()),
+            'properties': properties,
+            'routing_key': self.routing_key
+        }, wait=self._wait(wait), channel_key=self)
+
+    def _wait(self, wait):
+        return self.wait_for_publish if wait is None else wait
 
 
 class ScheduledExecutionHandler(SendHandler):
@@ -561,17 +1128,77 @@ class _RequestResponseHandlerBase(TaskConsumer):
         self._declare_queue(self._queue_name(correlation_id))
 
     def publish(self, message, correlation_id, routing_key='',
-                expiration=None):
+                expiration=None, headers=None):
         if expiration is not None:
             # rabbitmq wants it to be a string
             expiration = '{0}'.format(expiration)
+        properties = pika.BasicProperties(
+            reply_to=self._queue_name(correlation_id),
+            correlation_id=correlation_id,
+            expiration=expiration,
+            headers=self._request_headers(headers))
+        self._connection.publish({
+            'exchange': self.exchange,
+            'body': encode_body(message, properties,
+                                compress=self._peer_accepts_compressed()),
+            'properties': properties,
+            'routing_key': routing_key
+        })
+
+    def _request_headers(self, headers=None):
+        """Headers of a request: the response to it can be compressed"""
+        headers = dict(headers or {})
+        headers[ACCEPT_ENCODING_HEADER] = ZLIB_ENCODING
+        return headers
+
+    def _peer_accepts_compressed(self):
+        return _accepting_compressed.get(self.exchange, False)
+
+    def _response_received(self, properties):
+        """Remember if the agent responding accepts compressed requests.
+
+        An exchange can have several consumers, of different versions,
+        so a single one that doesn't is enough to stop compressing.
+        """
+        if _accepts_compressed(properties):
+            _accepting_compressed.setdefault(self.exchange, True)
+        else:
+            _accepting_compressed[self.exchange] = False
+
+    def publish_batch(self, messages, routing_key='', headers=None):
+        """Publish several request messages as a single AMQP message.
+
+        Each message still gets its response separately, on its own
+        response queue. The receiving TaskConsumer must support batches
+        (see TaskConsumer.process).
+
+        The messages are sent in as many AMQP messages as needed so that
+        none holds more than MAX_BATCH_SIZE of them.
+
+        :param messages: a list of (message, correlation_id) pairs
+        :param headers: headers of each message, by correlation_id
+        """
+        for start in range(0, len(messages), MAX_BATCH_SIZE):
+            self._publish_batch(messages[start:start + MAX_BATCH_SIZE],
+                                routing_key, headers)
+
+    def _publish_batch(self, messages, routing_key, headers):
+        batch = []
+        for message, correlation_id in messages:
+            item = {
+                'task': message,
+                'reply_to': self._queue_name(correlation_id),
+                'correlation_id': correlation_id
+            }
+            if headers and headers.get(correlation_id):
+                item['headers'] = headers[correlation_id]
+            batch.append(item)
+        properties = pika.BasicProperties(headers=self._request_headers())
         self._connection.publish({
             'exchange': self.exchange,
-            'body': json.dumps(message),
-            'properties': pika.BasicProperties(
-                reply_to=self._queue_name(correlation_id),
-                correlation_id=correlation_id,
-                expiration=expiration),
+            'body': encode_body({BATCH_KEY: batch}, properties,
+                                compress=self._peer_accepts_compressed()),
+            'properties': properties,
             'routing_key': routing_key
         })
 
@@ -598,7 +1225,7 @@ class BlockingRequestResponseHandler(_RequestResponseHandlerBase):
             message, correlation_id, *args, **kwargs)
 
         try:
-            return json.loads(self._response.get(timeout=timeout))
+            return codec.loads(self._response.get(timeout=timeout))
         except queue.Empty:
             raise RuntimeError('No response received for task {0}'
                                .format(correlation_id))
@@ -608,10 +1235,11 @@ class BlockingRequestResponseHandler(_RequestResponseHandlerBase):
 
     def process(self, channel, method, properties, body):
         channel.basic_ack(method.delivery_tag)
+        self._response_received(properties)
         self.delete_queue(
             self._queue_name(properties.correlation_id),
             wait=False, if_empty=False)
-        self._response.put(body)
+        self._response.put(decode_body(body, properties))
 
 
 class CallbackRequestResponseHandler(_RequestResponseHandlerBase):
@@ -632,11 +1260,12 @@ class CallbackRequestResponseHandler(_RequestResponseHandlerBase):
             message, correlation_id, *args, **kwargs)
 
     def process(self, channel, method, properties, body):
+        self._response_received(properties)
         if properties.correlation_id in self.callbacks:
             try:
-                response = json.loads(body)
+                response = codec.loads(decode_body(body, properties))
                 self.callbacks[properties.correlation_id](response)
-            except ValueError:
+            except (ValueError, zlib.error):
                 logger.error('Error parsing response: {0}'.format(body))
         channel.basic_ack(method.delivery_tag)
         self.delete_queue(
@@ -697,14 +1326,26 @@ class CloudifyEventsPublisher(object):
         self._connection = AMQPConnection(
             handlers=list(self.handlers.values()),
             amqp_params=amqp_params,
-            name=os.environ.get('AGENT_NAME')
+            name=os.environ.get('AGENT_NAME'),
+            # logs aren't waited for, and events are sent from many threads:
+            # don't make each of them wait for the previous one's confirm.
+            # Every handler publishes on its own channel, so that a flood of
+            # logs doesn't hold up the events
+            publish_window=DEFAULT_PUBLISH_WINDOW,
+            publish_channels=len(self.handlers)
         )
         self._is_closed = False
 
     def connect(self):
         self._connection.consume_in_thread()
 
-    def publish_message(self, message, message_type):
+    def publish_message(self, message, message_type, wait=None):
+        """Publish a message using the handler for its type.
+
+        :param wait: whether to wait for the message to be sent; by
+                     default, events are waited for, and logs aren't
+        :return: a PublishConfirmation
+        """
         if self._is_closed:
             raise exceptions.ClosedAMQPClientException(
                 'Publish failed, AMQP client already closed')
@@ -712,11 +1353,36 @@ class CloudifyEventsPublisher(object):
         handler = self.handlers.get(message_type)
 
         if handler:
-            handler.publish(message)
+            return handler.publish(message, wait=wait)
         else:
             logger.error('Unknown message type : {0} for message : {1}'.
                          format(message_type, message))
 
+    def publish_batch(self, messages, message_type, wait=None):
+        """Publish several messages of the same type, as one AMQP message"""
+        if len(messages) == 1:
+            return self.publish_message(messages[0], message_type, wait)
+        if self._is_closed:
+            raise exceptions.ClosedAMQPClientException(
+                'Publish failed, AMQP client already closed')
+
+        handler = self.handlers.get(message_type)
+
+        if handler:
+            return handler.publish_batch(messages, wait=wait)
+        else:
+            logger.error('Unknown message type : {0} for {1} messages'.
+                         format(message_type, len(messages)))
+
+    def is_alive(self):
+        """Whether the connection thread is running, or reconnecting.
+
+        It stops trying to reconnect after connect_timeout, and then the
+        messages that weren't confirmed yet are never going to be.
+        """
+        thread = self._connection._consumer_thread
+        return thread is not None and thread.is_alive()
+
     def close(self):
         if self._is_closed:
             return
@@ -13,12 +13,46 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import atexit
+import logging
+import os
+import time
+from collections import OrderedDict
 from threading import Thread, RLock, Event
 
-from cloudify import amqp_client
+from cloudify import amqp_client, spool
 from cloudify._compat import queue
 from cloudify.exceptions import ClosedAMQPClientException
 
+# logs and events are sent in batches of up to this many, when it's more
+# than 1; the consumers must unpack them, see amqp_client.unpack_messages
+EVENTS_BATCH_SIZE_ENV = 'CLOUDIFY_EVENTS_BATCH_SIZE'
+# how long, in seconds, to wait for more logs and events to fill a batch
+EVENTS_FLUSH_INTERVAL_ENV = 'CLOUDIFY_EVENTS_FLUSH_INTERVAL'
+DEFAULT_EVENTS_FLUSH_INTERVAL = 0.1
+# how long, in seconds, the publisher stays connected with nothing to
+# publish and no registered callers
+EVENTS_IDLE_TIMEOUT_ENV = 'CLOUDIFY_EVENTS_IDLE_TIMEOUT'
+DEFAULT_EVENTS_IDLE_TIMEOUT = 60
+# at exit, how long to wait for the queued logs and events to be published
+SHUTDOWN_TIMEOUT = 10
+# if set, logs and events are spooled on disk under this directory, and
+# published from there; see _GlobalEventsPublisher
+EVENTS_SPOOL_DIR_ENV = 'CLOUDIFY_EVENTS_SPOOL_DIR'
+# the most disk space that a process' spool takes, in bytes
+EVENTS_SPOOL_MAX_BYTES_ENV = 'CLOUDIFY_EVENTS_SPOOL_MAX_BYTES'
+# spooled messages are published this many at a time, and confirmed
+# before the next ones are published
+SPOOL_READ_SIZE = amqp_client.DEFAULT_PUBLISH_WINDOW
+# how often to check that the client is still connected (or reconnecting),
+# while waiting for spooled messages to be confirmed
+SPOOL_CONFIRM_TIMEOUT = 5
+# how long to wait before publishing the spooled messages again, after
+# failing to
+SPOOL_RETRY_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
 
 class AMQPWrappedThread(Thread):
     """
@@ -40,22 +74,69 @@ class AMQPWrappedThread(Thread):
 
 
 _STOP = object()
+# put in the queue to wake the thread up, when messages are spooled
+_SPOOLED = object()
 
 
 class _GlobalEventsPublisher(object):
+    """Publishes logs and events from a thread, on a long-lived client.
+
+    Publishing only puts the message in a queue, so it never waits for the
+    client to connect. The client is connected when there's something to
+    publish, and stays connected until it's been idle for idle_timeout
+    seconds, or until close is called (which happens at exit).
+
+    Registered callers are never idle: registering connects the client
+    right away, and when the last caller unregisters, what it queued is
+    published before unregister_caller returns.
+
+    With CLOUDIFY_EVENTS_SPOOL_DIR set, the messages are written to
+    a spool.Spool instead of kept in memory, and the thread publishes them
+    from there, in order. Messages are only removed from the spool once
+    they're confirmed, so while the broker is unreachable, they're kept on
+    disk (up to CLOUDIFY_EVENTS_SPOOL_MAX_BYTES), and published once it's
+    back; the ones that were sent but not confirmed might be published
+    twice. Registering doesn't connect, and unregistering callers doesn't
+    wait for spooled messages.
+
+    Every process has its own spool, under a directory named spool_name.
+    When a process exits before its spool was published, eg. an
+    operation's process during a broker outage, the next process to start
+    spooling under the same directory claims it, and publishes it first.
+
+    :param spool_name: the spool directory of this publisher, under
+                       CLOUDIFY_EVENTS_SPOOL_DIR
+    """
+
     def __init__(self, *client_args, **client_kwargs):
+        self._spool_name = client_kwargs.pop('spool_name', 'events')
+        # set when messages can be published: the client is connected, or
+        # they are spooled
         self.client_started = Event()
         self._connect_lock = RLock()
         self._callers = 0
         self._thread = None
+        self._client = None
         self._queue = queue.Queue()
         self._client_args = client_args
         self._client_kwargs = client_kwargs
+        self._batch_size = 1
+        self._flush_interval = DEFAULT_EVENTS_FLUSH_INTERVAL
+        self._idle_timeout = DEFAULT_EVENTS_IDLE_TIMEOUT
+        self._spool = None
+        # spools of the processes that exited before publishing them
+        self._abandoned_spools = []
+        self._spool_checked = False
+        self._closing = False
 
     def register_caller(self):
         with self._connect_lock:
-            if not self.client_started.is_set():
-                self._connect()
+            if self._get_spool() is None:
+                self._get_client()
+            else:
+                # the thread connects, once the broker is reachable
+                self.client_started.set()
+            self._start()
             self._callers += 1
 
     def unregister_caller(self):
@@ -64,9 +145,10 @@ class _GlobalEventsPublisher(object):
             # Can theoretically be less than zero, if this function is called
             # by dispatch.py as part of cleanup after the init_events_publisher
             # call failed.
-            if self._callers <= 0:
-                self._disconnect()
-                self._thread.join()
+            if self._callers > 0 or self._thread is None or \
+                    self._spool is not None:
+                return
+        self._queue.join()
 
     def __enter__(self):
         self.register_caller()
@@ -76,38 +158,290 @@ class _GlobalEventsPublisher(object):
         self.unregister_caller()
 
     def publish_message(self, message, message_type):
-        self._queue.put((message, message_type))
+        message_spool = self._get_spool()
+        if message_spool is None:
+            self._queue.put((message, message_type))
+        elif message_spool.append([message_type, message]) and \
+                self._queue.empty():
+            # the thread publishes everything that's spooled when it
+            # wakes up, so there's no need for more than one _SPOOLED
+            self._queue.put(_SPOOLED)
+        if self._thread is None:
+            with self._connect_lock:
+                self._start()
 
-    def close(self):
-        self.unregister_caller()
-        self._client.close()
+    def close(self, timeout=None):
+        """Publish what's queued, and disconnect.
+
+        Spooled messages that can't be published, because the broker is
+        unreachable, are left in the spool directory.
+        """
+        with self._connect_lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._closing = True
+            self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _get_spool(self):
+        if self._spool_checked:
+            return self._spool
+        with self._connect_lock:
+            if not self._spool_checked:
+                self._open_spools()
+                self._spool_checked = True
+            return self._spool
+
+    def _open_spools(self):
+        """Create this process' spool, and claim the abandoned ones.
+
+        The thread is woken up to publish what's in those; the caller
+        starts it.
+        """
+        spool_dir = os.environ.get(EVENTS_SPOOL_DIR_ENV)
+        if not spool_dir:
+            return
+        root = os.path.join(spool_dir, self._spool_name)
+        try:
+            self._spool = spool.create(root, max_bytes=int(
+                os.environ.get(EVENTS_SPOOL_MAX_BYTES_ENV) or
+                spool.DEFAULT_MAX_BYTES))
+        except (IOError, OSError) as e:
+            logger.warning('Cannot spool logs and events in %s: %s',
+                           root, e)
+            return
+        try:
+            self._abandoned_spools = spool.claim_abandoned(
+                root, exclude=self._spool.directory)
+        except (IOError, OSError) as e:
+            logger.warning('Cannot claim the spooled logs and events in '
+                           '%s: %s', root, e)
+        abandoned = sum(len(s) for s in self._abandoned_spools)
+        if abandoned:
+            logger.info('Publishing %d logs and events spooled by '
+                        'processes that exited', abandoned)
+            self._queue.put(_SPOOLED)
+
+    def _spooled(self):
+        """Number of the messages in the spools, not published yet"""
+        return sum(len(s) for s in self._abandoned_spools) + (
+            len(self._spool) if self._spool is not None else 0)
 
     def _make_client(self):
         return amqp_client.create_events_publisher(
             *self._client_args, **self._client_kwargs)
 
-    def _connect(self):
-        self._client = self._make_client()
-        self.client_started.set()
+    def _get_client(self):
+        with self._connect_lock:
+            if self._client is None:
+                self._client = self._make_client()
+                self.client_started.set()
+            return self._client
+
+    def _detach_client(self):
+        """Stop using the client; the caller closes it"""
+        with self._connect_lock:
+            client, self._client = self._client, None
+            if self._spool is None:
+                self.client_started.clear()
+            return client
+
+    def _start(self):
+        """Start the publishing thread, unless it's running already"""
+        if self._thread is not None:
+            return
+        self._batch_size = _events_batch_size()
+        self._flush_interval = float(os.environ.get(
+            EVENTS_FLUSH_INTERVAL_ENV, DEFAULT_EVENTS_FLUSH_INTERVAL))
+        self._idle_timeout = float(os.environ.get(
+            EVENTS_IDLE_TIMEOUT_ENV, DEFAULT_EVENTS_IDLE_TIMEOUT))
+        self._closing = False
         self._thread = Thread(target=self._handle_publish_message)
+        # at exit, close publishes what's left; don't wait for idle_timeout
+        self._thread.daemon = True
         self._thread.start()
 
-    def _disconnect(self):
-        self._queue.put(_STOP)
-
     def _handle_publish_message(self):
         while True:
-            request = self._queue.get()
-            if request is _STOP:
+            requests, stop = self._next_requests()
+            if self._spool is not None:
+                if requests or stop:
+                    self._drain_spool()
+            elif requests:
+                try:
+                    self._publish_requests(requests)
+                except Exception as e:
+                    logger.warning('Error publishing %d logs and events: %s',
+                                   len(requests), e)
+            for _ in range(len(requests) + (1 if stop else 0)):
+                self._queue.task_done()
+            if stop:
+                with self._connect_lock:
+                    self._thread = None
+                    client = self._detach_client()
+                    spools = self._abandoned_spools + (
+                        [self._spool] if self._spool is not None else [])
+                    self._spool, self._abandoned_spools = None, []
+                    self._spool_checked = False
+                    self.client_started.clear()
+                for message_spool in spools:
+                    message_spool.close()
+                break
+            if not requests:
+                stopped, client = self._stop_if_idle()
+                if stopped:
+                    break
+        if client is not None:
+            client.close()
+
+    def _stop_if_idle(self):
+        """Let the thread end, unless there's a caller or a message.
+
+        :return: whether to stop, and the client to close
+        """
+        with self._connect_lock:
+            if self._callers > 0:
+                return False, None
+            # publish_message starts another thread if it sees this one
+            # is gone, so only check for messages after clearing it
+            thread, self._thread = self._thread, None
+            if not self._queue.empty() or self._spooled():
+                self._thread = thread
+                return False, None
+            return True, self._detach_client()
+
+    def _next_requests(self):
+        """Wait for the next requests to publish.
+
+        Returns up to batch_size requests: the first one, and those that
+        were put in the queue in flush_interval after it. If there are
+        none for idle_timeout, returns no requests.
+
+        :return: the requests, and whether to stop after publishing them
+        """
+        requests = []
+        deadline = None
+        while len(requests) < self._batch_size:
+            try:
+                if deadline is None:
+                    request = self._queue.get(timeout=self._idle_timeout)
+                    deadline = time.time() + self._flush_interval
+                else:
+                    request = self._queue.get(
+                        timeout=max(0, deadline - time.time()))
+            except queue.Empty:
                 break
+            if request is _STOP:
+                return requests, True
+            requests.append(request)
+        return requests, False
+
+    def _publish_requests(self, requests, **kwargs):
+        """Publish the requests, return what the client returned"""
+        if self._batch_size > 1:
+            return self._publish_batches(requests, **kwargs)
+        return [self._publish('publish_message', *request, **kwargs)
+                for request in requests]
+
+    def _publish_batches(self, requests, **kwargs):
+        # every type of message goes to its own exchange or routing key, so
+        # there's no order between the types to keep, only within each
+        by_type = OrderedDict()
+        for message, message_type in requests:
+            by_type.setdefault(message_type, []).append(message)
+        return [self._publish('publish_batch', messages, message_type,
+                              **kwargs)
+                for message_type, messages in by_type.items()]
+
+    def _publish(self, method, *args, **kwargs):
+        try:
+            return getattr(self._get_client(), method)(*args, **kwargs)
+        except ClosedAMQPClientException:
+            with self._connect_lock:
+                self._client = self._make_client()
+            return getattr(self._client, method)(*args, **kwargs)
+
+    def _drain_spool(self):
+        """Publish the spooled messages, until there's none left.
+
+        The abandoned spools are published first, oldest first, and
+        removed once they're empty.
+        """
+        while self._abandoned_spools:
+            if not self._drain(self._abandoned_spools[0]):
+                return
+            with self._connect_lock:
+                message_spool = self._abandoned_spools.pop(0)
+            message_spool.close()
+        self._drain(self._spool)
+
+    def _drain(self, message_spool):
+        """Publish the messages of message_spool, until there's none left.
+
+        While they can't be published, retry every SPOOL_RETRY_INTERVAL,
+        unless the publisher is closing.
+
+        :return: whether the spool was emptied
+        """
+        while True:
+            records = message_spool.read(SPOOL_READ_SIZE)
+            if not records:
+                return True
+            requests = [(message, message_type)
+                        for message_type, message in records]
+            while not self._publish_spooled(requests):
+                if self._closing:
+                    return False
+                time.sleep(SPOOL_RETRY_INTERVAL)
+            message_spool.commit(len(records))
+
+    def _publish_spooled(self, requests):
+        """Publish the requests, and wait for them to be confirmed.
+
+        :return: whether they were all confirmed
+        """
+        try:
+            for confirmation in self._publish_requests(requests, wait=False):
+                self._wait_for_confirm(confirmation)
+        except Exception as e:
+            logger.warning('Error publishing %d spooled logs and events, '
+                           'retrying in %ds: %s',
+                           len(requests), SPOOL_RETRY_INTERVAL, e)
+            # the next attempt connects again
+            client = self._detach_client()
+            if client is not None:
+                client.close()
+            return False
+        return True
+
+    def _wait_for_confirm(self, confirmation):
+        while confirmation is not None:
             try:
-                self._client.publish_message(*request)
-            except ClosedAMQPClientException:
-                with self._connect_lock:
-                    self._client = self._make_client()
-                self._client.publish_message(*request)
-        self._client.close()
-        self.client_started.clear()
+                confirmation.wait(SPOOL_CONFIRM_TIMEOUT)
+                return
+            except queue.Empty:
+                client = self._client
+                if self._closing or client is None or \
+                        not client.is_alive():
+                    raise ClosedAMQPClientException(
+                        'Disconnected before the message was confirmed')
+
+
+def _events_batch_size():
+    """The batch size set in the environment; at least 1"""
+    value = os.environ.get(EVENTS_BATCH_SIZE_ENV)
+    if not value:
+        return 1
+    try:
+        batch_size = int(value)
+    except ValueError:
+        batch_size = 0
+    if batch_size < 1:
+        logger.warning('Invalid %s: %r, not sending logs and events in '
+                       'batches', EVENTS_BATCH_SIZE_ENV, value)
+        return 1
+    return batch_size
 
 
 def init_events_publisher():
@@ -123,5 +457,13 @@ def close_amqp_client():
     global_management_events_publisher.unregister_caller()
 
 
+def close_events_publishers(timeout=SHUTDOWN_TIMEOUT):
+    """Publish the queued logs and events, and disconnect"""
+    global_events_publisher.close(timeout)
+    global_management_events_publisher.close(timeout)
+
+
 global_events_publisher = _GlobalEventsPublisher()
-global_management_events_publisher = _GlobalEventsPublisher(amqp_vhost='/')
+global_management_events_publisher = _GlobalEventsPublisher(
+    amqp_vhost='/', spool_name='management-events')
+atexit.register(close_events_publishers)
@@ -0,0 +1,139 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""JSON encoding and decoding of AMQP messages and REST payloads.
+
+The stdlib json module is used by default. Set the CLOUDIFY_JSON_CODEC
+environment variable to "orjson" to use orjson instead, which is several
+times faster, or to "auto" to use it only if it's installed. Another
+codec can be used by calling set_codec.
+
+Only the hot paths go through the codec, ie. plain dumps and loads
+calls. Calls that need the json module's options (indent, cls, ...)
+still use it directly.
+"""
+
+import json
+import logging
+import os
+import re
+
+JSON_CODEC_ENV = 'CLOUDIFY_JSON_CODEC'
+
+# numbers this long might be integers that don't fit in 64 bits, which
+# orjson parses as floats, losing precision
+_LONG_NUMBER = re.compile(r'\d{20}')
+_LONG_NUMBER_BYTES = re.compile(br'\d{20}')
+
+logger = logging.getLogger(__name__)
+
+
+class JSONCodec(object):
+    """The stdlib json module"""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """orjson, falling back to the stdlib for what it can't serialize"""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        try:
+            return self._orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # eg. non-string keys, or ints that don't fit in 64 bits
+            return json.dumps(obj)
+
+    def loads(self, data):
+        pattern = _LONG_NUMBER_BYTES if isinstance(data, bytes) \
+            else _LONG_NUMBER
+        if pattern.search(data):
+            return json.loads(data)
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            # eg. NaN or Infinity, which the stdlib accepts
+            return json.loads(data)
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    OrjsonCodec.name: OrjsonCodec,
+}
+
+
+def _codec_from_env():
+    name = os.environ.get(JSON_CODEC_ENV) or JSONCodec.name
+    if name == 'auto':
+        name = OrjsonCodec.name
+        required = False
+    else:
+        required = True
+    try:
+        return CODECS[name]()
+    except (KeyError, ImportError) as e:
+        if required:
+            logger.warning('JSON codec %s is not available, using %s: %s',
+                           name, JSONCodec.name, e)
+        return JSONCodec()
+
+
+_codec = _codec_from_env()
+
+
+def get_codec():
+    return _codec
+
+
+def set_codec(codec):
+    """Use this codec from now on.
+
+    :param codec: an object with dumps and loads methods, like JSONCodec
+    """
+    global _codec
+    _codec = codec
+
+
+def dumps(obj):
+    return _codec.dumps(obj)
+
+
+def loads(data):
+    """Decode a JSON document, given as text or as utf-8 encoded bytes"""
+    return _codec.loads(data)
+
+
+def dump(obj, f):
+    """Write obj to f, which must be opened in binary mode, as utf-8.
+
+    Codecs might output non-ascii text (orjson does), so this doesn't
+    rely on the locale encoding of a text mode file.
+    """
+    f.write(dumps(obj).encode('utf-8'))
+
+
+def load(f):
+    """Read a document written by dump from f, opened in binary mode"""
+    return loads(f.read())
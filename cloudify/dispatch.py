@@ -15,7 +15,6 @@
 
 
 import copy
-import json
 import logging
 import os
 import shutil
@@ -23,6 +22,7 @@ import subprocess
 import sys
 import tempfile
 import threading
+import time
 from time import sleep
 import traceback
 
@@ -34,6 +34,7 @@ from cloudify_rest_client.exceptions import (
     CloudifyClientError
 )
 
+from cloudify import codec
 from cloudify import logs
 from cloudify import exceptions
 from cloudify import state
@@ -41,6 +42,8 @@ from cloudify import context
 from cloudify import utils
 from cloudify import amqp_client_utils
 from cloudify import constants
+from cloudify import metrics
+from cloudify import tracing
 from cloudify._compat import queue, StringIO, PY2
 from cloudify.amqp_client_utils import AMQPWrappedThread
 from cloudify.manager import update_execution_status, get_rest_client
@@ -56,11 +59,13 @@ except ImportError:
     plugin_installer = None
 
 try:
+    from cloudify.workflows import aio
     from cloudify.workflows import api
     from cloudify.workflows import workflow_context
 except ImportError:
     workflow_context = None
     api = None
+    aio = None
 
 
 ENV_ENCODING = 'utf-8'  # encoding for env variables
@@ -77,6 +82,10 @@ PREINSTALLED_PLUGINS = [
     'worker_installer',
     'cloudify_system_workflows',
 ]
+# reserved execution parameters, which are moved into the workflow's
+# cloudify context under another name; the leading underscore keeps them
+# apart from the workflows' own parameters
+CONTEXT_EXECUTION_PARAMETERS = {'_profile_memory': 'profile_memory'}
 
 
 class LockedFile(object):
@@ -179,6 +188,10 @@ class TaskHandler(object):
         self._func = self.NOTSET
         self._logfiles = {}
         self._process_registry = process_registry
+        # durations (in seconds) of the phases of handling the task: the
+        # subprocess run, and the operation function itself. Agents can
+        # report these to the workflow, see cloudify.workflows.timings
+        self.timings = {}
 
     def handle_or_dispatch_to_subprocess_if_remote(self):
         if self.cloudify_context.get('task_target'):
@@ -246,17 +259,38 @@ class TaskHandler(object):
 
         return LockedFile.open(log_name)
 
+    def trace_parent(self):
+        """Context of the span that the spans of this task are children of
+
+        That's the current span (eg. the agent handling the task message),
+        or the one the task was sent with.
+        """
+        return tracing.current() or tracing.SpanContext.from_dict(
+            self.cloudify_context.get(tracing.TRACE_KEY))
+
     def dispatch_to_subprocess(self):
+        with tracing.span('subprocess', category='dispatch',
+                          parent=self.trace_parent(),
+                          task_name=self.cloudify_context['task_name']) \
+                as span:
+            return self._dispatch_to_subprocess(span.context)
+
+    def _dispatch_to_subprocess(self, trace_context):
         # inputs.json, output.json and output are written to a temporary
         # directory that only lives during the lifetime of the subprocess
+        cloudify_context = self.cloudify_context
+        if trace_context is not None:
+            # spans in the subprocess are children of the subprocess span
+            cloudify_context = dict(cloudify_context)
+            cloudify_context[tracing.TRACE_KEY] = trace_context.to_dict()
         split = self.cloudify_context['task_name'].split('.')
         dispatch_dir = tempfile.mkdtemp(prefix='task-{0}.{1}-'.format(
             split[0], split[-1]))
 
         try:
-            with open(os.path.join(dispatch_dir, 'input.json'), 'w') as f:
-                json.dump({
-                    'cloudify_context': self.cloudify_context,
+            with open(os.path.join(dispatch_dir, 'input.json'), 'wb') as f:
+                codec.dump({
+                    'cloudify_context': cloudify_context,
                     'args': self.args,
                     'kwargs': self.kwargs
                 }, f)
@@ -281,12 +315,15 @@ class TaskHandler(object):
                 os.path.dirname(executable), env['PATH'])
             command_args = [executable, '-u', '-m', 'cloudify.dispatch',
                             dispatch_dir]
+            subprocess_start = time.time()
             self.run_subprocess(command_args,
                                 env=env,
                                 bufsize=1,
                                 close_fds=os.name != 'nt')
-            with open(os.path.join(dispatch_dir, 'output.json')) as f:
-                dispatch_output = json.load(f)
+            self.timings['subprocess'] = time.time() - subprocess_start
+            with open(os.path.join(dispatch_dir, 'output.json'), 'rb') as f:
+                dispatch_output = codec.load(f)
+            self.timings.update(dispatch_output.get('timings') or {})
             if dispatch_output['type'] == 'result':
                 return dispatch_output['payload']
             elif dispatch_output['type'] == 'error':
@@ -507,9 +544,12 @@ class OperationHandler(TaskHandler):
                 amqp_client_utils.close_amqp_client()
 
     def _run_operation_func(self, ctx, kwargs):
+        start = time.time()
         try:
-            return self.func(*self.args, **kwargs)
+            with tracing.span('operation', category='plugin'):
+                return self.func(*self.args, **kwargs)
         finally:
+            self.timings['operation'] = time.time() - start
             if ctx.type == constants.NODE_INSTANCE:
                 ctx.instance.update()
             elif ctx.type == constants.RELATIONSHIP_INSTANCE:
@@ -524,6 +564,11 @@ class WorkflowHandler(TaskHandler):
             raise RuntimeError('Dispatcher not installed')
         super(WorkflowHandler, self).__init__(*args, **kwargs)
         self.execution_parameters = copy.deepcopy(self.kwargs)
+        # these configure the workflow context, and aren't passed to the
+        # workflow function
+        for name, context_key in CONTEXT_EXECUTION_PARAMETERS.items():
+            if name in self.kwargs:
+                self.cloudify_context[context_key] = self.kwargs.pop(name)
 
     @property
     def ctx_cls(self):
@@ -685,6 +730,8 @@ class WorkflowHandler(TaskHandler):
         try:
             self.ctx.internal.start_local_tasks_processing()
             result = self.func(*self.args, **self.kwargs)
+            if aio.iscoroutine(result):
+                result = aio.run(result)
             if not self.ctx.internal.graph_mode:
                 tasks = list(self.ctx.internal.task_graph.tasks_iter())
                 for workflow_task in tasks:
@@ -692,6 +739,40 @@ class WorkflowHandler(TaskHandler):
             return result
         finally:
             self.ctx.internal.stop_local_tasks_processing()
+            self._send_timings_summary()
+            self._send_memory_profile()
+
+    def _send_timings_summary(self):
+        summary = self.ctx.internal.timings.summary()
+        if summary is None:
+            return
+        try:
+            self.ctx.internal.send_workflow_event(
+                event_type='workflow_timings',
+                message="'{0}' workflow execution timings".format(
+                    self.ctx.workflow_id),
+                args={'timings': summary})
+        except Exception:
+            logger = logging.getLogger(__name__)
+            logger.exception('Failed sending the execution timings')
+
+    def _send_memory_profile(self):
+        profile = self.ctx.internal.memory_profile
+        if not profile.enabled:
+            return
+        try:
+            profile.sample('end')
+            profile.stop()
+            if self.ctx.memory_profile_path:
+                profile.write(self.ctx.memory_profile_path)
+            self.ctx.internal.send_workflow_event(
+                event_type='workflow_memory_profile',
+                message="'{0}' workflow execution memory profile".format(
+                    self.ctx.workflow_id),
+                args={'memory_profile': profile.report()})
+        except Exception:
+            logger = logging.getLogger(__name__)
+            logger.exception('Failed sending the execution memory profile')
 
     def _workflow_started(self):
         self._update_execution_status(Execution.STARTED)
@@ -790,8 +871,8 @@ def dispatch(__cloudify_context, *args, **kwargs):
 
 def main():
     dispatch_dir = sys.argv[1]
-    with open(os.path.join(dispatch_dir, 'input.json')) as f:
-        dispatch_inputs = json.load(f)
+    with open(os.path.join(dispatch_dir, 'input.json'), 'rb') as f:
+        dispatch_inputs = codec.load(f)
     cloudify_context = dispatch_inputs['cloudify_context']
     args = dispatch_inputs['args']
     kwargs = dispatch_inputs['kwargs']
@@ -799,12 +880,21 @@ def main():
     threading.current_thread().setName('Dispatch-{0}'.format(dispatch_type))
     handler_cls = TASK_HANDLERS[dispatch_type]
     handler = None
+    metrics_exporter = None
     try:
+        # this process only lives as long as the task, so its metrics are
+        # written to the file when it's done, rather than served
+        metrics_exporter = metrics.export_from_env(serve=False)
         handler = handler_cls(cloudify_context=cloudify_context,
                               args=args,
                               kwargs=kwargs)
         handler.setup_logging()
-        payload = handler.handle()
+        # other threads, eg. the ctx proxy, also trace into the task's span
+        with tracing.span(cloudify_context['task_name'],
+                          category=dispatch_type,
+                          parent=handler.trace_parent(),
+                          default=True):
+            payload = handler.handle()
         payload_type = 'result'
     except BaseException as e:
         payload_type = 'error'
@@ -816,11 +906,15 @@ def main():
             handler.cloudify_context.get('task_id', '<no-id>'),
             payload['traceback']))
 
-    with open(os.path.join(dispatch_dir, 'output.json'), 'w') as f:
-        json.dump({
+    with open(os.path.join(dispatch_dir, 'output.json'), 'wb') as f:
+        codec.dump({
             'type': payload_type,
-            'payload': payload
+            'payload': payload,
+            'timings': handler.timings if handler else {}
         }, f)
+    if metrics_exporter is not None:
+        metrics_exporter.stop()
+    tracing.get_tracer().close()
 
 
 if __name__ == '__main__':
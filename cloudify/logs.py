@@ -17,10 +17,10 @@ import os
 import sys
 import logging.config
 import logging.handlers
-import json
 import datetime
 from functools import wraps
 
+from cloudify import codec
 from cloudify import constants
 from cloudify import amqp_client_utils
 from cloudify import event as _event
@@ -354,9 +354,10 @@ def with_amqp_client(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         """Calls the wrapped func with an AMQP client instance."""
-        # call the wrapped func with the amqp client
-        with amqp_client_utils.global_management_events_publisher as client:
-            return func(client, *args, **kwargs)
+        # the publisher connects when it has something to publish, and
+        # stays connected, so there's no need to register as its caller
+        client = amqp_client_utils.global_management_events_publisher
+        return func(client, *args, **kwargs)
 
     return wrapper
 
@@ -372,7 +373,7 @@ def _publish_message(client, message, message_type, logger):
             'Error publishing {0} to RabbitMQ ({1})[message={2}]'
             .format(message_type,
                     '{0}: {1}'.format(type(e).__name__, e),
-                    json.dumps(message)))
+                    codec.dumps(message)))
 
 
 def setup_logger_base(log_level, log_dir=None):
@@ -0,0 +1,383 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Latency histograms, exportable in the Prometheus text format.
+
+Histograms are process-wide, and are kept in REGISTRY. Observing a value
+doesn't take a lock: every thread records into its own shard, and shards
+are only merged when the metrics are exported.
+
+Export the metrics either by calling write_text_file (eg. for the
+node_exporter textfile collector), or serve_socket, which answers
+every connection to a local socket with the current metrics. When the
+CLOUDIFY_METRICS_FILE or CLOUDIFY_METRICS_SOCKET environment variables
+are set, export_from_env does that automatically.
+"""
+
+import bisect
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300, 900)
+
+METRICS_FILE_ENV = 'CLOUDIFY_METRICS_FILE'
+METRICS_SOCKET_ENV = 'CLOUDIFY_METRICS_SOCKET'
+METRICS_INTERVAL_ENV = 'CLOUDIFY_METRICS_INTERVAL'
+
+logger = logging.getLogger(__name__)
+
+
+class _Shard(object):
+    """The part of a histogram recorded by a single thread.
+
+    The thread-local holds the only reference to this object, so it is
+    collected when its thread exits, and then its series are retired
+    into the histogram's totals.
+    """
+    __slots__ = ('series', '__weakref__')
+
+    def __init__(self):
+        self.series = {}
+
+
+class _Timer(object):
+    __slots__ = ('_histogram', '_labelvalues', '_start')
+
+    def __init__(self, histogram, labelvalues):
+        self._histogram = histogram
+        self._labelvalues = labelvalues
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram.observe(time.time() - self._start,
+                                *self._labelvalues)
+
+
+def _merge_series(target, series):
+    for labelvalues, values in series.items():
+        merged = target.get(labelvalues)
+        if merged is None:
+            target[labelvalues] = list(values)
+        else:
+            for ix, value in enumerate(values):
+                merged[ix] += value
+
+
+class Histogram(object):
+    """A histogram of durations, in seconds.
+
+    :param name: the metric name, eg. cloudify_rest_request_seconds
+    :param documentation: the metric description, used as its HELP
+    :param labelnames: names of the labels, values for which are
+                       passed to .observe in the same order
+    :param buckets: upper bounds of the buckets, in seconds
+    """
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._shards = {}
+        self._retired = {}
+
+    def _shard_series(self):
+        try:
+            return self._local.shard.series
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                key = id(shard)
+                self._shards[key] = (
+                    weakref.ref(shard, lambda ref: self._retire(key)),
+                    shard.series)
+            return shard.series
+
+    def _retire(self, key):
+        with self._lock:
+            _, series = self._shards.pop(key)
+            _merge_series(self._retired, series)
+
+    def observe(self, value, *labelvalues):
+        """Record a single duration.
+
+        Every value is put in a bucket, and the last two elements
+        of a series are the count of values over the highest bucket,
+        and the sum of all values.
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('{0} expects labels: {1}'.format(
+                self.name, ', '.join(self.labelnames)))
+        series = self._shard_series()
+        values = series.get(labelvalues)
+        if values is None:
+            values = series[labelvalues] = [0] * (len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def time(self, *labelvalues):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labelvalues)
+
+    def collect(self):
+        """Merge the recorded values of all threads.
+
+        :return: dict of label values to a list of per-bucket counts,
+                 followed by the overflow count, and the sum of values
+        """
+        with self._lock:
+            merged = {}
+            _merge_series(merged, self._retired)
+            for _, series in list(self._shards.values()):
+                # other threads might be adding series in the meantime:
+                # copy the items in one (GIL-holding) step
+                _merge_series(merged, dict(series.items()))
+        return merged
+
+    def generate_text(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, _escape_help(
+                self.documentation)),
+            '# TYPE {0} histogram'.format(self.name)
+        ]
+        bounds = [_format_value(bucket) for bucket in self.buckets]
+        bounds.append('+Inf')
+        for labelvalues, values in sorted(self.collect().items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, _format_labels(labels + [('le', bound)]),
+                    cumulative))
+            lines.append('{0}_sum{1} {2}'.format(
+                self.name, _format_labels(labels), _format_value(values[-1])))
+            lines.append('{0}_count{1} {2}'.format(
+                self.name, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+def _escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, _escape_help(str(value)).replace('"', r'\"'))
+        for name, value in labels))
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        """Get the histogram called name, creating it if needed"""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Histogram(
+                    name, documentation, labelnames, buckets)
+            elif metric.labelnames != tuple(labelnames):
+                raise ValueError(
+                    'Metric {0} already registered with labels: {1}'
+                    .format(name, ', '.join(metric.labelnames)))
+            return metric
+
+    def generate_text(self):
+        """All the metrics, in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.generate_text() for metric in metrics)
+
+    def write_text_file(self, path):
+        """Write the metrics to path.
+
+        The file is replaced atomically, so that readers never see
+        a partially-written file.
+        """
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.generate_text())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def serve_socket(self, address):
+        """Serve the metrics over a local socket, in a daemon thread.
+
+        Every connection is answered with a HTTP response containing
+        the metrics, so it can be scraped directly, or read using eg.
+        `curl --unix-socket`.
+
+        :param address: path of a unix socket to create, or a
+                        (host, port) tuple to listen on using TCP
+        :return: the listening socket. To stop serving, shut it down
+                 before closing it: only closing it doesn't interrupt
+                 the thread waiting for connections
+        :raise socket.error: if another process serves on that path
+        """
+        if isinstance(address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            if os.path.exists(address):
+                if _is_listening(address):
+                    raise socket.error(
+                        errno.EADDRINUSE,
+                        'Another process serves on {0}'.format(address))
+                # left behind by a process that exited
+                os.remove(address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.listen(5)
+        thread = threading.Thread(target=self._serve, args=(sock, ))
+        thread.daemon = True
+        thread.start()
+        return sock
+
+    def _serve(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except (socket.error, OSError):
+                # the socket was closed
+                return
+            try:
+                conn.settimeout(1)
+                try:
+                    # the request is irrelevant, but read it so that the
+                    # client doesn't get a connection reset
+                    conn.recv(65536)
+                except socket.timeout:
+                    pass
+                body = self.generate_text().encode('utf-8')
+                conn.sendall(
+                    b'HTTP/1.0 200 OK\r\n'
+                    b'Content-Type: text/plain; version=0.0.4\r\n'
+                    b'Content-Length: ' + str(len(body)).encode('ascii') +
+                    b'\r\n\r\n' + body)
+            except Exception:
+                logger.debug('Error serving metrics', exc_info=True)
+            finally:
+                conn.close()
+
+
+def _is_listening(path):
+    """Whether a process accepts connections on the unix socket at path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (socket.error, OSError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+REGISTRY = MetricsRegistry()
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+class _FileExporter(object):
+    def __init__(self, registry, path, interval):
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.write()
+
+    def write(self):
+        try:
+            self._registry.write_text_file(self._path)
+        except Exception:
+            logger.debug('Error writing metrics to %s', self._path,
+                         exc_info=True)
+
+    def stop(self):
+        """Stop the periodic writes, and write the final metrics"""
+        self._stop.set()
+        self.write()
+
+
+def export_from_env(registry=REGISTRY, serve=True):
+    """Start exporting the metrics, as configured by the environment.
+
+    CLOUDIFY_METRICS_FILE is a path the metrics will be written to every
+    CLOUDIFY_METRICS_INTERVAL seconds (default 15). The path can contain
+    {pid}, so that separate processes don't overwrite each other's file.
+    CLOUDIFY_METRICS_SOCKET is a path of a unix socket to serve them on.
+    Only one process can serve on a path, so it can contain {pid} too.
+
+    Failing to export the metrics is logged, and isn't an error.
+
+    :param serve: whether to serve on CLOUDIFY_METRICS_SOCKET; short-lived
+                  processes don't, they're gone before being scraped
+    :return: the file exporter, if any, so that it can be stopped and
+             write the final metrics when the process is done
+    """
+    socket_path = os.environ.get(METRICS_SOCKET_ENV)
+    if serve and socket_path:
+        socket_path = socket_path.format(pid=os.getpid())
+        try:
+            registry.serve_socket(socket_path)
+        except Exception as e:
+            logger.warning('Cannot serve metrics on %s: %s', socket_path, e)
+    file_path = os.environ.get(METRICS_FILE_ENV)
+    if not file_path:
+        return None
+    file_path = file_path.format(pid=os.getpid())
+    try:
+        exporter = _FileExporter(
+            registry, file_path,
+            float(os.environ.get(METRICS_INTERVAL_ENV, 15)))
+        exporter.start()
+    except Exception as e:
+        logger.warning('Cannot write metrics to %s: %s', file_path, e)
+        return None
+    return exporter
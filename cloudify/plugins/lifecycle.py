@@ -661,7 +661,7 @@ def _relationship_operations(relationship, operation):
 
 
 def is_host_node(node_instance):
-    return constants.COMPUTE_NODE_TYPE in node_instance.node.type_hierarchy
+    return node_instance.node.is_derived_from(constants.COMPUTE_NODE_TYPE)
 
 
 def _wait_for_host_to_start(host_node_instance):
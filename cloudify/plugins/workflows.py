@@ -520,8 +520,8 @@ def _filter_node_instances(ctx, node_ids, node_instance_ids, type_names):
     for node in ctx.nodes:
         if node_ids and node.id not in node_ids:
             continue
-        if type_names and not next((type_name for type_name in type_names if
-                                    type_name in node.type_hierarchy), None):
+        if type_names and not any(node.is_derived_from(type_name)
+                                  for type_name in type_names):
             continue
 
         for instance in node.instances:
@@ -0,0 +1,361 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""A bounded on-disk FIFO of JSON records.
+
+Records are appended to segment files, one JSON document per line. They
+are read in order, and once they're committed (ie. the reader is done
+with them), segments that were read to the end are deleted, and the read
+position in the first remaining segment is written to its offset file.
+
+A spool is used by one process at a time, which holds a lock on it.
+Spools are kept under a common root directory: use create to make a new
+one, and claim_abandoned to take over the ones that were left behind by
+processes that exited before committing everything, to read them from
+where those stopped. Locking needs fcntl, so without it (on Windows),
+spools are never claimed.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from cloudify import codec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+SEGMENT_SUFFIX = '.spool'
+OFFSET_SUFFIX = '.offset'
+LOCK_FILE = 'lock'
+
+
+def create(root, **kwargs):
+    """A new spool in a directory under root, locked by this process.
+
+    :param kwargs: passed to Spool
+    """
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    # the directory name starts with the time, so that abandoned spools
+    # are claimed oldest first; and it's only given its final name once
+    # it's locked, so that it's never claimed before that
+    name = '{0:015d}-{1}-'.format(int(time.time() * 1000), os.getpid())
+    temp_directory = tempfile.mkdtemp(prefix='.' + name, dir=root)
+    lock_file = _lock(temp_directory)
+    directory = os.path.join(root, os.path.basename(temp_directory)[1:])
+    os.rename(temp_directory, directory)
+    return Spool(directory, lock_file=lock_file, **kwargs)
+
+
+def claim_abandoned(root, exclude=None, **kwargs):
+    """The spools under root that no process holds, locked by this one.
+
+    :param exclude: a spool directory to skip, eg. this process' own
+    :param kwargs: passed to Spool
+    :return: the spools, oldest first
+    """
+    spools = []
+    if fcntl is None or not os.path.isdir(root):
+        return spools
+    for name in sorted(os.listdir(root)):
+        directory = os.path.join(root, name)
+        if name.startswith('.') or directory == exclude or \
+                not os.path.isdir(directory):
+            continue
+        lock_file = _lock(directory)
+        if lock_file is None:
+            continue
+        try:
+            spools.append(Spool(directory, lock_file=lock_file, **kwargs))
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Cannot read spool %s: %s', directory, e)
+            lock_file.close()
+    return spools
+
+
+def _lock(directory):
+    """Lock the spool in directory for this process.
+
+    :return: the open lock file, which holds the lock until it's closed;
+             None if another process holds it, or the spool was removed
+    """
+    path = os.path.join(directory, LOCK_FILE)
+    try:
+        lock_file = open(path, 'ab')
+    except (IOError, OSError):
+        return None
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # a spool is removed by the process holding it: if that happened
+        # just before it was locked here, there's no spool anymore
+        if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+            return lock_file
+    except (IOError, OSError):
+        pass
+    lock_file.close()
+    return None
+
+
+class Spool(object):
+    """Records appended by any thread, read and committed by one.
+
+    Records that were left in the directory are read first. New records
+    are always written to a new segment, so that they never follow a line
+    that a process didn't finish writing.
+
+    :param directory: where to keep the segments; created if needed
+    :param max_bytes: when the segments take this much, new records are
+                      dropped until some are committed
+    :param segment_bytes: a new segment is started when the current one
+                          is this big
+    :param lock_file: the open file holding the lock on the spool; it's
+                      closed when the spool is
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES, lock_file=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._lock_file = lock_file
+        self._size = 0
+        self._pending = 0
+        # segment numbers, oldest first; the last one is being written to
+        self._segments = []
+        self._writer = None
+        self._writer_size = 0
+        self._reader = None
+        self._reader_segment = None
+        # the read position, and positions after each of the records
+        # returned by the last read, for commit
+        self._position = None
+        self._read_positions = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '{0:012d}{1}'.format(
+            segment, SEGMENT_SUFFIX))
+
+    def _offset_path(self, segment):
+        return os.path.join(self.directory, '{0:012d}{1}'.format(
+            segment, OFFSET_SUFFIX))
+
+    def _load(self):
+        """Find the records left in the directory, and the read position"""
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                self._segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+        self._segments.sort()
+        if not self._segments:
+            return
+        offset = self._read_offset(self._segments[0])
+        self._position = (self._segments[0], offset)
+        for segment in self._segments:
+            self._size += os.path.getsize(self._path(segment))
+            self._pending += self._count_records(segment, offset)
+            offset = 0
+
+    def _read_offset(self, segment):
+        try:
+            with open(self._offset_path(segment)) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _write_offset(self, segment, offset):
+        """Replace the offset file atomically"""
+        path = self._offset_path(segment)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def _count_records(self, segment, offset):
+        """Number of the complete lines in segment, after offset"""
+        count = 0
+        with open(self._path(segment), 'rb') as f:
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                count += chunk.count(b'\n')
+        return count
+
+    def __len__(self):
+        """Number of the records that weren't committed yet"""
+        return self._pending
+
+    def append(self, record):
+        """Add a record at the end.
+
+        :return: whether the record was added; it isn't if the spool is
+                 full
+        """
+        line = codec.dumps(record).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._size + len(line) > self.max_bytes:
+                if not self.dropped:
+                    logger.warning('Spool %s is full, dropping records',
+                                   self.directory)
+                self.dropped += 1
+                return False
+            if self._writer is None or \
+                    self._writer_size >= self.segment_bytes:
+                self._start_segment()
+            self._writer.write(line)
+            self._writer.flush()
+            self._writer_size += len(line)
+            self._size += len(line)
+            self._pending += 1
+            if self._position is None:
+                self._position = (self._segments[0], 0)
+            return True
+
+    def _start_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+        segment = self._segments[-1] + 1 if self._segments else 0
+        self._writer = open(self._path(segment), 'ab')
+        self._writer_size = 0
+        self._segments.append(segment)
+
+    def read(self, count):
+        """Up to count of the oldest records that weren't committed"""
+        with self._lock:
+            self._read_positions = []
+            if self._position is None:
+                return []
+            segment, offset = self._position
+            records = []
+            while len(records) < count:
+                if self._reader_segment != segment:
+                    self._open_reader(segment)
+                self._reader.seek(offset)
+                line = self._reader.readline()
+                # a line without a newline was never finished: the process
+                # writing it exited, so nothing follows it in this segment
+                if line.endswith(b'\n'):
+                    offset += len(line)
+                    records.append(codec.loads(line))
+                    self._read_positions.append((segment, offset))
+                elif segment != self._segments[-1]:
+                    segment = self._segments[self._segments.index(segment)
+                                             + 1]
+                    offset = 0
+                else:
+                    break
+            return records
+
+    def _open_reader(self, segment):
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = open(self._path(segment), 'rb')
+        self._reader_segment = segment
+
+    def commit(self, count):
+        """The first count records returned by read are done with"""
+        if not count:
+            return
+        with self._lock:
+            self._position = self._read_positions[count - 1]
+            self._read_positions = []
+            self._pending -= count
+            if not self._pending:
+                # everything was read: start over with a new segment
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                self._position = None
+                while self._segments:
+                    self._delete_segment(self._segments.pop(0))
+                if self.dropped:
+                    logger.warning('Spool %s was emptied, after dropping '
+                                   '%d records', self.directory, self.dropped)
+                    self.dropped = 0
+                return
+            segment, offset = self._position
+            # the segments before the read position were read to the end
+            while self._segments[0] != segment:
+                self._delete_segment(self._segments.pop(0))
+            self._write_offset(segment, offset)
+
+    def _delete_segment(self, segment):
+        if self._reader_segment == segment:
+            self._reader.close()
+            self._reader = None
+            self._reader_segment = None
+        path = self._path(segment)
+        self._size -= os.path.getsize(path)
+        os.remove(path)
+        if os.path.exists(self._offset_path(segment)):
+            os.remove(self._offset_path(segment))
+
+    def close(self):
+        """Close the files, and remove the directory if all was committed.
+
+        Otherwise, the lock is released, and the records are left for
+        another process to claim.
+
+        :return: whether the directory was removed
+        """
+        with self._lock:
+            for f in (self._reader, self._writer):
+                if f is not None:
+                    f.close()
+            self._reader = self._writer = None
+            self._reader_segment = None
+            removed = not self._pending
+            if removed:
+                # what's left is segments with unfinished lines, if any
+                while self._segments:
+                    self._delete_segment(self._segments.pop(0))
+            else:
+                logger.warning('%d records were left in spool %s',
+                               self._pending, self.directory)
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            if removed:
+                # another process might lock the directory as it's being
+                # removed; it then finds it empty, and removes it itself
+                try:
+                    names = os.listdir(self.directory)
+                except OSError:
+                    names = []
+                for name in names:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+                try:
+                    os.rmdir(self.directory)
+                except OSError:
+                    pass
+            return removed
@@ -0,0 +1,645 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""An in-memory AMQP broker, standing in for RabbitMQ.
+
+MockBroker implements the parts of pika's BlockingConnection and
+BlockingChannel that cloudify.amqp_client uses: declaring, binding and
+deleting exchanges and queues, publishing, consuming, acks, qos, and
+publisher confirms (both the blocking ones, and the ones enabled on the
+underlying channel). Use it by patching pika.BlockingConnection:
+
+    broker = MockBroker(latency=0.001)
+    with broker.patched():
+        with AMQPConnection(handlers) as connection:
+            ...
+
+Everything a client sends arrives at the broker after `latency` seconds,
+and everything the broker sends arrives at the client after `latency`
+seconds too. So a synchronous method (declare, bind, a publish on
+a channel with blocking confirms) takes twice the latency, and so does
+a message getting from the publisher to a consumer.
+
+Not implemented: message TTLs and dead-lettering, mandatory publishes,
+transactions, and basic_get.
+"""
+
+import copy
+import heapq
+import itertools
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import pika
+import pika.exceptions
+from pika.adapters import select_connection
+
+from cloudify import amqp_client
+
+
+def _topic_matches(pattern, routing_key):
+    """Does the routing key match the topic exchange binding pattern"""
+    def _matches(pattern, words):
+        if not pattern:
+            return not words
+        if pattern[0] == '#':
+            return any(_matches(pattern[1:], words[i:])
+                       for i in range(len(words) + 1))
+        if not words:
+            return False
+        return pattern[0] in ('*', words[0]) and \
+            _matches(pattern[1:], words[1:])
+    return _matches(pattern.split('.'), routing_key.split('.'))
+
+
+class _Exchange(object):
+    def __init__(self, name, exchange_type):
+        self.name = name
+        self.exchange_type = exchange_type
+        # (queue name, binding key) pairs
+        self.bindings = []
+
+    def route(self, routing_key):
+        """Names of the queues that a message is routed to"""
+        if self.exchange_type == 'fanout':
+            matches = [queue for queue, _ in self.bindings]
+        elif self.exchange_type == 'topic':
+            matches = [queue for queue, key in self.bindings
+                       if _topic_matches(key, routing_key)]
+        else:
+            matches = [queue for queue, key in self.bindings
+                       if key == routing_key]
+        # a message is only put on every queue once
+        return sorted(set(matches), key=matches.index)
+
+
+class _Message(object):
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.redelivered = False
+
+
+class _Queue(object):
+    def __init__(self, name, exclusive_to=None, auto_delete=False):
+        self.name = name
+        self.exclusive_to = exclusive_to
+        self.auto_delete = auto_delete
+        self.messages = []
+        self.consumers = []
+
+
+class _Consumer(object):
+    def __init__(self, channel, tag, queue, callback, no_ack):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+
+
+class MockBroker(object):
+    """Exchanges and queues, shared by all the connections to the broker.
+
+    :param latency: the one-way delay between the clients and the broker,
+                    in seconds
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.connections = []
+        self._lock = threading.RLock()
+        self._exchanges = {'': _Exchange('', 'direct')}
+        self._queues = {}
+        self._queue_names = itertools.count(1)
+
+    def connect(self, params=None):
+        """A new BlockingConnection to the broker"""
+        connection = MockBlockingConnection(self, params)
+        with self._lock:
+            self.connections.append(connection)
+        return connection
+
+    @contextmanager
+    def patched(self):
+        """Make pika.BlockingConnection connect to this broker"""
+        original = pika.BlockingConnection
+        pika.BlockingConnection = self.connect
+        try:
+            yield self
+        finally:
+            pika.BlockingConnection = original
+
+    def disconnect(self):
+        """Drop all the connections, like a broker restart"""
+        with self._lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection._drop()
+
+    def queue_size(self, queue):
+        """Number of the messages that are waiting in the queue"""
+        with self._lock:
+            return len(self._queues[queue].messages)
+
+    def _sleep(self, round_trips=1):
+        if self.latency:
+            time.sleep(2 * self.latency * round_trips)
+
+    def declare_exchange(self, name, exchange_type):
+        with self._lock:
+            if name not in self._exchanges:
+                self._exchanges[name] = _Exchange(name, exchange_type)
+
+    def delete_exchange(self, name):
+        with self._lock:
+            self._exchanges.pop(name, None)
+
+    def declare_queue(self, name, exclusive_to=None, auto_delete=False):
+        with self._lock:
+            if not name:
+                name = 'amq.gen-{0}'.format(next(self._queue_names))
+            if name not in self._queues:
+                self._queues[name] = _Queue(name, exclusive_to, auto_delete)
+                # every queue is bound to the default exchange by its name
+                self._exchanges[''].bindings.append((name, name))
+            return name
+
+    def bind_queue(self, queue, exchange, routing_key):
+        with self._lock:
+            if queue not in self._queues:
+                raise pika.exceptions.ChannelClosed(
+                    404, 'NOT_FOUND - no queue {0}'.format(queue))
+            if exchange not in self._exchanges:
+                raise pika.exceptions.ChannelClosed(
+                    404, 'NOT_FOUND - no exchange {0}'.format(exchange))
+            binding = (queue, routing_key)
+            if binding not in self._exchanges[exchange].bindings:
+                self._exchanges[exchange].bindings.append(binding)
+
+    def delete_queue(self, name, if_empty=False):
+        with self._lock:
+            queue = self._queues.get(name)
+            if queue is None or (if_empty and queue.messages):
+                return
+            del self._queues[name]
+            for exchange in self._exchanges.values():
+                exchange.bindings = [binding for binding in exchange.bindings
+                                     if binding[0] != name]
+            for consumer in queue.consumers:
+                consumer.channel._consumers.pop(consumer.tag, None)
+
+    def publish(self, exchange, routing_key, body, properties, sent_at):
+        with self._lock:
+            if exchange not in self._exchanges:
+                raise pika.exceptions.ChannelClosed(
+                    404, 'NOT_FOUND - no exchange {0}'.format(exchange))
+            for name in self._exchanges[exchange].route(routing_key):
+                queue = self._queues[name]
+                # every queue gets its own copy, like from the wire
+                queue.messages.append(_Message(
+                    exchange, routing_key, body, copy.deepcopy(properties)))
+                self._dispatch(queue, sent_at)
+
+    def consume(self, consumer):
+        with self._lock:
+            queue = self._queues.get(consumer.queue)
+            if queue is None:
+                raise pika.exceptions.ChannelClosed(
+                    404, 'NOT_FOUND - no queue {0}'.format(consumer.queue))
+            queue.consumers.append(consumer)
+            self._dispatch(queue, time.time())
+
+    def cancel(self, consumer):
+        with self._lock:
+            queue = self._queues.get(consumer.queue)
+            if queue is None:
+                return
+            if consumer in queue.consumers:
+                queue.consumers.remove(consumer)
+            if queue.auto_delete and not queue.consumers:
+                self.delete_queue(queue.name)
+
+    def requeue(self, messages, sent_at):
+        """Put back messages that were delivered, but not acked"""
+        with self._lock:
+            for queue_name, message in reversed(messages):
+                queue = self._queues.get(queue_name)
+                if queue is None:
+                    continue
+                message.redelivered = True
+                queue.messages.insert(0, message)
+            for queue in list(self._queues.values()):
+                self._dispatch(queue, sent_at)
+
+    def acked(self, channel, sent_at):
+        """A channel acked messages: it might be able to get more"""
+        with self._lock:
+            for consumer in list(channel._consumers.values()):
+                queue = self._queues.get(consumer.queue)
+                if queue is not None:
+                    self._dispatch(queue, sent_at)
+
+    def close_connection(self, connection, sent_at):
+        with self._lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            for queue in list(self._queues.values()):
+                if queue.exclusive_to is connection:
+                    self.delete_queue(queue.name)
+
+    def _dispatch(self, queue, sent_at):
+        """Deliver the queue's messages to its consumers, round-robin.
+
+        The client's action that made the messages deliverable (a publish,
+        an ack, a consume) was sent at sent_at, so the messages get to the
+        consumers a round trip later.
+        """
+        arrives_at = sent_at + 2 * self.latency
+        while queue.messages:
+            consumer = self._next_consumer(queue)
+            if consumer is None:
+                return
+            message = queue.messages.pop(0)
+            consumer.channel._deliver(consumer, queue.name, message,
+                                      arrives_at)
+
+    def _next_consumer(self, queue):
+        for _ in range(len(queue.consumers)):
+            consumer = queue.consumers.pop(0)
+            queue.consumers.append(consumer)
+            if consumer.channel._can_deliver():
+                return consumer
+        return None
+
+
+class _Frame(object):
+    def __init__(self, method):
+        self.method = method
+
+
+class _ChannelImpl(object):
+    """The underlying channel: only its confirms are used"""
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self._channel._enable_confirms(callback)
+
+
+class MockBlockingChannel(object):
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.is_open = True
+        self._impl = _ChannelImpl(self)
+        self._broker = connection._broker
+        self._prefetch_count = 0
+        self._confirms = False
+        self._confirm_callback = None
+        self._publish_tag = 0
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._consumers = {}
+        # delivery tag: (queue name, message)
+        self._unacked = {}
+
+    def _check_open(self):
+        if not self.is_open:
+            raise pika.exceptions.ChannelClosed(
+                406, 'the channel is closed')
+        self.connection._check_open()
+
+    def _rpc(self):
+        """Wait for a synchronous method to be done by the broker"""
+        self._check_open()
+        self._broker._sleep()
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self._rpc()
+        self._prefetch_count = prefetch_count
+
+    def confirm_delivery(self):
+        self._rpc()
+        self._enable_confirms(None)
+
+    def _enable_confirms(self, callback):
+        self._confirms = True
+        self._confirm_callback = callback
+
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None):
+        self._rpc()
+        self._broker.declare_exchange(exchange, exchange_type)
+
+    def exchange_delete(self, exchange=None, if_unused=False):
+        self._rpc()
+        self._broker.delete_exchange(exchange)
+
+    def queue_declare(self, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        self._rpc()
+        name = self._broker.declare_queue(
+            queue, exclusive_to=self.connection if exclusive else None,
+            auto_delete=auto_delete)
+        return _Frame(pika.spec.Queue.DeclareOk(queue=name))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self._rpc()
+        if routing_key is None:
+            routing_key = queue
+        self._broker.bind_queue(queue, exchange, routing_key)
+
+    def queue_delete(self, queue='', if_unused=False, if_empty=False):
+        self._rpc()
+        self._broker.delete_queue(queue, if_empty=if_empty)
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        self._rpc()
+        if consumer_tag is None:
+            consumer_tag = 'ctag{0}.{1}'.format(
+                self.channel_number, next(self._consumer_tags))
+        consumer = _Consumer(self, consumer_tag, queue, consumer_callback,
+                             no_ack)
+        self._consumers[consumer_tag] = consumer
+        self._broker.consume(consumer)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag='', nowait=False):
+        self._rpc()
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            self._broker.cancel(consumer)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._check_open()
+        with self._broker._lock:
+            if multiple:
+                tags = [tag for tag in self._unacked if tag <= delivery_tag]
+            else:
+                tags = [delivery_tag]
+            for tag in tags:
+                self._unacked.pop(tag, None)
+        self._broker.acked(self, time.time())
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        self._check_open()
+        with self._broker._lock:
+            if multiple:
+                tags = sorted(tag for tag in self._unacked
+                              if tag <= delivery_tag)
+            else:
+                tags = [delivery_tag]
+            messages = [self._unacked.pop(tag) for tag in tags
+                        if tag in self._unacked]
+        if requeue:
+            self._broker.requeue(messages, time.time())
+        else:
+            self._broker.acked(self, time.time())
+
+    def publish(self, exchange, routing_key, body, properties=None,
+                mandatory=False, immediate=False):
+        self._check_open()
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        sent_at = time.time()
+        self._broker.publish(exchange, routing_key, body,
+                             properties or pika.BasicProperties(), sent_at)
+        if not self._confirms:
+            return
+        if self._confirm_callback is None:
+            # blocking confirms: wait for the broker's ack
+            self._broker._sleep()
+            return
+        self._publish_tag += 1
+        frame = _Frame(pika.spec.Basic.Ack(delivery_tag=self._publish_tag))
+        self.connection._add_event(sent_at + 2 * self._broker.latency,
+                                   self._confirm_callback, frame)
+
+    basic_publish = publish
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._release(time.time())
+
+    def _release(self, sent_at):
+        """Cancel the consumers, and requeue the unacked messages"""
+        with self._broker._lock:
+            for consumer in list(self._consumers.values()):
+                self._broker.cancel(consumer)
+            self._consumers.clear()
+            unacked = [self._unacked[tag] for tag in sorted(self._unacked)]
+            self._unacked.clear()
+        self._broker.requeue(unacked, sent_at)
+
+    def _can_deliver(self):
+        if not (self.is_open and self.connection.is_open) or \
+                self.connection._dropped:
+            return False
+        return not self._prefetch_count or \
+            len(self._unacked) < self._prefetch_count
+
+    def _deliver(self, consumer, queue_name, message, arrives_at):
+        """Called by the broker, with its lock held"""
+        delivery_tag = next(self._delivery_tags)
+        if not consumer.no_ack:
+            self._unacked[delivery_tag] = (queue_name, message)
+        method = pika.spec.Basic.Deliver(
+            consumer_tag=consumer.tag,
+            delivery_tag=delivery_tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key)
+        self.connection._add_event(
+            arrives_at, self._on_delivery, consumer, method,
+            copy.deepcopy(message.properties), message.body)
+
+    def _on_delivery(self, consumer, method, properties, body):
+        if not self.is_open:
+            return
+        if consumer.tag in self._consumers:
+            consumer.callback(self, method, properties, body)
+        elif not consumer.no_ack:
+            # like pika, messages arriving for a cancelled consumer are
+            # nacked, so that the broker delivers them again
+            self.basic_nack(method.delivery_tag)
+
+
+class _IOLoop(object):
+    """Just enough of an ioloop to poll for additional file descriptors"""
+
+    def __init__(self):
+        self.handlers = {}
+
+    def add_handler(self, fileno, handler, events):
+        self.handlers[fileno] = handler
+
+    def remove_handler(self, fileno):
+        self.handlers.pop(fileno, None)
+
+
+class _ConnectionImpl(object):
+    def __init__(self):
+        self.ioloop = _IOLoop()
+
+
+class MockBlockingConnection(object):
+    """A connection to a MockBroker.
+
+    Like with pika's BlockingConnection, callbacks (deliveries, confirms,
+    timeouts) are only dispatched by process_data_events, in the thread
+    that calls it.
+    """
+
+    def __init__(self, broker, params=None):
+        self.params = params
+        self.is_open = True
+        self._broker = broker
+        self._broker._sleep(round_trips=3)
+        self._impl = _ConnectionImpl()
+        self._dropped = False
+        self._channel_numbers = itertools.count(1)
+        self._channels = []
+        self._events = []
+        self._event_ids = itertools.count()
+        self._events_lock = threading.Lock()
+        # the broker writes here when it adds an event from another thread,
+        # so that process_data_events doesn't sleep through it
+        self._notify_read, self._notify_write = amqp_client._socketpair()
+
+    def _check_open(self):
+        if self._dropped:
+            # the client noticed that the connection is gone: like with
+            # pika, its channels are closed from now on
+            self.is_open = False
+            for channel in self._channels:
+                channel.is_open = False
+            self._notify_read.close()
+            self._notify_write.close()
+            raise pika.exceptions.ConnectionClosed(
+                320, 'CONNECTION_FORCED - broker forced connection closure')
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed(200, 'Normal shutdown')
+
+    def channel(self, channel_number=None):
+        self._check_open()
+        self._broker._sleep()
+        if channel_number is None:
+            channel_number = next(self._channel_numbers)
+        channel = MockBlockingChannel(self, channel_number)
+        self._channels.append(channel)
+        return channel
+
+    def add_timeout(self, deadline, callback_method):
+        return self._add_event(time.time() + deadline, callback_method)
+
+    def remove_timeout(self, timeout_id):
+        with self._events_lock:
+            self._events = [event for event in self._events
+                            if event[1] != timeout_id]
+            heapq.heapify(self._events)
+
+    def _add_event(self, due, callback, *args):
+        with self._events_lock:
+            event_id = next(self._event_ids)
+            heapq.heappush(self._events, (due, event_id, callback, args))
+        try:
+            self._notify_write.send(b'x')
+        except socket.error:
+            pass
+        return event_id
+
+    def _pop_due(self, now):
+        with self._events_lock:
+            due = []
+            while self._events and self._events[0][0] <= now:
+                due.append(heapq.heappop(self._events))
+            next_due = self._events[0][0] if self._events else None
+        return due, next_due
+
+    def process_data_events(self, time_limit=0):
+        """Dispatch the callbacks that are due.
+
+        Waits up to time_limit for there to be any, or indefinitely if
+        time_limit is None.
+        """
+        deadline = None if time_limit is None else time.time() + time_limit
+        while True:
+            self._check_open()
+            now = time.time()
+            due, next_due = self._pop_due(now)
+            for _, _, callback, args in due:
+                callback(*args)
+            if due or (deadline is not None and now >= deadline):
+                return
+            timeout = deadline
+            if next_due is not None and (timeout is None or
+                                         next_due < timeout):
+                timeout = next_due
+            self._poll(None if timeout is None else max(0, timeout - now))
+
+    def _poll(self, timeout):
+        handlers = dict(self._impl.ioloop.handlers)
+        readable, _, _ = select.select(
+            [self._notify_read] + list(handlers), [], [], timeout)
+        for fileno in readable:
+            if fileno is self._notify_read:
+                try:
+                    while self._notify_read.recv(512):
+                        pass
+                except socket.error:
+                    pass
+            else:
+                handlers[fileno](fileno, select_connection.READ)
+
+    def sleep(self, duration):
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            self.process_data_events(deadline - time.time())
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if not self.is_open:
+            return
+        self.is_open = False
+        for channel in self._channels:
+            channel.is_open = False
+        self._disconnect()
+        self._notify_read.close()
+        self._notify_write.close()
+
+    def _drop(self):
+        """The broker closed the connection"""
+        self._dropped = True
+        self._disconnect()
+        # wake up process_data_events, so that it raises ConnectionClosed
+        self._add_event(time.time(), lambda: None)
+
+    def _disconnect(self):
+        sent_at = time.time()
+        for channel in self._channels:
+            channel._release(sent_at)
+        self._broker.close_connection(self, sent_at)
+        with self._events_lock:
+            self._events = []
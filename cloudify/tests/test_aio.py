@@ -0,0 +1,108 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+import unittest
+
+import mock
+
+from cloudify import exceptions
+from cloudify.state import current_workflow_ctx, workflow_ctx
+from cloudify.workflows import aio, api, tasks
+from cloudify.tests.test_task_results import _TaskResultsTestBase
+
+asyncio = aio.asyncio
+
+
+@unittest.skipIf(asyncio is None, 'asyncio not available')
+class TestAwaitResults(_TaskResultsTestBase):
+    def setUp(self):
+        super(TestAwaitResults, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def _run(self, awaitable):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(awaitable, timeout=5))
+
+    def test_gather(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow = self._execute(lambda: release.wait(5) and 'slow')
+        fast = self._execute(lambda: 'fast')
+        self.assertEqual('fast', self._run(fast))
+        self.assertFalse(slow.done())
+        release.set()
+        self.assertEqual(['slow', 'fast'],
+                         self._run(asyncio.gather(slow, fast)))
+
+    def test_retried(self):
+        calls = []
+
+        def _retried():
+            calls.append(True)
+            if len(calls) < 3:
+                raise exceptions.OperationRetry(retry_after=0)
+            return len(calls)
+
+        self.assertEqual(3, self._run(self._execute(_retried)))
+
+    def test_failed(self):
+        def _failing():
+            raise exceptions.NonRecoverableError('x')
+
+        result = self._execute(_failing)
+        self.assertRaises(exceptions.NonRecoverableError, self._run, result)
+        self.assertTrue(result.done())
+
+    def test_loop_closed(self):
+        """Tasks can terminate after the loop was closed"""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        result = self._execute(lambda: release.wait(5) and 'slow')
+        future = aio.result_future(result, self.loop)
+        self.loop.close()
+        with mock.patch.object(tasks.logger, 'exception') as logged:
+            release.set()
+            self.assertEqual('slow', result.get())
+        self.assertFalse(logged.called)
+        self.assertFalse(future.done())
+
+    def test_run_blocking(self):
+        ctx = mock.Mock()
+        with current_workflow_ctx.push(ctx, {'a': 1}):
+            future = aio.run_blocking(
+                lambda: workflow_ctx._get_current_object())
+            self.assertIs(ctx, self._run(future))
+
+
+@unittest.skipIf(asyncio is None, 'asyncio not available')
+class TestRun(unittest.TestCase):
+    def test_result(self):
+        self.assertEqual(42, aio.run(asyncio.sleep(0, result=42)))
+
+    def test_cancelled(self):
+        with mock.patch('cloudify.workflows.api.has_cancel_request',
+                        return_value=True):
+            self.assertRaises(api.ExecutionCancelled,
+                              aio.run, asyncio.sleep(10))
+
+    def test_iscoroutine(self):
+        coro = asyncio.sleep(0)
+        self.addCleanup(coro.close)
+        self.assertTrue(aio.iscoroutine(coro))
+        self.assertFalse(aio.iscoroutine(None))
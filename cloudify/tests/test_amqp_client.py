@@ -0,0 +1,858 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import mock
+import pika
+import testtools
+from pika.adapters import select_connection
+
+from cloudify import amqp_client, amqp_client_utils, logs
+from cloudify._compat import queue
+from cloudify.exceptions import ClosedAMQPClientException
+from cloudify.tests.mocks.mock_broker import MockBroker
+
+
+class _RecordingConsumer(amqp_client.TaskConsumer):
+    def __init__(self, *args, **kwargs):
+        super(_RecordingConsumer, self).__init__(*args, **kwargs)
+        self.handled = []
+
+    def handle_task(self, full_task):
+        self.handled.append(full_task)
+        return {'ok': True, 'task': full_task['id']}
+
+    def _run_task(self, task_args):
+        # run synchronously, to make the test deterministic
+        self._process_message(*task_args)
+
+
+class TestBatchMessages(testtools.TestCase):
+    def _publish_batch(self, messages):
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        handler._connection = mock.Mock()
+        handler.publish_batch(messages, routing_key='operation')
+        return handler._connection.publish.mock_calls[0][1][0]
+
+    def test_publish_batch(self):
+        message = self._publish_batch([({'id': 't1'}, 't1'),
+                                       ({'id': 't2'}, 't2')])
+        self.assertEqual('agent1', message['exchange'])
+        self.assertEqual('operation', message['routing_key'])
+        body = json.loads(message['body'])
+        self.assertEqual([
+            {'task': {'id': 't1'}, 'correlation_id': 't1',
+             'reply_to': 'agent1_response_t1'},
+            {'task': {'id': 't2'}, 'correlation_id': 't2',
+             'reply_to': 'agent1_response_t2'},
+        ], body[amqp_client.BATCH_KEY])
+
+    def test_publish_batch_size(self):
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        handler._connection = mock.Mock()
+        with mock.patch.object(amqp_client, 'MAX_BATCH_SIZE', 2):
+            handler.publish_batch(
+                [({'id': i}, str(i)) for i in range(5)],
+                routing_key='operation')
+        batches = [json.loads(c[1][0]['body'])[amqp_client.BATCH_KEY]
+                   for c in handler._connection.publish.mock_calls]
+        self.assertEqual(
+            [['0', '1'], ['2', '3'], ['4']],
+            [[item['correlation_id'] for item in batch]
+             for batch in batches])
+
+    def _consume(self, consumer, body, delivery_tag=1):
+        consumer._connection = mock.Mock()
+        channel = mock.Mock()
+        method = mock.Mock(delivery_tag=delivery_tag)
+        consumer.process(channel, method, mock.Mock(), body)
+        return consumer._connection, channel
+
+    def test_consume_batch(self):
+        message = self._publish_batch([({'id': 't1'}, 't1'),
+                                       ({'id': 't2'}, 't2')])
+        consumer = _RecordingConsumer('agent1')
+        connection, channel = self._consume(consumer, message['body'])
+
+        self.assertEqual([{'id': 't1'}, {'id': 't2'}], consumer.handled)
+        # every task is responded to separately...
+        responses = [c[1][0] for c in connection.publish.mock_calls]
+        self.assertEqual(
+            ['agent1_response_t1', 'agent1_response_t2'],
+            [r['routing_key'] for r in responses])
+        self.assertEqual(
+            ['t1', 't2'],
+            [r['properties'].correlation_id for r in responses])
+        self.assertEqual(
+            ['t1', 't2'],
+            [json.loads(r['body'])['task'] for r in responses])
+        # ...but the batch message is only acked once
+        connection.ack.assert_called_once_with(channel, 1)
+
+    def test_consume_batch_late_ack(self):
+        message = self._publish_batch([({'id': 't1'}, 't1'),
+                                       ({'id': 't2'}, 't2')])
+        consumer = _RecordingConsumer('agent1')
+        consumer.late_ack = True
+        connection, channel = self._consume(consumer, message['body'])
+        connection.ack.assert_called_once_with(channel, 1)
+
+    def test_consume_empty_batch(self):
+        consumer = _RecordingConsumer('agent1')
+        connection, channel = self._consume(
+            consumer, json.dumps({amqp_client.BATCH_KEY: []}))
+        channel.basic_ack.assert_called_once_with(1)
+        self.assertEqual([], consumer.handled)
+
+
+def _confirm(method, delivery_tag, multiple=False):
+    return mock.Mock(method=method(delivery_tag=delivery_tag,
+                                   multiple=multiple))
+
+
+class TestPipelinedPublish(testtools.TestCase):
+    def setUp(self):
+        super(TestPipelinedPublish, self).setUp()
+        self.connection = amqp_client.AMQPConnection(
+            [], amqp_params=mock.Mock(), publish_window=2)
+        self.connection._pika_connection = mock.Mock()
+        self.connection._pika_connection.channel.side_effect = mock.Mock
+        self._open()
+
+    def _open(self):
+        self.publish_channel, = self.connection._publish_channels
+        self.publish_channel.open(self.connection._pika_connection)
+        self.channel = self.publish_channel._channel
+
+    def _publish(self, body):
+        return self.connection.publish(
+            {'exchange': 'ex', 'body': body}, wait=False)
+
+    def _sent(self):
+        self.connection._send_pending()
+        return [c[2]['body'] for c in self.channel.publish.mock_calls]
+
+    def _confirm(self, method, delivery_tag, multiple=False):
+        self.publish_channel._on_confirm(
+            _confirm(method, delivery_tag, multiple=multiple))
+
+    def test_confirms_enabled(self):
+        self.channel._impl.confirm_delivery.assert_called_once_with(
+            self.publish_channel._on_confirm, nowait=True)
+
+    def test_pipelined(self):
+        """Messages are sent without waiting for the previous confirms"""
+        first, second = self._publish('m1'), self._publish('m2')
+        self.assertEqual(['m1', 'm2'], self._sent())
+        self.assertFalse(first.done())
+        self._confirm(pika.spec.Basic.Ack, 2)
+        self.assertFalse(first.done())
+        self.assertTrue(second.done())
+        self._confirm(pika.spec.Basic.Ack, 1)
+        first.wait(timeout=1)
+        self.assertEqual(2, first.message['properties'].delivery_mode)
+
+    def test_multiple(self):
+        confirmations = [self._publish('m{0}'.format(i)) for i in range(2)]
+        self._sent()
+        self._confirm(pika.spec.Basic.Ack, 2, multiple=True)
+        self.assertTrue(all(c.done() for c in confirmations))
+        self.assertFalse(self.publish_channel.has_unconfirmed())
+
+    def test_nack(self):
+        confirmation = self._publish('m1')
+        self._sent()
+        self._confirm(pika.spec.Basic.Nack, 1)
+        self.assertRaises(pika.exceptions.NackError,
+                          confirmation.wait, timeout=1)
+
+    def test_not_confirmed(self):
+        confirmation = self._publish('m1')
+        self.assertRaises(queue.Empty, confirmation.wait, timeout=0.01)
+
+    def test_window(self):
+        """Publishing blocks while the window is full of unconfirmed"""
+        self._publish('m1')
+        self._publish('m2')
+        self._sent()
+        published = threading.Event()
+        thread = threading.Thread(
+            target=lambda: self._publish('m3') and published.set())
+        thread.daemon = True
+        thread.start()
+        self.assertFalse(published.wait(0.1))
+        self._confirm(pika.spec.Basic.Ack, 1)
+        self.assertTrue(published.wait(5))
+
+    def test_reconnect(self):
+        """Messages not confirmed before a reconnect are sent again"""
+        confirmation = self._publish('m1')
+        self._sent()
+        self._publish('m2')
+        self._open()
+        self.assertEqual(['m1', 'm2'], self._sent())
+        self._confirm(pika.spec.Basic.Ack, 1)
+        self.assertTrue(confirmation.done())
+
+    def test_closed(self):
+        confirmation = self._publish('m1')
+        self._sent()
+        unsent = self._publish('m2')
+        self.connection.CLOSE_CONFIRM_TIMEOUT = 0
+        self.connection._wait_for_confirms()
+        self.assertRaises(ClosedAMQPClientException,
+                          confirmation.wait, timeout=1)
+        self.assertRaises(ClosedAMQPClientException, unsent.wait, timeout=1)
+
+
+class TestPublishChannels(testtools.TestCase):
+    def setUp(self):
+        super(TestPublishChannels, self).setUp()
+        self.connection = amqp_client.AMQPConnection(
+            [], amqp_params=mock.Mock(), publish_window=1, publish_channels=2)
+        pika_connection = mock.Mock()
+        pika_connection.channel.side_effect = mock.Mock
+        for publish_channel in self.connection._publish_channels:
+            publish_channel.open(pika_connection)
+        self.sent = []
+        for index, publish_channel in enumerate(
+                self.connection._publish_channels):
+            publish_channel._channel.publish.side_effect = \
+                lambda index=index, **kw: self.sent.append(
+                    (index, kw['body']))
+
+    def _publish(self, body, key):
+        return self.connection.publish(
+            {'exchange': 'ex', 'body': body}, wait=False, channel_key=key)
+
+    def test_keys(self):
+        """Every key is assigned a channel, round-robin"""
+        first, second, third = mock.Mock(), mock.Mock(), mock.Mock()
+        channels = [self.connection._get_publish_channel(key)
+                    for key in [first, second, third, first]]
+        self.assertEqual(self.connection._publish_channels,
+                         channels[:2])
+        self.assertIs(channels[0], channels[2])
+        self.assertIs(channels[0], channels[3])
+
+    def test_thread_key(self):
+        """By default, every thread publishes on its own channel"""
+        self.connection.publish({'body': 'main'}, wait=False)
+        thread = threading.Thread(target=self.connection.publish,
+                                  args=({'body': 'thread'}, False))
+        thread.start()
+        thread.join(5)
+        self.connection._send_pending()
+        self.assertEqual([(0, 'main'), (1, 'thread')], self.sent)
+
+    def test_fair(self):
+        """Channels take turns sending their pending messages"""
+        busy, quiet = mock.Mock(), mock.Mock()
+        for i in range(3):
+            self.connection._get_publish_channel(busy).pending.append(
+                amqp_client.PublishConfirmation({'body': 'b{0}'.format(i)}))
+        self.connection._get_publish_channel(quiet).pending.append(
+            amqp_client.PublishConfirmation({'body': 'q0'}))
+        self.connection._send_pending()
+        self.assertEqual([(0, 'b0'), (1, 'q0'), (0, 'b1'), (0, 'b2')],
+                         self.sent)
+
+    def test_slow_confirm(self):
+        """A channel waiting for a confirm doesn't hold up the others"""
+        slow, fast = mock.Mock(), mock.Mock()
+        self._publish('s1', slow)
+        self.connection._send_pending()
+        published = threading.Event()
+
+        def _publish_fast():
+            for i in range(3):
+                self._publish('f{0}'.format(i), fast)
+                self.connection._send_pending()
+                self.connection._get_publish_channel(fast)._on_confirm(
+                    _confirm(pika.spec.Basic.Ack, i + 1))
+            published.set()
+
+        thread = threading.Thread(target=_publish_fast)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(published.wait(5))
+        self.assertEqual(['s1', 'f0', 'f1', 'f2'],
+                         [body for _, body in self.sent])
+
+
+class TestWakeup(testtools.TestCase):
+    def setUp(self):
+        super(TestWakeup, self).setUp()
+        self.ioloop = select_connection.IOLoop()
+        self.ioloop.activate_poller()
+        self.addCleanup(self.ioloop.deactivate_poller)
+        self.pika_connection = mock.Mock()
+        self.pika_connection._impl.ioloop = self.ioloop
+        self.wakeup = amqp_client._Wakeup()
+        self.addCleanup(self.wakeup.close)
+        self.wakeup.register(self.pika_connection)
+
+    def test_wake_from_thread(self):
+        """Polling returns as soon as another thread wakes it up"""
+        timer = threading.Timer(0.05, self.wakeup.wake)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.time()
+        self.ioloop.poll()
+        self.assertLess(time.time() - start, 2)
+        # process_data_events returns once the timer event is dispatched
+        self.assertEqual(1, self.pika_connection.add_timeout.call_count)
+
+    def test_schedule_wakes(self):
+        connection = amqp_client.AMQPConnection([], amqp_params=mock.Mock())
+        connection._wakeup = mock.Mock()
+        connection.channel_method('basic_ack', wait=False, delivery_tag=1)
+        connection._wakeup.wake.assert_called_once_with()
+        connection.close()
+        self.assertEqual(2, connection._wakeup.wake.call_count)
+
+
+class _BlockingConsumer(amqp_client.TaskConsumer):
+    routing_key = 'operation'
+
+    def __init__(self, *args, **kwargs):
+        super(_BlockingConsumer, self).__init__(*args, **kwargs)
+        self.release = threading.Event()
+        self.running = set()
+        self.threads = set()
+        self.handled = queue.Queue()
+        self._lock = threading.Lock()
+
+    def handle_task(self, full_task):
+        with self._lock:
+            self.running.add(full_task['id'])
+            self.threads.add(threading.current_thread())
+        self.release.wait(5)
+        with self._lock:
+            self.running.discard(full_task['id'])
+        self.handled.put(full_task['id'])
+
+
+class TestWorkerPool(testtools.TestCase):
+    def _process(self, consumer, task_ids):
+        for i in task_ids:
+            consumer.process(mock.Mock(), mock.Mock(delivery_tag=i),
+                             mock.Mock(reply_to=None),
+                             json.dumps({'id': i}))
+
+    def test_bounded(self):
+        """Tasks are run by threadpool_size reused worker threads"""
+        consumer = _BlockingConsumer('agent1', threadpool_size=2)
+        self.addCleanup(consumer.release.set)
+        consumer._connection = mock.Mock()
+        self._process(consumer, range(2))
+        deadline = time.time() + 5
+        while len(consumer.running) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, len(consumer.running))
+        self._process(consumer, range(2, 4))
+        # the rest wait for a worker, not acked yet
+        self.assertEqual(2, consumer._tasks.qsize())
+        self.assertEqual(2, consumer._connection.ack.call_count)
+        consumer.release.set()
+        self.assertEqual(
+            set(range(4)),
+            set(consumer.handled.get(timeout=5) for _ in range(4)))
+        self.assertEqual(2, len(consumer.threads))
+        self.assertEqual(4, consumer._connection.ack.call_count)
+        # there was never more than threadpool_size tasks waiting
+        self.assertFalse(consumer._connection.channel_method.called)
+
+    def test_batch_larger_than_pool(self):
+        """Consuming pauses while more tasks wait than there are workers"""
+        broker = MockBroker()
+        patcher = broker.patched()
+        patcher.__enter__()
+        self.addCleanup(patcher.__exit__, None, None, None)
+        params = amqp_client.AMQPParams(amqp_host='localhost')
+        consumer = _BlockingConsumer('agent1', threadpool_size=2)
+        self.addCleanup(consumer.release.set)
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        for handlers in [[consumer], [handler]]:
+            connection = amqp_client.AMQPConnection(handlers,
+                                                    amqp_params=params)
+            connection.consume_in_thread()
+            self.addCleanup(connection.close)
+        handler.publish_batch(
+            [({'id': i}, str(i)) for i in range(10)],
+            routing_key='operation')
+        for i in range(10, 13):
+            handler.publish({'id': i}, correlation_id=str(i),
+                            routing_key='operation')
+        deadline = time.time() + 5
+        while (broker.queue_size('agent1_operation') < 3 or
+               len(consumer.running) < 2) and time.time() < deadline:
+            time.sleep(0.01)
+        # the batch's tasks wait for the workers, and the other messages
+        # wait in the broker
+        self.assertTrue(consumer._paused)
+        self.assertEqual(3, broker.queue_size('agent1_operation'))
+        self.assertEqual(8, consumer._queued)
+        consumer.release.set()
+        self.assertEqual(
+            set(range(13)),
+            set(consumer.handled.get(timeout=5) for _ in range(13)))
+        self.assertFalse(consumer._paused)
+
+    def test_prefetch(self):
+        consumer = amqp_client.TaskConsumer('agent1', threadpool_size=3)
+        channel = mock.Mock()
+        consumer.register(mock.Mock(), channel)
+        channel.basic_qos.assert_called_once_with(prefetch_count=3)
+        # workers are only started for the first task
+        self.assertEqual([], consumer._workers)
+
+
+class TestEventsBatches(testtools.TestCase):
+    def _publish(self, requests, batch_size):
+        publisher = amqp_client_utils._GlobalEventsPublisher()
+        client = mock.Mock()
+        publisher._make_client = lambda: client
+        with mock.patch.dict(os.environ, {
+            amqp_client_utils.EVENTS_BATCH_SIZE_ENV: str(batch_size),
+            amqp_client_utils.EVENTS_FLUSH_INTERVAL_ENV: '5'
+        }):
+            # the flush interval is long enough for all the requests to
+            # be queued, so that the batches are deterministic
+            for request in requests:
+                publisher.publish_message(*request)
+            publisher.close()
+        return client
+
+    def test_batch_size(self):
+        client = self._publish(
+            [({'id': i}, 'event') for i in range(5)], batch_size=2)
+        self.assertEqual([
+            mock.call([{'id': 0}, {'id': 1}], 'event'),
+            mock.call([{'id': 2}, {'id': 3}], 'event'),
+            mock.call([{'id': 4}], 'event'),
+        ], client.publish_batch.mock_calls)
+
+    def test_by_type(self):
+        """Every type is batched separately, keeping the order"""
+        client = self._publish([
+            ({'id': 1}, 'event'),
+            ({'id': 2}, 'log'),
+            ({'id': 3}, 'event'),
+        ], batch_size=10)
+        self.assertEqual([
+            mock.call([{'id': 1}, {'id': 3}], 'event'),
+            mock.call([{'id': 2}], 'log'),
+        ], client.publish_batch.mock_calls)
+
+    def test_no_batches(self):
+        client = self._publish(
+            [({'id': i}, 'event') for i in range(2)], batch_size=1)
+        self.assertEqual([
+            mock.call({'id': 0}, 'event'),
+            mock.call({'id': 1}, 'event'),
+        ], client.publish_message.mock_calls)
+        self.assertFalse(client.publish_batch.called)
+
+    def test_invalid_batch_size(self):
+        """Invalid batch sizes don't stop logs and events from being sent"""
+        for batch_size in [0, -1, 'x']:
+            client = self._publish([({'id': 0}, 'event')],
+                                   batch_size=batch_size)
+            self.assertEqual([mock.call({'id': 0}, 'event')],
+                             client.publish_message.mock_calls)
+
+    def test_unpack(self):
+        handler = amqp_client.SendHandler('cloudify-logs')
+        handler._connection = mock.Mock()
+        messages = [{'level': 'info', 'message': {'text': str(i)}}
+                    for i in range(3)]
+        handler.publish_batch(messages)
+        handler.publish(messages[0])
+        batch, single = [c[1][0]['body']
+                         for c in handler._connection.publish.mock_calls]
+        self.assertEqual(messages, amqp_client.unpack_messages(batch))
+        self.assertEqual(messages[:1], amqp_client.unpack_messages(single))
+
+
+class TestGlobalEventsPublisher(testtools.TestCase):
+    def setUp(self):
+        super(TestGlobalEventsPublisher, self).setUp()
+        self.publisher = amqp_client_utils._GlobalEventsPublisher()
+        self.clients = []
+        self.publisher._make_client = self._make_client
+        self.addCleanup(self.publisher.close)
+        patcher = mock.patch.dict(os.environ, {
+            amqp_client_utils.EVENTS_IDLE_TIMEOUT_ENV: '0.1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_client(self):
+        client = mock.Mock()
+        self.clients.append(client)
+        return client
+
+    def _wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_lazy(self):
+        """Publishing connects once, in the background"""
+        self.assertEqual([], self.clients)
+        for i in range(3):
+            self.publisher.publish_message({'id': i}, 'event')
+        self._wait_for(
+            lambda: self.clients and
+            self.clients[0].publish_message.call_count == 3)
+        self.assertEqual(1, len(self.clients))
+
+    def test_idle(self):
+        """An idle publisher disconnects, and connects again when needed"""
+        self.publisher.publish_message({'id': 1}, 'event')
+        self._wait_for(lambda: self.publisher._thread is None)
+        self.clients[0].close.assert_called_once_with()
+        self.publisher.publish_message({'id': 2}, 'event')
+        self._wait_for(
+            lambda: len(self.clients) == 2 and
+            self.clients[1].publish_message.called)
+
+    def test_registered(self):
+        """Registered callers keep the publisher connected"""
+        self.publisher.register_caller()
+        self.assertTrue(self.publisher.client_started.is_set())
+        self.publisher.publish_message({'id': 1}, 'event')
+        time.sleep(0.3)
+        self.assertFalse(self.clients[0].close.called)
+        # what's queued is published by the time the last caller is done
+        self.publisher.unregister_caller()
+        self.clients[0].publish_message.assert_called_once_with(
+            {'id': 1}, 'event')
+
+    def test_close(self):
+        with mock.patch.dict(os.environ, {
+                amqp_client_utils.EVENTS_IDLE_TIMEOUT_ENV: '60'}):
+            self.publisher.publish_message({'id': 1}, 'event')
+        self.publisher.close()
+        self.clients[0].publish_message.assert_called_once_with(
+            {'id': 1}, 'event')
+        self.clients[0].close.assert_called_once_with()
+        self.assertIsNone(self.publisher._thread)
+
+    def test_with_amqp_client(self):
+        """Logging doesn't register with the publisher"""
+        with mock.patch.object(amqp_client_utils,
+                               'global_management_events_publisher',
+                               self.publisher):
+            with mock.patch.object(self.publisher, 'register_caller') \
+                    as register:
+                logs._publish_message({'id': 1}, 'log', mock.Mock())
+        self.assertFalse(register.called)
+        self._wait_for(lambda: self.clients and
+                       self.clients[0].publish_message.called)
+
+
+class TestEventsSpool(testtools.TestCase):
+    def setUp(self):
+        super(TestEventsSpool, self).setUp()
+        self.spool_dir = tempfile.mkdtemp(prefix='events-spool-test-')
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+        for patcher in [
+            mock.patch.dict(os.environ, {
+                amqp_client_utils.EVENTS_SPOOL_DIR_ENV: self.spool_dir}),
+            mock.patch.object(amqp_client_utils, 'SPOOL_RETRY_INTERVAL',
+                              0.01),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.publisher = amqp_client_utils._GlobalEventsPublisher()
+        self.addCleanup(self.publisher.close)
+        self.client = mock.Mock()
+        self.client.publish_message.side_effect = self._published
+        self.publisher._make_client = lambda: self.client
+        self.published = queue.Queue()
+        self.fail_publish = 0
+
+    def _published(self, message, message_type, wait=None):
+        if self.fail_publish:
+            self.fail_publish -= 1
+            raise RuntimeError('broker unreachable')
+        self.published.put((message, message_type, wait))
+
+    def _spooled(self):
+        return len(self.publisher._spool)
+
+    def test_spooled(self):
+        for i in range(3):
+            self.publisher.publish_message({'id': i}, 'event')
+        self.assertEqual(
+            [({'id': i}, 'event', False) for i in range(3)],
+            [self.published.get(timeout=5) for _ in range(3)])
+        spool_directory = self.publisher._spool.directory
+        self.assertTrue(spool_directory.startswith(self.spool_dir))
+        self.publisher.close()
+        self.assertFalse(os.path.exists(spool_directory))
+
+    def test_outage(self):
+        """Messages are kept until they can be published, in order"""
+        self.fail_publish = 3
+        for i in range(3):
+            self.publisher.publish_message({'id': i}, 'event')
+        self.assertEqual(
+            [({'id': i}, 'event', False) for i in range(3)],
+            [self.published.get(timeout=5) for _ in range(3)])
+        # the client is closed after every failure, and connected again
+        self.assertEqual(3, self.client.close.call_count)
+
+    def test_not_confirmed(self):
+        """Messages that weren't confirmed are published again"""
+        confirmation = mock.Mock()
+        confirmation.wait.side_effect = [queue.Empty(), None]
+        self.client.publish_message.side_effect = None
+        self.client.publish_message.return_value = confirmation
+        self.client.is_alive.return_value = False
+        self.publisher.publish_message({'id': 0}, 'event')
+        deadline = time.time() + 5
+        while self.client.publish_message.call_count < 2 and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, self.client.publish_message.call_count)
+        self.publisher.close()
+        self.assertIsNone(self.publisher._spool)
+
+    def test_closed_in_outage(self):
+        """Closing leaves the messages that weren't published on disk"""
+        self.fail_publish = 1000
+        self.publisher.publish_message({'id': 0}, 'event')
+        spool_directory = self.publisher._get_spool().directory
+        self.publisher.close()
+        self.assertIn('000000000000.spool', os.listdir(spool_directory))
+
+    def test_unregister(self):
+        """Unregistering doesn't wait for spooled messages"""
+        self.fail_publish = 1000
+        self.publisher.register_caller()
+        self.publisher.publish_message({'id': 0}, 'event')
+        self.publisher.unregister_caller()
+        self.assertEqual(1, self._spooled())
+
+    def test_register_in_outage(self):
+        """Registering doesn't connect"""
+        def _unreachable():
+            raise RuntimeError('broker unreachable')
+        self.publisher._make_client = _unreachable
+        self.publisher.register_caller()
+        self.assertTrue(self.publisher.client_started.is_set())
+        self.publisher.publish_message({'id': 0}, 'event')
+        time.sleep(0.1)
+        self.assertEqual(1, self._spooled())
+        self.publisher._make_client = lambda: self.client
+        self.assertEqual(({'id': 0}, 'event', False),
+                         self.published.get(timeout=5))
+        self.publisher.unregister_caller()
+
+    def test_process_exit(self):
+        """What a process spooled before exiting is published by the next"""
+        script = (
+            'import os\n'
+            'from cloudify import amqp_client_utils\n'
+            'def _unreachable():\n'
+            '    raise RuntimeError("broker unreachable")\n'
+            'publisher = amqp_client_utils._GlobalEventsPublisher()\n'
+            'publisher._make_client = _unreachable\n'
+            'publisher.register_caller()\n'
+            'for i in range(3):\n'
+            '    publisher.publish_message({"id": i}, "event")\n'
+            'os._exit(0)\n'
+        )
+        subprocess.check_call(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(amqp_client_utils.__file__)))
+        spool_root = os.path.join(self.spool_dir, 'events')
+        abandoned, = os.listdir(spool_root)
+
+        self.publisher.register_caller()
+        self.addCleanup(self.publisher.unregister_caller)
+        self.publisher.publish_message({'id': 3}, 'event')
+        self.assertEqual(
+            [({'id': i}, 'event', False) for i in range(4)],
+            [self.published.get(timeout=5) for _ in range(4)])
+        self.assertEqual([os.path.basename(self.publisher._spool.directory)],
+                         os.listdir(spool_root))
+        self.assertNotEqual(abandoned, os.listdir(spool_root)[0])
+
+
+class TestResponseTimings(testtools.TestCase):
+    def _respond(self, consumer, **kwargs):
+        consumer._connection = mock.Mock()
+        consumer._process_message(
+            mock.Mock(), pika.BasicProperties(reply_to='r1',
+                                              correlation_id='t1'),
+            {'id': 't1'}, 1, **kwargs)
+        response = consumer._connection.publish.mock_calls[0][1][0]
+        return json.loads(response['body'])
+
+    def test_timings(self):
+        response = self._respond(_RecordingConsumer('agent1'),
+                                 queued_at=time.time() - 10)
+        self.assertTrue(response['ok'])
+        self.assertGreaterEqual(response['timings']['queue'], 10)
+        self.assertLess(response['timings']['handle'], 10)
+
+    def test_handler_timings(self):
+        """Timings returned by the handler are kept"""
+        consumer = _RecordingConsumer('agent1')
+        consumer.handle_task = lambda task: {'ok': True,
+                                             'timings': {'operation': 1}}
+        response = self._respond(consumer)
+        self.assertEqual(['handle', 'operation'],
+                         sorted(response['timings']))
+
+
+class TestCompression(testtools.TestCase):
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        for patcher in [
+            mock.patch.dict(
+                os.environ, {amqp_client.COMPRESS_THRESHOLD_ENV: '100'}),
+            mock.patch.object(amqp_client, '_accepting_compressed', {})
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _request(self, task):
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        handler._connection = mock.Mock()
+        handler.publish(task, correlation_id='t1')
+        return handler._connection.publish.mock_calls[0][1][0]
+
+    def _receive_response(self, response, callback=None):
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        handler._connection = mock.Mock()
+        handler.callbacks['t1'] = callback or mock.Mock()
+        handler.process(mock.Mock(), mock.Mock(), response['properties'],
+                        response['body'])
+
+    def _respond(self, request):
+        consumer = _RecordingConsumer('agent1')
+        consumer._connection = mock.Mock()
+        consumer.process(mock.Mock(), mock.Mock(delivery_tag=1),
+                         request['properties'], request['body'])
+        return consumer, consumer._connection.publish.mock_calls[0][1][0]
+
+    def test_compressed(self):
+        task = {'id': 'x' * 1000}
+        # the agent isn't known to decompress requests yet
+        request = self._request(task)
+        self.assertIsNone(request['properties'].content_encoding)
+        consumer, response = self._respond(request)
+        self.assertEqual([task], consumer.handled)
+        # the request accepts a compressed response
+        self.assertEqual('zlib', response['properties'].content_encoding)
+
+        callback = mock.Mock()
+        self._receive_response(response, callback)
+        received, = callback.call_args[0]
+        self.assertEqual({'ok': True, 'task': task['id']},
+                         dict((k, v) for k, v in received.items()
+                              if k != 'timings'))
+
+        # the response said that the agent decompresses requests
+        request = self._request(task)
+        self.assertEqual('zlib', request['properties'].content_encoding)
+        self.assertLess(len(request['body']), 200)
+        consumer, _ = self._respond(request)
+        self.assertEqual([task], consumer.handled)
+
+    def test_old_agent(self):
+        """Agents whose responses don't accept compression get plain
+        requests
+        """
+        self._receive_response({
+            'properties': pika.BasicProperties(correlation_id='t1'),
+            'body': json.dumps({'ok': True})
+        })
+        request = self._request({'id': 'x' * 1000})
+        self.assertIsNone(request['properties'].content_encoding)
+
+    def test_mixed_consumers(self):
+        """One old consumer of the exchange is enough to stop compressing"""
+        task = {'id': 'x' * 1000}
+        _, response = self._respond(self._request(task))
+        self._receive_response(response)
+        self.assertEqual(
+            'zlib', self._request(task)['properties'].content_encoding)
+        old_response = {
+            'properties': pika.BasicProperties(correlation_id='t1'),
+            'body': json.dumps({'ok': True})
+        }
+        self._receive_response(old_response)
+        self.assertIsNone(self._request(task)['properties'].content_encoding)
+        # even if the new consumer responds again
+        self._receive_response(response)
+        self.assertIsNone(self._request(task)['properties'].content_encoding)
+
+    def test_undecodable(self):
+        """Messages that can't be decoded are rejected, not left unacked"""
+        consumer = _RecordingConsumer('agent1')
+        consumer._connection = mock.Mock()
+        channel = mock.Mock()
+        consumer.process(channel, mock.Mock(delivery_tag=1),
+                         pika.BasicProperties(content_encoding='zlib'),
+                         b'not compressed')
+        channel.basic_nack.assert_called_once_with(1, requeue=False)
+        self.assertEqual([], consumer.handled)
+
+    def test_small(self):
+        request = self._request({'id': 't1'})
+        self.assertIsNone(request['properties'].content_encoding)
+        self.assertEqual({'id': 't1'}, json.loads(request['body']))
+
+    def test_response_not_accepted(self):
+        """Responses to senders that can't decompress aren't compressed"""
+        task_id = 'x' * 1000
+        _, response = self._respond({
+            'properties': pika.BasicProperties(reply_to='agent1_response_x'),
+            'body': json.dumps({'id': task_id})
+        })
+        self.assertIsNone(response['properties'].content_encoding)
+        self.assertEqual(task_id, json.loads(response['body'])['task'])
+
+    def _publish_events(self, messages):
+        handler = amqp_client.SendHandler('cloudify-logs')
+        handler._connection = mock.Mock()
+        handler.publish_batch(messages)
+        return handler._connection.publish.mock_calls[0][1][0]
+
+    def test_events(self):
+        messages = [{'level': 'info', 'message': {'text': 'x' * 100}}] * 5
+        # the events consumers might not decompress
+        message = self._publish_events(messages)
+        self.assertIsNone(message['properties'].content_encoding)
+        with mock.patch.dict(
+                os.environ, {amqp_client.COMPRESS_EVENTS_ENV: 'true'}):
+            message = self._publish_events(messages)
+        self.assertEqual('zlib', message['properties'].content_encoding)
+        self.assertEqual(messages, amqp_client.unpack_messages(
+            message['body'], message['properties']))
@@ -0,0 +1,106 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import io
+import json
+import os
+import unittest
+
+import mock
+import testtools
+
+from cloudify import amqp_client, codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class TestCodecFromEnv(testtools.TestCase):
+    def _codec(self, name):
+        with mock.patch.dict(os.environ, {codec.JSON_CODEC_ENV: name}):
+            return codec._codec_from_env()
+
+    def test_default(self):
+        self.assertEqual('json', self._codec('').name)
+
+    def test_unknown(self):
+        self.assertEqual('json', self._codec('nosuchcodec').name)
+
+    def test_auto(self):
+        expected = 'json' if orjson is None else 'orjson'
+        self.assertEqual(expected, self._codec('auto').name)
+
+    def test_set_codec(self):
+        custom = mock.Mock()
+        custom.dumps.return_value = '{}'
+        previous = codec.get_codec()
+        codec.set_codec(custom)
+        self.addCleanup(codec.set_codec, previous)
+        self.assertEqual(
+            '{}', amqp_client.encode_body({'a': 1}, mock.Mock()))
+        custom.dumps.assert_called_once_with({'a': 1})
+
+
+@unittest.skipIf(orjson is None, 'orjson not installed')
+class TestOrjsonCodec(testtools.TestCase):
+    def setUp(self):
+        super(TestOrjsonCodec, self).setUp()
+        self.codec = codec.OrjsonCodec()
+
+    def test_roundtrip(self):
+        payload = {'id': u'n\xe9', 'values': [1, 2.5, None, True]}
+        encoded = self.codec.dumps(payload)
+        self.assertIsInstance(encoded, str)
+        self.assertEqual(payload, json.loads(encoded))
+        self.assertEqual(payload, self.codec.loads(encoded))
+        self.assertEqual(payload, self.codec.loads(encoded.encode('utf-8')))
+
+    def test_fallback(self):
+        """What orjson can't serialize is serialized by the stdlib"""
+        class _Dict(dict):
+            pass
+        for payload in [{1: 'a'}, _Dict(a=1), {'big': 2 ** 70}]:
+            self.assertEqual(json.loads(json.dumps(payload)),
+                             json.loads(self.codec.dumps(payload)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.codec.loads, '{')
+
+    def test_loads_fallback(self):
+        """What orjson can't parse, or parses lossily, is parsed by the
+        stdlib
+        """
+        for document in ['[NaN, Infinity]', '{"big": 1180591620717411303424}',
+                         '-1180591620717411303424']:
+            expected = json.loads(document)
+            self.assertEqual(expected, self.codec.loads(document))
+            self.assertEqual(expected,
+                             self.codec.loads(document.encode('utf-8')))
+        self.assertEqual(2 ** 70, self.codec.loads(
+            self.codec.dumps({'big': 2 ** 70}))['big'])
+
+    def test_dump_non_ascii(self):
+        """dump writes utf-8 regardless of the locale encoding"""
+        payload = {'name': u'n\xe9\u4e2d'}
+        f = io.BytesIO()
+        previous = codec.get_codec()
+        codec.set_codec(self.codec)
+        self.addCleanup(codec.set_codec, previous)
+        codec.dump(payload, f)
+        self.assertIn(u'\u4e2d'.encode('utf-8'), f.getvalue())
+        f.seek(0)
+        self.assertEqual(payload, codec.load(f))
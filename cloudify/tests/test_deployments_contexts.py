@@ -0,0 +1,161 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+import time
+
+import mock
+import testtools
+
+from cloudify_rest_client.deployments import Deployment
+
+from cloudify.workflows.workflow_context import _DeploymentContexts
+
+
+class _DeploymentContext(object):
+    """Stands in for _ManagedCloudifyWorkflowContext"""
+
+    def __init__(self, ctx, contexts, instances=10):
+        self._context = ctx
+        self.deployment_id = ctx['deployment_id']
+        self._contexts = contexts
+        self._raw_node_instances = dict.fromkeys(range(instances))
+        self._users = 0
+        self.internal = mock.Mock()
+
+    def __enter__(self):
+        self._contexts._acquire(self.deployment_id, self)
+
+    def __exit__(self, *args):
+        self._contexts._release(self)
+
+
+class _SystemWideContext(object):
+    tenant_name = 't1'
+
+    def __init__(self):
+        self._context = {'tenant': {'name': 't1'}}
+        self.logger = mock.Mock()
+        self.built = []
+        self._lock = threading.Lock()
+
+    def _ManagedCloudifyWorkflowContext(self, ctx, contexts):
+        with self._lock:
+            self.built.append(ctx['deployment_id'])
+        if ctx['deployment_id'] == 'broken':
+            raise RuntimeError('broken')
+        return _DeploymentContext(ctx, contexts)
+
+
+def _contexts(deployment_ids, max_instances=1000):
+    deployments = [Deployment({'id': dep_id, 'blueprint_id': 'bp'})
+                   for dep_id in deployment_ids]
+    workflow_ctx = _SystemWideContext()
+    return workflow_ctx, _DeploymentContexts(
+        workflow_ctx, deployments, max_instances=max_instances)
+
+
+class TestDeploymentContexts(testtools.TestCase):
+    def test_mapping(self):
+        workflow_ctx, contexts = _contexts(['d1', 'd2'])
+        self.assertEqual(['d1', 'd2'], list(contexts))
+        self.assertEqual(2, len(contexts))
+        self.assertIn('d1', contexts)
+        self.assertRaises(KeyError, contexts.__getitem__, 'd3')
+        # contexts are only built when used
+        self.assertEqual([], workflow_ctx.built)
+        self.assertEqual('d1', contexts['d1'].deployment_id)
+        self.assertEqual('d1', contexts['d1'].deployment_id)
+        self.assertEqual(['d1'], workflow_ctx.built)
+
+    def test_lru(self):
+        """Least recently used contexts are dropped, and rebuilt"""
+        workflow_ctx, contexts = _contexts(['d1', 'd2', 'd3'],
+                                           max_instances=20)
+        for dep_id in ['d1', 'd2', 'd1', 'd3']:
+            contexts[dep_id].deployment_id
+        self.assertEqual(['d1', 'd3'], list(contexts._cache))
+        contexts['d2'].deployment_id
+        self.assertEqual(['d1', 'd2', 'd3', 'd2'], workflow_ctx.built)
+        self.assertEqual(20, contexts._cached_instances)
+
+    def test_in_use_not_dropped(self):
+        workflow_ctx, contexts = _contexts(['d1', 'd2', 'd3'],
+                                           max_instances=10)
+        with contexts['d1']:
+            contexts['d2'].deployment_id
+            contexts['d3'].deployment_id
+            self.assertEqual(['d1', 'd3'], list(contexts._cache))
+            contexts['d1'].deployment_id
+        self.assertEqual(['d1', 'd2', 'd3'], workflow_ctx.built)
+
+    def test_dropped_before_entered(self):
+        """A context dropped between lookup and use is cached again"""
+        workflow_ctx, contexts = _contexts(['d1', 'd2', 'd3'],
+                                           max_instances=10)
+        d1 = contexts._get('d1')
+        contexts['d2'].deployment_id
+        self.assertEqual(['d2'], list(contexts._cache))
+        with d1:
+            contexts['d3'].deployment_id
+            self.assertEqual(['d1', 'd3'], list(contexts._cache))
+            self.assertIs(d1, contexts._get('d1'))
+        self.assertEqual(['d1', 'd2', 'd3'], workflow_ctx.built)
+        self.assertEqual(0, d1._users)
+        self.assertEqual(20, contexts._cached_instances)
+
+    def test_referenced_not_rebuilt(self):
+        """A dropped context that is still referenced is used again"""
+        workflow_ctx, contexts = _contexts(['d1', 'd2'], max_instances=10)
+        d1 = contexts._get('d1')
+        contexts['d2'].deployment_id
+        self.assertEqual(['d2'], list(contexts._cache))
+        self.assertIs(d1, contexts._get('d1'))
+        self.assertEqual(['d1'], list(contexts._cache))
+        self.assertEqual(10, contexts._cached_instances)
+        # d2 isn't referenced anymore, so it's rebuilt
+        contexts['d2'].deployment_id
+        self.assertEqual(['d1', 'd2', 'd2'], workflow_ctx.built)
+
+    def test_prefetch(self):
+        workflow_ctx, contexts = _contexts(
+            ['d{0}'.format(i) for i in range(20)])
+        build = workflow_ctx._ManagedCloudifyWorkflowContext
+        running = []
+        concurrent = []
+
+        def _slow_build(ctx, contexts):
+            running.append(True)
+            concurrent.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+            return build(ctx, contexts)
+
+        workflow_ctx._ManagedCloudifyWorkflowContext = _slow_build
+        contexts.prefetch(workers=5)
+        self.assertEqual(sorted(contexts), sorted(workflow_ctx.built))
+        self.assertLessEqual(max(concurrent), 5)
+        self.assertGreater(max(concurrent), 1)
+        # prefetched contexts are not built again
+        contexts['d0'].deployment_id
+        self.assertEqual(20, len(workflow_ctx.built))
+
+    def test_prefetch_failure(self):
+        workflow_ctx, contexts = _contexts(['d1', 'broken'])
+        contexts.prefetch(['broken', 'd1'])
+        self.assertEqual(1, workflow_ctx.logger.warning.call_count)
+        self.assertEqual(['d1'], list(contexts._cache))
+        self.assertRaises(RuntimeError, getattr,
+                          contexts['broken'], 'deployment_id')
@@ -0,0 +1,99 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+import time
+
+import mock
+import testtools
+
+from cloudify.workflows.workflow_context import LocalTasksProcessing
+
+
+class TestLocalTasksProcessing(testtools.TestCase):
+    def _processor(self, thread_pool_size):
+        processor = LocalTasksProcessing(
+            mock.Mock(local=True), thread_pool_size=thread_pool_size)
+        processor.start()
+        self.addCleanup(processor.stop)
+        return processor
+
+    def _wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_concurrent_tasks(self):
+        """Tasks without an ordering key run concurrently"""
+        processor = self._processor(thread_pool_size=3)
+        lock = threading.Lock()
+        started = []
+        done = []
+
+        def task():
+            with lock:
+                started.append(True)
+            # only finish when all 3 tasks are running at the same time
+            deadline = time.time() + 5
+            while len(started) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            done.append(len(started) == 3)
+
+        for _ in range(3):
+            processor.add_task(task)
+        self._wait(lambda: len(done) == 3)
+        self.assertEqual([True] * 3, done)
+
+    def test_ordered_tasks(self):
+        """Tasks with the same ordering key run in order, one at a time"""
+        processor = self._processor(thread_pool_size=5)
+        lock = threading.Lock()
+        running = set()
+        order = {'ni1': [], 'ni2': []}
+        overlaps = []
+
+        def make_task(key, index):
+            def task():
+                with lock:
+                    if key in running:
+                        overlaps.append(key)
+                    running.add(key)
+                time.sleep(0.001)
+                order[key].append(index)
+                with lock:
+                    running.discard(key)
+            return task
+
+        for index in range(20):
+            for key in order:
+                processor.add_task(make_task(key, index), ordering_key=key)
+        self._wait(lambda: all(len(o) == 20 for o in order.values()))
+        self.assertEqual(list(range(20)), order['ni1'])
+        self.assertEqual(list(range(20)), order['ni2'])
+        self.assertEqual([], overlaps)
+        self.assertEqual({}, processor._ordered_tasks)
+
+    def test_ordered_task_fails(self):
+        """A failing task doesn't block the next ones with its key"""
+        processor = self._processor(thread_pool_size=2)
+        done = []
+
+        def failing():
+            raise RuntimeError()
+
+        processor.add_task(failing, ordering_key='ni1')
+        processor.add_task(lambda: done.append(True), ordering_key='ni1')
+        self._wait(lambda: done)
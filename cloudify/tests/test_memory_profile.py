@@ -0,0 +1,158 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import yaml
+from testtools import TestCase
+
+from cloudify.decorators import workflow
+from cloudify.workflows import local, memory_profile
+from cloudify.workflows.memory_profile import (ExecutionMemoryProfile,
+                                               NullMemoryProfile)
+
+
+class _Allocated(object):
+    pass
+
+
+@workflow
+def profiled_workflow(ctx, **kwargs):
+    return {
+        'kwargs': sorted(kwargs),
+        'profile_memory': ctx.profile_memory,
+        'enabled': ctx.internal.memory_profile.enabled
+    }
+
+
+PROFILED_BLUEPRINT = {
+    'tosca_definitions_version': 'cloudify_dsl_1_3',
+    'plugins': {
+        'p': {'executor': 'central_deployment_agent', 'install': False}
+    },
+    'node_templates': {},
+    'workflows': {
+        'profiled': 'p.cloudify.tests.test_memory_profile.profiled_workflow'
+    }
+}
+
+
+@unittest.skipIf(not memory_profile.available, 'tracemalloc not available')
+class TestExecutionMemoryProfile(TestCase):
+    def setUp(self):
+        super(TestExecutionMemoryProfile, self).setUp()
+        self.profile = ExecutionMemoryProfile()
+        self.addCleanup(self.profile.stop)
+
+    def test_sample(self):
+        allocated = [_Allocated() for _ in range(1000)]
+        self.profile.sample('graph_execute')
+        samples = self.profile.report()['samples']
+        self.assertEqual(1, len(samples))
+        sample = samples[0]
+        self.assertEqual('graph_execute', sample['phase'])
+        self.assertGreater(sample['traced'], 0)
+        self.assertIn(__name__, [m['module'] for m in sample['modules']])
+        types = dict((t['type'], t['count']) for t in sample['types'])
+        self.assertGreaterEqual(
+            types.get('{0}._Allocated'.format(__name__)), len(allocated))
+
+    def test_sample_phase_once(self):
+        self.profile.sample('mid_execution')
+        self.profile.sample('mid_execution')
+        self.profile.sample('end')
+        self.assertEqual(
+            ['mid_execution', 'end'],
+            [s['phase'] for s in self.profile.report()['samples']])
+
+    def test_top_consumers(self):
+        profile = ExecutionMemoryProfile(top=2)
+        profile.sample('end')
+        sample = profile.report()['samples'][0]
+        self.assertLessEqual(len(sample['modules']), 2)
+        self.assertEqual(2, len(sample['types']))
+
+    def test_no_samples_after_stop(self):
+        self.profile.stop()
+        self.profile.sample('end')
+        self.assertEqual([], self.profile.report()['samples'])
+
+    def test_write(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'profile.json')
+        self.profile.sample('end')
+        self.profile.write(path)
+        with open(path) as f:
+            self.assertEqual(self.profile.report(), json.load(f))
+
+
+class TestNullMemoryProfile(TestCase):
+    def test_null_profile(self):
+        profile = NullMemoryProfile()
+        profile.sample('end')
+        profile.stop()
+        self.assertFalse(profile.enabled)
+        self.assertIsNone(profile.report())
+
+
+@unittest.skipIf(not memory_profile.available, 'tracemalloc not available')
+class TestProfileMemoryParameter(TestCase):
+    def setUp(self):
+        super(TestProfileMemoryParameter, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        blueprint_path = os.path.join(self.tempdir, 'blueprint.yaml')
+        with open(blueprint_path, 'w') as f:
+            yaml.safe_dump(PROFILED_BLUEPRINT, f)
+        self.env = local.init_env(blueprint_path, name=self._testMethodName)
+
+    def test_parameter(self):
+        profile_dir = os.path.join(self.tempdir, 'profiles')
+        os.mkdir(profile_dir)
+        with mock.patch.dict(os.environ, {
+                memory_profile.MEMORY_PROFILE_DIR_ENV: profile_dir}):
+            result = self.env.execute('profiled', parameters={
+                '_profile_memory': True,
+                'other': 1
+            }, allow_custom_parameters=True)
+        self.assertTrue(result['profile_memory'])
+        self.assertTrue(result['enabled'])
+        # the profiling parameter isn't passed to the workflow function
+        self.assertEqual(['other'], result['kwargs'])
+        report, = os.listdir(profile_dir)
+        with open(os.path.join(profile_dir, report)) as f:
+            self.assertEqual(['end'],
+                             [s['phase'] for s in json.load(f)['samples']])
+
+    def test_workflow_parameters(self):
+        """Workflows' own parameters of the same names are passed on"""
+        result = self.env.execute('profiled', parameters={
+            'profile_memory': True,
+            'memory_profile_path': '/etc/passwd'
+        }, allow_custom_parameters=True)
+        self.assertFalse(result['enabled'])
+        self.assertEqual(['memory_profile_path', 'profile_memory'],
+                         result['kwargs'])
+
+    def test_disabled(self):
+        result = self.env.execute('profiled')
+        self.assertFalse(result['profile_memory'])
+        self.assertFalse(result['enabled'])
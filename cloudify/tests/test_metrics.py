@@ -0,0 +1,154 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import mock
+from testtools import TestCase
+
+from cloudify import metrics
+from cloudify.metrics import Histogram, MetricsRegistry
+from cloudify_rest_client.client import _request_endpoint
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = Histogram('h', 'doc', labelnames=('op', ),
+                              buckets=(1, 5))
+        histogram.observe(0.5, 'a')
+        histogram.observe(1, 'a')
+        histogram.observe(3, 'a')
+        histogram.observe(10, 'a')
+        histogram.observe(2, 'b')
+        self.assertEqual({
+            ('a', ): [2, 1, 1, 14.5],
+            ('b', ): [0, 1, 0, 2]
+        }, histogram.collect())
+
+    def test_wrong_labels(self):
+        histogram = Histogram('h', 'doc', labelnames=('op', ))
+        self.assertRaises(ValueError, histogram.observe, 1)
+        self.assertRaises(ValueError, histogram.observe, 1, 'a', 'b')
+
+    def test_threads(self):
+        histogram = Histogram('h', 'doc', buckets=(1, ))
+
+        def _observe():
+            for _ in range(100):
+                histogram.observe(0.5)
+        threads = [threading.Thread(target=_observe) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        del threads
+        histogram.observe(2)
+        self.assertEqual({(): [500, 1, 252]}, histogram.collect())
+
+    def test_time(self):
+        histogram = Histogram('h', 'doc', labelnames=('op', ))
+        with histogram.time('a'):
+            pass
+        self.assertEqual(1, sum(histogram.collect()[('a', )][:-1]))
+
+    def test_generate_text(self):
+        histogram = Histogram('h_seconds', 'Some\ndoc',
+                              labelnames=('op', ), buckets=(1, 5))
+        histogram.observe(0.5, 'a"b')
+        histogram.observe(3, 'a"b')
+        self.assertEqual(
+            '# HELP h_seconds Some\\ndoc\n'
+            '# TYPE h_seconds histogram\n'
+            'h_seconds_bucket{op="a\\"b",le="1.0"} 1\n'
+            'h_seconds_bucket{op="a\\"b",le="5.0"} 2\n'
+            'h_seconds_bucket{op="a\\"b",le="+Inf"} 2\n'
+            'h_seconds_sum{op="a\\"b"} 3.5\n'
+            'h_seconds_count{op="a\\"b"} 2\n',
+            histogram.generate_text())
+
+
+class TestMetricsRegistry(TestCase):
+    def setUp(self):
+        super(TestMetricsRegistry, self).setUp()
+        self.registry = MetricsRegistry()
+        self.registry.histogram('h', 'doc', buckets=(1, )).observe(0.5)
+
+    def test_get_or_create(self):
+        self.assertIs(self.registry.histogram('h', 'doc'),
+                      self.registry.histogram('h', 'doc'))
+        self.assertRaises(ValueError, self.registry.histogram, 'h', 'doc',
+                          labelnames=('op', ))
+
+    def test_write_text_file(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'metrics.prom')
+        self.registry.write_text_file(path)
+        with open(path) as f:
+            self.assertEqual(self.registry.generate_text(), f.read())
+        self.assertEqual(['metrics.prom'], os.listdir(tempdir))
+
+    def test_serve_socket(self):
+        listening = self.registry.serve_socket(('127.0.0.1', 0))
+        self.addCleanup(listening.close)
+        conn = socket.create_connection(listening.getsockname())
+        self.addCleanup(conn.close)
+        conn.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            response += data
+        headers, body = response.decode('utf-8').split('\r\n\r\n', 1)
+        self.assertTrue(headers.startswith('HTTP/1.0 200 OK'))
+        self.assertEqual(self.registry.generate_text(), body)
+
+    def test_serve_unix_socket(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'metrics.sock')
+        listening = self.registry.serve_socket(path)
+        # another process can't take over the path
+        self.assertRaises(socket.error, self.registry.serve_socket, path)
+        listening.shutdown(socket.SHUT_RDWR)
+        listening.close()
+        # but it can once the socket isn't served anymore
+        self.addCleanup(self.registry.serve_socket(path).close)
+
+    def test_export_from_env_errors(self):
+        """Failing to export is logged, and doesn't raise"""
+        with mock.patch.dict(os.environ, {
+            metrics.METRICS_SOCKET_ENV: '/nonexistent/metrics.sock',
+            metrics.METRICS_FILE_ENV: '/nonexistent/metrics.prom',
+        }), mock.patch.object(metrics.logger, 'warning') as warning, \
+                mock.patch.object(metrics._FileExporter, 'start',
+                                  side_effect=RuntimeError('x')):
+            self.assertIsNone(metrics.export_from_env(self.registry))
+        self.assertEqual(2, warning.call_count)
+
+
+class TestRequestEndpoint(TestCase):
+    def test_request_endpoint(self):
+        for url, expected in [
+            ('http://localhost/api/v3.1/node-instances/x', 'node-instances'),
+            ('https://localhost:53333/api/v3.1/executions', 'executions'),
+            ('http://localhost/api/version', 'version'),
+        ]:
+            self.assertEqual(expected, _request_endpoint(url))
@@ -0,0 +1,184 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import json
+import time
+
+import testtools
+
+from cloudify import amqp_client
+from cloudify._compat import queue
+from cloudify.tests.mocks.mock_broker import MockBroker, _topic_matches
+
+
+class _EchoConsumer(amqp_client.TaskConsumer):
+    routing_key = 'operation'
+
+    def handle_task(self, full_task):
+        return {'ok': True, 'result': full_task['value']}
+
+
+class _Listener(object):
+    """Consumes a queue bound to an exchange, on its own connection"""
+
+    def __init__(self, broker, exchange, exchange_type, routing_key):
+        self.received = queue.Queue()
+        self.connection = broker.connect()
+        channel = self.connection.channel()
+        channel.exchange_declare(exchange=exchange,
+                                 exchange_type=exchange_type)
+        queue_name = channel.queue_declare(
+            queue='', exclusive=True).method.queue
+        channel.queue_bind(queue=queue_name, exchange=exchange,
+                           routing_key=routing_key)
+        channel.basic_consume(self._received, queue_name)
+
+    def _received(self, channel, method, properties, body):
+        self.received.put(json.loads(body.decode('utf-8')))
+        channel.basic_ack(method.delivery_tag)
+
+    def get(self, timeout=5):
+        deadline = time.time() + timeout
+        while self.received.empty() and time.time() < deadline:
+            self.connection.process_data_events(0.05)
+        return self.received.get_nowait()
+
+
+class TestMockBroker(testtools.TestCase):
+    def setUp(self):
+        super(TestMockBroker, self).setUp()
+        self.broker = MockBroker()
+        self.addCleanup(self._close_connections)
+        patcher = self.broker.patched()
+        patcher.__enter__()
+        self.addCleanup(patcher.__exit__, None, None, None)
+        self.amqp_params = amqp_client.AMQPParams(amqp_host='localhost')
+
+    def _close_connections(self):
+        for connection in list(self.broker.connections):
+            connection.close()
+
+    def _connection(self, handlers, **kwargs):
+        connection = amqp_client.AMQPConnection(
+            handlers, amqp_params=self.amqp_params, **kwargs)
+        connection.consume_in_thread()
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_request_response(self):
+        self._connection([_EchoConsumer('agent1', threadpool_size=2)])
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        self._connection([handler])
+        responses = queue.Queue()
+        for i in range(5):
+            handler.publish({'id': str(i), 'value': i},
+                            routing_key='operation',
+                            callback=responses.put)
+        results = [responses.get(timeout=5) for _ in range(5)]
+        self.assertEqual(list(range(5)),
+                         sorted(r['result'] for r in results))
+        # the response queues are deleted once the responses are handled
+        deadline = time.time() + 5
+        while len(self.broker._queues) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['agent1_operation'], list(self.broker._queues))
+
+    def test_events_publisher(self):
+        events = _Listener(self.broker, amqp_client.EVENTS_EXCHANGE_NAME,
+                           'topic', 'events.#')
+        logs = _Listener(self.broker, amqp_client.LOGS_EXCHANGE_NAME,
+                         'fanout', '')
+        publisher = amqp_client.CloudifyEventsPublisher(self.amqp_params)
+        publisher.connect()
+        self.addCleanup(publisher.close)
+        publisher.publish_message({'event_type': 'e1'}, 'event')
+        publisher.publish_message({'event_type': 'h1'}, 'hook')
+        publisher.publish_message({'message': {'text': 'l1'}}, 'log')
+        self.assertEqual({'event_type': 'e1'}, events.get())
+        self.assertEqual({'event_type': 'h1'}, events.get())
+        self.assertEqual({'message': {'text': 'l1'}}, logs.get())
+
+    def test_prefetch(self):
+        """No more than prefetch_count messages are delivered unacked"""
+        consumer = self.broker.connect()
+        channel = consumer.channel()
+        channel.basic_qos(prefetch_count=2)
+        channel.queue_declare(queue='q1')
+        delivered = []
+        channel.basic_consume(
+            lambda ch, method, props, body: delivered.append(method), 'q1')
+        publisher = self.broker.connect().channel()
+        for i in range(5):
+            publisher.publish('', 'q1', str(i))
+        consumer.process_data_events(0.05)
+        self.assertEqual(2, len(delivered))
+        self.assertEqual(3, self.broker.queue_size('q1'))
+        channel.basic_ack(delivered[-1].delivery_tag, multiple=True)
+        consumer.process_data_events(0.05)
+        self.assertEqual(4, len(delivered))
+
+    def test_latency(self):
+        self.broker.latency = 0.05
+        connection = self.broker.connect()
+        channel = connection.channel()
+        channel.queue_declare(queue='q1')
+        channel.confirm_delivery()
+        start = time.time()
+        channel.publish('', 'q1', 'body')
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        # pipelined confirms arrive a round trip after the publish
+        confirms = []
+        channel._impl.confirm_delivery(confirms.append, nowait=True)
+        channel.publish('', 'q1', 'body')
+        connection.process_data_events(0)
+        self.assertEqual([], confirms)
+        connection.process_data_events(1)
+        self.assertEqual(1, confirms[0].method.delivery_tag)
+
+    def test_redelivered(self):
+        """Unacked messages are redelivered after the broker restarts"""
+        channel = self.broker.connect().channel()
+        channel.queue_declare(queue='q1')
+        channel.basic_consume(lambda *args: None, 'q1')
+        channel.publish('', 'q1', 'body')
+        self.broker.disconnect()
+        self.assertEqual(1, self.broker.queue_size('q1'))
+        delivered = []
+        connection = self.broker.connect()
+        connection.channel().basic_consume(
+            lambda ch, method, props, body: delivered.append(method), 'q1')
+        connection.process_data_events(1)
+        self.assertTrue(delivered[0].redelivered)
+
+    def test_reconnect(self):
+        """Clients reconnect after the broker restarts"""
+        self._connection([_EchoConsumer('agent1')])
+        handler = amqp_client.CallbackRequestResponseHandler('agent1')
+        self._connection([handler])
+        responses = queue.Queue()
+        handler.publish({'id': '1', 'value': 1}, routing_key='operation',
+                        callback=responses.put)
+        self.assertEqual(1, responses.get(timeout=5)['result'])
+        self.broker.disconnect()
+        handler.publish({'id': '2', 'value': 2}, routing_key='operation',
+                        callback=responses.put)
+        self.assertEqual(2, responses.get(timeout=5)['result'])
+
+    def test_topic_matches(self):
+        self.assertTrue(_topic_matches('events.#', 'events.hooks'))
+        self.assertTrue(_topic_matches('events.#', 'events'))
+        self.assertTrue(_topic_matches('*.hooks', 'events.hooks'))
+        self.assertFalse(_topic_matches('events.*', 'events'))
+        self.assertFalse(_topic_matches('events', 'events.hooks'))
@@ -0,0 +1,246 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import mock
+import testtools
+
+from cloudify_rest_client.nodes import Node
+from cloudify_rest_client.node_instances import NodeInstance
+
+from cloudify.workflows import workflow_context
+from cloudify.workflows.workflow_context import (
+    CloudifyWorkflowNodeInstance,
+    WorkflowNodesAndInstancesContainer
+)
+
+CONTAINED_IN = ['cloudify.relationships.depends_on',
+                'cloudify.relationships.contained_in']
+CONNECTED_TO = ['cloudify.relationships.depends_on',
+                'cloudify.relationships.connected_to']
+
+
+def _node(node_id, relationships=()):
+    return Node({
+        'id': node_id,
+        'relationships': [
+            {'target_id': target, 'type_hierarchy': hierarchy}
+            for target, hierarchy in relationships
+        ]
+    })
+
+
+def _instance(instance_id, node_id, relationships=(), version=1):
+    return NodeInstance({
+        'id': instance_id,
+        'node_id': node_id,
+        'version': version,
+        'relationships': [
+            {'target_id': target_id, 'target_name': target_name}
+            for target_id, target_name in relationships
+        ]
+    })
+
+
+class TestNodesAndInstancesContainer(testtools.TestCase):
+    def setUp(self):
+        super(TestNodesAndInstancesContainer, self).setUp()
+        raw_nodes = [
+            _node('vm'),
+            _node('app', [('vm', CONTAINED_IN)]),
+            _node('db', [('vm', CONTAINED_IN), ('app', CONNECTED_TO)])
+        ]
+        raw_instances = [
+            _instance('vm_1', 'vm'),
+            _instance('vm_2', 'vm'),
+            _instance('app_1', 'app', [('vm_1', 'vm')]),
+            _instance('app_2', 'app', [('vm_2', 'vm')]),
+            _instance('db_1', 'db', [('vm_1', 'vm'), ('app_1', 'app')])
+        ]
+        self.container = WorkflowNodesAndInstancesContainer(
+            mock.Mock(), raw_nodes, raw_instances)
+
+    def test_lazy(self):
+        """Objects are only created for what was accessed"""
+        instance = self.container.get_node_instance('app_1')
+        self.assertEqual(['app'], list(self.container._nodes))
+        self.assertEqual(['app_1'], list(self.container._node_instances))
+        self.assertIs(instance, self.container.get_node_instance('app_1'))
+        self.assertIs(self.container.get_node('app'), instance.node)
+
+    def test_missing(self):
+        self.assertIsNone(self.container.get_node('missing'))
+        self.assertIsNone(self.container.get_node_instance('missing'))
+
+    def test_iterate(self):
+        self.assertEqual(['vm', 'app', 'db'],
+                         [n.id for n in self.container.nodes])
+        self.assertEqual(['vm_1', 'vm_2', 'app_1', 'app_2', 'db_1'],
+                         [i.id for i in self.container.node_instances])
+        self.assertEqual(
+            ['vm_1', 'vm_2'],
+            [i.id for i in self.container.get_node('vm').instances])
+
+    def test_relationships(self):
+        db = self.container.get_node_instance('db_1')
+        relationships = dict((r.target_id, r) for r in db.relationships)
+        self.assertEqual(['app_1', 'vm_1'], sorted(relationships))
+        self.assertIs(self.container.get_node_instance('app_1'),
+                      relationships['app_1'].target_node_instance)
+        self.assertTrue(relationships['vm_1'].relationship.is_derived_from(
+            'cloudify.relationships.contained_in'))
+
+    def test_contained_instances(self):
+        vm = self.container.get_node_instance('vm_1')
+        self.assertEqual(['app_1', 'db_1'],
+                         [i.id for i in vm.contained_instances])
+        self.assertEqual(
+            set(['vm_1', 'app_1', 'db_1']),
+            set(i.id for i in vm.get_contained_subgraph()))
+        self.assertEqual([], self.container.get_node_instance(
+            'app_1').contained_instances)
+
+    def test_replace_instances(self):
+        self.container.get_node_instance('vm_1')
+        self.container._set_raw_node_instances([_instance('vm_3', 'vm')])
+        self.assertIsNone(self.container.get_node_instance('vm_1'))
+        self.assertEqual(
+            ['vm_3'],
+            [i.id for i in self.container.get_node('vm').instances])
+
+    def test_is_derived_from(self):
+        app = self.container.get_node_instance('app_1')
+        relationship = next(app.relationships).relationship
+        self.assertTrue(relationship.is_derived_from(
+            'cloudify.relationships.depends_on'))
+        self.assertFalse(relationship.is_derived_from(
+            'cloudify.relationships.connected_to'))
+        # every distinct hierarchy is kept once, and shared
+        db = self.container.get_node_instance('db_1')
+        db_relationship = next(r.relationship for r in db.relationships
+                               if r.target_id == 'vm_1')
+        db_relationship.is_derived_from('cloudify.relationships.contained_in')
+        self.assertIs(relationship._type_hierarchy,
+                      db_relationship._type_hierarchy)
+
+    def test_hierarchies_converted_once(self):
+        """The hierarchy sets are kept on the raw nodes, and reused"""
+        raw_nodes = list(self.container._raw_nodes.values())
+        with mock.patch.object(
+                workflow_context, '_type_hierarchy_set',
+                wraps=workflow_context._type_hierarchy_set) as converted:
+            self.container.get_node_instance('vm_1').contained_instances
+            # 3 nodes, with 3 relationships
+            self.assertEqual(6, converted.call_count)
+            container = WorkflowNodesAndInstancesContainer(
+                mock.Mock(), raw_nodes,
+                self.container._raw_node_instances.values())
+            for instance in container.node_instances:
+                instance.node.is_derived_from('cloudify.nodes.Compute')
+                for relationship in instance.relationships:
+                    relationship.relationship.is_derived_from(
+                        'cloudify.relationships.contained_in')
+            self.assertEqual(
+                ['app_1', 'db_1'],
+                [i.id for i in container.get_node_instance(
+                    'vm_1').contained_instances])
+        self.assertEqual(6, converted.call_count)
+
+    def test_node_is_derived_from(self):
+        node = _node('server')
+        node['type_hierarchy'] = ['cloudify.nodes.Root',
+                                  'cloudify.nodes.Compute']
+        container = WorkflowNodesAndInstancesContainer(
+            mock.Mock(), [node], [])
+        self.assertTrue(container.get_node('server').is_derived_from(
+            'cloudify.nodes.Compute'))
+        self.assertFalse(container.get_node('server').is_derived_from(
+            'cloudify.nodes.Root.Other'))
+
+    def test_slots(self):
+        instance = self.container.get_node_instance('vm_1')
+        self.assertIsInstance(instance, CloudifyWorkflowNodeInstance)
+        self.assertFalse(hasattr(instance, '__dict__'))
+
+
+class _RemoteContainer(WorkflowNodesAndInstancesContainer):
+    local = False
+    deployment = mock.Mock(id='d1')
+
+
+class TestRefreshNodeInstances(testtools.TestCase):
+    def setUp(self):
+        super(TestRefreshNodeInstances, self).setUp()
+        self.container = _RemoteContainer(
+            mock.Mock(),
+            [_node('vm'), _node('app', [('vm', CONTAINED_IN)])],
+            [_instance('vm_1', 'vm'),
+             _instance('vm_2', 'vm'),
+             _instance('app_1', 'app', [('vm_1', 'vm')])])
+        self.rest = mock.Mock()
+        patcher = mock.patch.object(
+            workflow_context, 'get_rest_client', return_value=self.rest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _refresh(self, current):
+        """Refresh, with the REST service returning the current instances"""
+        def _list(_include=None, id=None, **kwargs):
+            if _include:
+                return [NodeInstance(dict((k, i[k]) for k in _include))
+                        for i in current]
+            return [i for i in current if i.id in id]
+        self.rest.node_instances.list.side_effect = _list
+        self.container.refresh_node_instances()
+
+    def test_fetch_changed(self):
+        vm = self.container.get_node_instance('vm_1')
+        self._refresh([
+            _instance('vm_1', 'vm', version=2),
+            _instance('vm_2', 'vm'),
+            _instance('app_1', 'app', [('vm_1', 'vm')]),
+            _instance('app_2', 'app', [('vm_2', 'vm')])
+        ])
+        fetch_call = self.rest.node_instances.list.mock_calls[-1]
+        self.assertEqual(['vm_1', 'app_2'], fetch_call[2]['id'])
+        # the existing object is updated in place
+        self.assertIs(vm, self.container.get_node_instance('vm_1'))
+        self.assertEqual(2, vm._node_instance.version)
+        self.assertEqual(
+            ['app_1', 'app_2'],
+            [i.id for i in self.container.get_node('app').instances])
+        self.assertEqual(
+            ['app_2'], [i.id for i in self.container.get_node_instance(
+                'vm_2').contained_instances])
+
+    def test_removed(self):
+        self.assertEqual(1, len(self.container.get_node_instance(
+            'vm_1').contained_instances))
+        self._refresh([_instance('vm_1', 'vm'), _instance('vm_2', 'vm')])
+        self.assertEqual(1, len(self.rest.node_instances.list.mock_calls))
+        self.assertIsNone(self.container.get_node_instance('app_1'))
+        self.assertEqual([], list(self.container.get_node('app').instances))
+        self.assertEqual([], self.container.get_node_instance(
+            'vm_1').contained_instances)
+
+    def test_chunks(self):
+        added = [_instance('vm_new_{0}'.format(i), 'vm') for i in range(5)]
+        with mock.patch.object(workflow_context,
+                               'REFRESH_FETCH_CHUNK_SIZE', 2):
+            self._refresh(added)
+        # the listing of versions, and 2 + 2 + 1 added instances
+        self.assertEqual(4, len(self.rest.node_instances.list.mock_calls))
+        self.assertEqual(
+            [i.id for i in added],
+            [i.id for i in self.container.get_node('vm').instances])
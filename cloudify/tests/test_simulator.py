@@ -0,0 +1,266 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import testtools
+import yaml
+
+from cloudify.decorators import workflow
+from cloudify.workflows import local, tasks
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
+from cloudify.workflows.simulator import (
+    LOCAL_TASKS,
+    DurationModel,
+    Simulator,
+    empirical,
+    lifecycle_graph,
+    uniform
+)
+from cloudify.tests.test_tasks_graph import MockWorkflowContext
+
+
+def _operation(operation, host='host1', name=None):
+    return tasks.LocalWorkflowTask(
+        lambda: None, None,
+        name=name or operation,
+        kwargs={'__cloudify_context': {
+            'operation': {'name': operation},
+            'plugin': {'name': 'plugin1'},
+            'node_id': 'node_{0}'.format(host),
+            'host_id': host,
+            'executor': 'host_agent'
+        }})
+
+
+def _local_task(name):
+    return tasks.LocalWorkflowTask(lambda: None, None, name=name)
+
+
+def noop(**_):
+    pass
+
+
+@workflow
+def simulate_install(ctx, **_):
+    graph = lifecycle_graph(ctx.node_instances)
+    result = Simulator(DurationModel({'create': 2}), poll_interval=0).run(
+        graph)
+    return {
+        'graph_mode': ctx.internal.graph_mode,
+        'tasks': len(list(graph.tasks_iter())),
+        'makespan': result.makespan
+    }
+
+
+NOOP = 'p.cloudify.tests.test_simulator.noop'
+
+
+def _interface(name, operations):
+    """The interface, with only the create operation implemented"""
+    return {name: dict((operation, NOOP if operation == 'create' else {})
+                       for operation in operations)}
+
+
+NODE_INTERFACES = {}
+NODE_INTERFACES.update(_interface('cloudify.interfaces.lifecycle', [
+    'precreate', 'create', 'configure', 'start', 'poststart', 'prestop',
+    'stop', 'delete', 'postdelete']))
+NODE_INTERFACES.update(_interface('cloudify.interfaces.monitoring',
+                                  ['start', 'stop']))
+NODE_INTERFACES.update(_interface('cloudify.interfaces.validation',
+                                  ['create', 'delete']))
+RELATIONSHIP_INTERFACES = _interface(
+    'cloudify.interfaces.relationship_lifecycle',
+    ['preconfigure', 'postconfigure', 'establish', 'unlink'])
+
+# a blueprint that defines the types it uses, so that no imports need
+# to be fetched
+SIMULATED_BLUEPRINT = {
+    'tosca_definitions_version': 'cloudify_dsl_1_3',
+    'plugins': {
+        'p': {'executor': 'central_deployment_agent', 'install': False}
+    },
+    'node_types': {
+        'cloudify.nodes.Root': {'interfaces': NODE_INTERFACES}
+    },
+    'relationships': {
+        'cloudify.relationships.depends_on': {
+            'properties': {'connection_type': {'default': 'all_to_all'}},
+            'source_interfaces': RELATIONSHIP_INTERFACES,
+            'target_interfaces': RELATIONSHIP_INTERFACES
+        }
+    },
+    'node_templates': {
+        'node1': {'type': 'cloudify.nodes.Root'},
+        'node2': {
+            'type': 'cloudify.nodes.Root',
+            'relationships': [{
+                'type': 'cloudify.relationships.depends_on',
+                'target': 'node1'
+            }]
+        }
+    },
+    'workflows': {
+        'simulate_install':
+            'p.cloudify.tests.test_simulator.simulate_install'
+    }
+}
+
+
+class TestSimulator(testtools.TestCase):
+    def setUp(self):
+        super(TestSimulator, self).setUp()
+        self.graph = TaskDependencyGraph(MockWorkflowContext())
+
+    def _simulate(self, durations=None, **kwargs):
+        kwargs.setdefault('poll_interval', 0)
+        return Simulator(DurationModel(durations), **kwargs).run(self.graph)
+
+    def test_empty(self):
+        result = self._simulate()
+        self.assertEqual(0, result.makespan)
+        self.assertEqual([], result.critical_path)
+
+    def test_sequence(self):
+        seq = self.graph.sequence()
+        seq.add(_operation('create'), _local_task('set_state'),
+                _operation('start'))
+        result = self._simulate({'create': 10, 'start': 5, 'set_state': 1})
+        self.assertEqual(16, result.makespan)
+        self.assertEqual(['create', 'set_state', 'start'],
+                         [t['name'] for t in result.critical_path])
+        self.assertEqual(2, result.agents['host1']['tasks'])
+        self.assertEqual(1, result.agents[LOCAL_TASKS]['tasks'])
+
+    def test_critical_path(self):
+        slow, fast, last = (_operation('slow'), _operation('fast'),
+                            _operation('last'))
+        for task in [slow, fast, last]:
+            self.graph.add_task(task)
+        self.graph.add_dependency(last, slow)
+        self.graph.add_dependency(last, fast)
+        result = self._simulate({'slow': 10, 'fast': 1, 'last': 1},
+                                agent_concurrency=None)
+        self.assertEqual(11, result.makespan)
+        self.assertEqual(['slow', 'last'],
+                         [t['name'] for t in result.critical_path])
+        self.assertEqual(2, result.agents['host1']['peak_in_flight'])
+
+    def test_agent_concurrency(self):
+        for _ in range(10):
+            self.graph.add_task(_operation('create'))
+        self.graph.add_task(_operation('create', host='host2'))
+        result = self._simulate({'create': 2}, agent_concurrency=3)
+        # 10 operations, 3 at a time
+        self.assertEqual(8, result.makespan)
+        self.assertEqual(10, result.agents['host1']['peak_in_flight'])
+        self.assertEqual(7, result.agents['host1']['peak_queued'])
+        self.assertEqual(1, result.agents['host2']['peak_in_flight'])
+
+    def test_agents_concurrency(self):
+        for _ in range(4):
+            self.graph.add_task(_operation('create'))
+        result = self._simulate({'create': 1}, agent_concurrency=1,
+                                agents_concurrency={'host1': 2})
+        self.assertEqual(2, result.makespan)
+
+    def test_local_task_threads(self):
+        for _ in range(4):
+            self.graph.add_task(_local_task('set_state'))
+        self.assertEqual(4, self._simulate(
+            {'set_state': 1}).makespan)
+        self.assertEqual(2, self._simulate(
+            {'set_state': 1}, local_task_threads=2).makespan)
+
+    def test_subgraphs(self):
+        subgraph1 = self.graph.subgraph('subgraph1')
+        subgraph1.sequence().add(_operation('create'), _operation('start'))
+        subgraph2 = self.graph.subgraph('subgraph2')
+        configure = _operation('configure', host='host2')
+        subgraph2.add_task(configure)
+        self.graph.add_dependency(subgraph2, subgraph1)
+        result = self._simulate({'create': 1, 'start': 2, 'configure': 4})
+        self.assertEqual(7, result.makespan)
+        self.assertEqual(['create', 'start', 'configure'],
+                         [t['name'] for t in result.critical_path])
+
+    def test_poll_interval(self):
+        seq = self.graph.sequence()
+        seq.add(_operation('create'), tasks.NOPLocalWorkflowTask(None),
+                _operation('start'))
+        result = self._simulate({'create': 0.25, 'start': 0.25},
+                                poll_interval=0.1)
+        # create is noticed at 0.3, the NOP task at 0.4,
+        # and start is sent at 0.4 and noticed at 0.7
+        self.assertAlmostEqual(0.7, result.makespan)
+
+    def test_distributions(self):
+        for _ in range(10):
+            self.graph.add_task(_operation('create'))
+        durations = {'create': uniform(1, 2)}
+        result1 = Simulator(DurationModel(durations, seed=1),
+                            agent_concurrency=1).run(self.graph)
+        result2 = Simulator(DurationModel(durations, seed=1),
+                            agent_concurrency=1).run(self.graph)
+        self.assertEqual(result1.makespan, result2.makespan)
+        self.assertTrue(10 <= result1.makespan <= 20.1)
+
+    def test_empirical(self):
+        self.graph.add_task(_operation('create'))
+        result = self._simulate({'create': empirical([3])})
+        self.assertEqual(3, result.makespan)
+
+    def test_graph_not_changed(self):
+        task = _operation('create')
+        self.graph.add_task(task)
+        self._simulate()
+        self.assertEqual([task], list(self.graph.tasks_iter()))
+        self.assertEqual(tasks.TASK_PENDING, task.get_state())
+
+    def test_to_dict(self):
+        self.graph.add_task(_operation('create'))
+        result = self._simulate({'create': 3}).to_dict()
+        self.assertEqual(3, result['makespan'])
+        self.assertEqual(1, result['tasks'])
+        self.assertEqual(1.0 / 5, result['agents']['host1']['utilization'])
+
+
+class TestLifecycleGraph(testtools.TestCase):
+    def setUp(self):
+        super(TestLifecycleGraph, self).setUp()
+        blueprint_dir = tempfile.mkdtemp(prefix='simulator-test-')
+        self.addCleanup(shutil.rmtree, blueprint_dir)
+        blueprint_path = os.path.join(blueprint_dir, 'blueprint.yaml')
+        with open(blueprint_path, 'w') as f:
+            yaml.safe_dump(SIMULATED_BLUEPRINT, f)
+        self.env = local.init_env(blueprint_path, name=self._testMethodName)
+
+    def _states(self):
+        return dict((instance.id, instance.state)
+                    for instance in self.env.storage.get_node_instances())
+
+    def test_install(self):
+        states = self._states()
+        result = self.env.execute('simulate_install', task_retries=0)
+        # the context is switched back from graph mode
+        self.assertFalse(result['graph_mode'])
+        self.assertGreater(result['tasks'], 0)
+        # node2 is created after node1 is, so the creates don't overlap
+        self.assertGreaterEqual(result['makespan'], 4)
+        # nothing was executed
+        self.assertEqual(states, self._states())
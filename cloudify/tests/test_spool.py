@@ -0,0 +1,177 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from cloudify import spool as spool_module
+from cloudify.spool import Spool
+
+
+class TestSpool(testtools.TestCase):
+    def setUp(self):
+        super(TestSpool, self).setUp()
+        self.directory = tempfile.mkdtemp(prefix='spool-test-')
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def _spool(self, **kwargs):
+        spool = Spool(os.path.join(self.directory, 'spool'), **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def _segments(self, spool):
+        return sorted(name for name in os.listdir(spool.directory)
+                      if name.endswith(spool_module.SEGMENT_SUFFIX))
+
+    def test_fifo(self):
+        spool = self._spool()
+        for i in range(5):
+            spool.append({'id': i})
+        self.assertEqual([{'id': 0}, {'id': 1}], spool.read(2))
+        # not committed, so read again
+        self.assertEqual([{'id': 0}], spool.read(1))
+        spool.commit(1)
+        self.assertEqual(4, len(spool))
+        self.assertEqual([{'id': i} for i in range(1, 5)], spool.read(10))
+        spool.append({'id': 5})
+        spool.commit(4)
+        self.assertEqual([{'id': 5}], spool.read(10))
+
+    def test_segments(self):
+        """Segments that were read to the end are deleted"""
+        spool = self._spool(segment_bytes=20)
+        for i in range(6):
+            spool.append({'id': i})
+        segments = self._segments(spool)
+        self.assertEqual(3, len(segments))
+        self.assertEqual([{'id': i} for i in range(6)], spool.read(10))
+        spool.commit(3)
+        self.assertEqual(segments[1:], self._segments(spool))
+        self.assertEqual([{'id': 3}, {'id': 4}, {'id': 5}], spool.read(10))
+        spool.commit(3)
+        # once it's all committed, the spool starts over
+        self.assertEqual([], self._segments(spool))
+        spool.append({'id': 6})
+        self.assertEqual([{'id': 6}], spool.read(10))
+
+    def test_full(self):
+        spool = self._spool(max_bytes=25)
+        self.assertTrue(spool.append({'id': 0}))
+        self.assertTrue(spool.append({'id': 1}))
+        self.assertFalse(spool.append({'id': 2}))
+        self.assertEqual(1, spool.dropped)
+        spool.read(2)
+        spool.commit(2)
+        self.assertEqual(0, spool.dropped)
+        self.assertTrue(spool.append({'id': 3}))
+
+    def test_close(self):
+        """The directory is only removed if everything was committed"""
+        spool = self._spool()
+        spool.append({'id': 0})
+        spool.read(1)
+        spool.commit(1)
+        self.assertTrue(spool.close())
+        self.assertFalse(os.path.exists(spool.directory))
+
+    def test_close_pending(self):
+        spool = self._spool()
+        spool.append({'id': 0})
+        self.assertFalse(spool.close())
+        self.assertEqual(1, len(self._segments(spool)))
+
+    def test_reopen(self):
+        """The read position is kept on disk"""
+        spool = self._spool(segment_bytes=20)
+        for i in range(5):
+            spool.append({'id': i})
+        spool.read(3)
+        spool.commit(3)
+        spool.append({'id': 5})
+        reopened = Spool(spool.directory)
+        self.assertEqual(3, len(reopened))
+        self.assertEqual([{'id': 3}, {'id': 4}, {'id': 5}],
+                         reopened.read(10))
+
+    def test_unfinished_line(self):
+        """A line that a process didn't finish writing is skipped"""
+        spool = self._spool()
+        spool.append({'id': 0})
+        with open(os.path.join(spool.directory,
+                               self._segments(spool)[-1]), 'ab') as f:
+            f.write(b'{"id"')
+        reopened = Spool(spool.directory)
+        self.assertEqual(1, len(reopened))
+        reopened.append({'id': 1})
+        self.assertEqual(2, len(self._segments(reopened)))
+        self.assertEqual([{'id': 0}, {'id': 1}], reopened.read(10))
+        reopened.commit(2)
+        self.assertEqual([], self._segments(reopened))
+
+
+@testtools.skipIf(spool_module.fcntl is None, 'spools are not locked')
+class TestClaimAbandoned(testtools.TestCase):
+    def setUp(self):
+        super(TestClaimAbandoned, self).setUp()
+        self.root = tempfile.mkdtemp(prefix='spool-test-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def _claim(self, **kwargs):
+        spools = spool_module.claim_abandoned(self.root, **kwargs)
+        for spool in spools:
+            self.addCleanup(spool.close)
+        return spools
+
+    def test_claim(self):
+        with mock.patch('time.time', side_effect=[1, 2]):
+            first = spool_module.create(self.root)
+            second = spool_module.create(self.root)
+        for i in range(3):
+            first.append({'id': i})
+            second.append({'id': 10 + i})
+        first.read(1)
+        first.commit(1)
+        # held by the spools' owner, which didn't exit yet
+        self.assertEqual([], self._claim())
+        first.close()
+        second.close()
+        claimed = self._claim()
+        self.assertEqual([first.directory, second.directory],
+                         [spool.directory for spool in claimed])
+        self.assertEqual([{'id': 1}, {'id': 2}], claimed[0].read(10))
+        # claimed by this one now
+        self.assertEqual([], self._claim())
+
+    def test_exclude(self):
+        own = spool_module.create(self.root)
+        own.append({'id': 0})
+        own.close()
+        self.assertEqual([], self._claim(exclude=own.directory))
+        self.assertEqual(1, len(self._claim()))
+
+    def test_removed(self):
+        """Once everything is committed, the spool is removed"""
+        spool = spool_module.create(self.root)
+        spool.append({'id': 0})
+        spool.close()
+        claimed, = self._claim()
+        claimed.read(1)
+        claimed.commit(1)
+        self.assertTrue(claimed.close())
+        self.assertEqual([], os.listdir(self.root))
@@ -0,0 +1,189 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+
+import mock
+import testtools
+
+from cloudify import exceptions
+from cloudify._compat import queue
+from cloudify.workflows import tasks
+from cloudify.workflows.timings import NullTimings
+from cloudify.workflows.workflow_context import (LocalTasksProcessing,
+                                                 _AsyncResult)
+
+
+class _WorkflowContext(object):
+    """Runs local tasks in a real thread pool, outside of graph mode"""
+
+    def __init__(self, processor):
+        self.internal = mock.Mock(graph_mode=False, timings=NullTimings())
+        self.internal.add_local_task = processor.add_task
+
+
+class _TaskResultsTestBase(testtools.TestCase):
+    def setUp(self):
+        super(_TaskResultsTestBase, self).setUp()
+        processor = LocalTasksProcessing(
+            mock.Mock(local=True), thread_pool_size=5)
+        processor.start()
+        self.addCleanup(processor.stop)
+        self.ctx = _WorkflowContext(processor)
+
+    def _execute(self, func, **kwargs):
+        kwargs.setdefault('retry_interval', 0)
+        task = tasks.LocalWorkflowTask(func, self.ctx, **kwargs)
+        return task.apply_async()
+
+
+class TestWorkflowTaskResult(_TaskResultsTestBase):
+    def test_get(self):
+        result = self._execute(lambda: 42)
+        self.assertEqual(42, result.get())
+        self.assertTrue(result.done())
+        # the result is kept, the task is not handled again
+        self.assertEqual(42, result.get())
+        task_graph = self.ctx.internal.task_graph
+        self.assertEqual(1, task_graph.remove_task.call_count)
+
+    def test_get_retried(self):
+        calls = []
+
+        def _retried():
+            calls.append(True)
+            if len(calls) < 3:
+                raise exceptions.OperationRetry(retry_after=0)
+            return len(calls)
+
+        self.assertEqual(3, self._execute(_retried).get())
+
+    def test_get_failed(self):
+        def _failing():
+            raise exceptions.NonRecoverableError('x')
+
+        result = self._execute(_failing)
+        self.assertRaises(exceptions.NonRecoverableError, result.get)
+        self.assertTrue(result.done())
+        self.assertRaises(exceptions.NonRecoverableError, result.get)
+
+    def test_on_terminated(self):
+        called = []
+        task = tasks.NOPLocalWorkflowTask(self.ctx)
+        task.on_terminated(called.append)
+        self.assertEqual([], called)
+        task.set_state(tasks.TASK_SUCCEEDED)
+        self.assertEqual([task], called)
+        # already terminated: called right away
+        task.on_terminated(called.append)
+        self.assertEqual([task, task], called)
+
+    def test_on_terminated_error(self):
+        """A failing callback doesn't keep the others from being called"""
+        called = []
+        task = tasks.NOPLocalWorkflowTask(self.ctx)
+        task.on_terminated(lambda _: 1 / 0)
+        task.on_terminated(called.append)
+        task.set_state(tasks.TASK_SUCCEEDED)
+        self.assertEqual([task], called)
+        self.assertTrue(task.is_terminated)
+
+    def test_wait_for_terminated(self):
+        task = tasks.NOPLocalWorkflowTask(self.ctx)
+        self.assertRaises(queue.Empty, task.wait_for_terminated, timeout=0)
+        self.assertRaises(queue.Empty, task.terminated.get_nowait)
+        self.assertTrue(task.terminated.empty())
+        task.set_state(tasks.TASK_SUCCEEDED)
+        task.wait_for_terminated(timeout=0)
+        self.assertTrue(task.terminated.get(timeout=0))
+        self.assertFalse(task.terminated.empty())
+
+
+class TestWaitHelpers(_TaskResultsTestBase):
+    def test_wait_all(self):
+        results = [self._execute(lambda i=i: i * 2) for i in range(10)]
+        self.assertEqual([i * 2 for i in range(10)], tasks.wait_all(results))
+
+    def test_as_completed_order(self):
+        release = threading.Event()
+        slow = self._execute(lambda: release.wait(5))
+        fast = self._execute(lambda: 'fast')
+        completed = tasks.as_completed([slow, fast])
+        self.assertIs(fast, next(completed))
+        release.set()
+        self.assertIs(slow, next(completed))
+        self.assertEqual([], list(completed))
+
+    def test_as_completed_retries(self):
+        calls = []
+
+        def _retried():
+            calls.append(True)
+            if len(calls) < 2:
+                raise exceptions.OperationRetry(retry_after=0)
+            return 'retried'
+
+        result = self._execute(_retried)
+        self.assertEqual([result], list(tasks.as_completed([result])))
+        self.assertEqual('retried', result.get())
+        self.assertEqual(2, len(calls))
+
+    def test_wait_all_failed(self):
+        def _failing():
+            raise exceptions.NonRecoverableError('x')
+
+        release = threading.Event()
+        failing = self._execute(_failing)
+        slow = self._execute(lambda: release.wait(5) or 'slow')
+        threading.Timer(0.1, release.set).start()
+        self.assertRaises(exceptions.NonRecoverableError,
+                          tasks.wait_all, [failing, slow])
+        # the error was only raised after the other task was done too
+        self.assertTrue(slow.done())
+
+    def test_wait_any(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow = self._execute(lambda: release.wait(5))
+        fast = self._execute(lambda: 'fast')
+        self.assertIs(fast, tasks.wait_any([slow, fast]))
+        self.assertIsNone(tasks.wait_any([]))
+
+    def test_graph_mode(self):
+        task = tasks.NOPLocalWorkflowTask(mock.Mock())
+        task.workflow_context.internal.graph_mode = True
+        result = tasks.LocalWorkflowTaskResult(task)
+        self.assertRaises(RuntimeError, list, tasks.as_completed([result]))
+
+    def test_cancelled(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        result = self._execute(lambda: release.wait(5))
+        with mock.patch('cloudify.workflows.api.has_cancel_request',
+                        return_value=True):
+            self.assertRaises(tasks.api.ExecutionCancelled,
+                              tasks.wait_all, [result])
+
+
+class TestAsyncResult(testtools.TestCase):
+    def test_set_result(self):
+        result = _AsyncResult(mock.Mock())
+        threading.Timer(0.05, result.set_result, args=(42,)).start()
+        self.assertEqual(42, result.get())
+
+    def test_set_error(self):
+        result = _AsyncResult(mock.Mock())
+        result.set_result(RuntimeError('x'), error=True)
+        self.assertRaises(RuntimeError, result.get)
@@ -21,6 +21,7 @@ from contextlib import contextmanager
 from cloudify.workflows import api
 from cloudify.workflows import tasks
 from cloudify.workflows.tasks_graph import TaskDependencyGraph
+from cloudify.workflows.workflow_context import _TaskDispatcher
 
 
 @contextmanager
@@ -47,6 +48,7 @@ def limited_sleep_mock(limit=100):
 
 class MockWorkflowContext(object):
     wait_after_fail = 600
+    internal = mock.MagicMock()
 
 
 class TestTasksGraphExecute(testtools.TestCase):
@@ -173,3 +175,48 @@ class TestTasksGraphExecute(testtools.TestCase):
 
         self.assertFalse(task.apply_async.called)
         self.assertFalse(task.cancel.called)
+
+
+class TestTaskDispatcherBatch(testtools.TestCase):
+    def _make_task(self, task_id, target):
+        return {
+            'id': task_id,
+            'queue': target,
+            'target': target,
+            'task': {'id': task_id},
+            'handler': mock.Mock(),
+            'client': mock.Mock()
+        }
+
+    def _send(self, dispatcher, task):
+        with mock.patch('cloudify.workflows.workflow_context.is_agent_alive',
+                        return_value=True):
+            dispatcher.send_task(None, task)
+
+    def test_send_without_batch(self):
+        dispatcher = _TaskDispatcher()
+        task = self._make_task('t1', 'agent1')
+        self._send(dispatcher, task)
+        task['handler'].publish.assert_called_once_with(
+            {'id': 't1'}, routing_key='operation', correlation_id='t1')
+
+    def test_batch_per_agent(self):
+        dispatcher = _TaskDispatcher()
+        t1 = self._make_task('t1', 'agent1')
+        t2 = self._make_task('t2', 'agent1')
+        t3 = self._make_task('t3', 'agent2')
+        with dispatcher.batch():
+            for task in [t1, t2, t3]:
+                self._send(dispatcher, task)
+            # nothing is sent before the batch is done
+            for task in [t1, t2, t3]:
+                self.assertFalse(task['handler'].publish.called)
+                self.assertFalse(task['handler'].publish_batch.called)
+
+        t1['handler'].publish_batch.assert_called_once_with(
+            [({'id': 't1'}, 't1'), ({'id': 't2'}, 't2')],
+            routing_key='operation')
+        self.assertFalse(t2['handler'].publish_batch.called)
+        # a single task for an agent is sent as a regular message
+        t3['handler'].publish.assert_called_once_with(
+            {'id': 't3'}, routing_key='operation', correlation_id='t3')
@@ -0,0 +1,63 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+from testtools import TestCase
+
+from cloudify.workflows.timings import ExecutionTimings, NullTimings
+
+
+class TestExecutionTimings(TestCase):
+    def test_summary(self):
+        timings = ExecutionTimings()
+        timings.add('task_send', 1, task_name='op1')
+        timings.add('task_send', 3, task_name='op1')
+        timings.add('task_send', 2, task_name='op2')
+        timings.add('graph_build', 0.5)
+        summary = timings.summary()
+        self.assertEqual(
+            {'count': 3, 'total': 6, 'avg': 2, 'max': 3},
+            summary['phases']['task_send'])
+        self.assertEqual(1, summary['phases']['graph_build']['count'])
+        self.assertEqual(
+            {'count': 2, 'total': 4, 'avg': 2, 'max': 3},
+            summary['tasks']['op1']['task_send'])
+        self.assertEqual(['op1', 'op2'], sorted(summary['tasks']))
+
+    def test_summary_top_tasks(self):
+        timings = ExecutionTimings()
+        for duration, name in enumerate(['op1', 'op2', 'op3']):
+            timings.add('local_task', duration, task_name=name)
+        summary = timings.summary(top_tasks=2)
+        self.assertEqual(['op2', 'op3'], sorted(summary['tasks']))
+
+    def test_measure(self):
+        timings = ExecutionTimings()
+        with timings.measure('graph_execute'):
+            pass
+        self.assertRaises(RuntimeError, self._measure_failing, timings)
+        self.assertEqual(
+            2, timings.summary()['phases']['graph_execute']['count'])
+
+    def _measure_failing(self, timings):
+        with timings.measure('graph_execute'):
+            raise RuntimeError()
+
+    def test_null_timings(self):
+        timings = NullTimings()
+        timings.add('task_send', 1)
+        with timings.measure('graph_execute'):
+            pass
+        self.assertFalse(timings.enabled)
+        self.assertIsNone(timings.summary())
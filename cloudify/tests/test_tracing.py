@@ -0,0 +1,184 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+import pika
+import testtools
+
+from cloudify import amqp_client, tracing
+from cloudify.workflows.workflow_context import _TaskDispatcher
+
+
+def _read_events(path):
+    with open(path) as f:
+        content = f.read()
+    # the array is left unterminated, so that it can be appended to
+    return json.loads(content.rstrip().rstrip(',') + ']')
+
+
+def _spans(events):
+    return [e for e in events if e['ph'] in ('X', 'b')]
+
+
+class _TracingTestBase(testtools.TestCase):
+    def setUp(self):
+        super(_TracingTestBase, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.trace_file = os.path.join(tempdir, 'trace.json')
+        self.tracer = tracing.Tracer(self.trace_file)
+        self.addCleanup(self.tracer.close)
+        patcher = mock.patch('cloudify.tracing._tracer', self.tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def events(self):
+        self.tracer.close()
+        return _read_events(self.trace_file)
+
+
+class TestTracer(_TracingTestBase):
+    def test_nested_spans(self):
+        with tracing.span('outer') as outer:
+            with tracing.span('inner', category='rest', url='/x') as inner:
+                pass
+        self.assertEqual(outer.context.trace_id, inner.context.trace_id)
+        spans = dict((e['name'], e) for e in _spans(self.events()))
+        self.assertEqual('X', spans['inner']['ph'])
+        self.assertEqual('rest', spans['inner']['cat'])
+        self.assertEqual('/x', spans['inner']['args']['url'])
+        self.assertEqual(outer.context.span_id,
+                         spans['inner']['args']['parent_id'])
+        self.assertIsNone(spans['outer']['args']['parent_id'])
+        self.assertLessEqual(spans['outer']['ts'], spans['inner']['ts'])
+
+    def test_explicit_parent(self):
+        parent = tracing.SpanContext('trace1', 'span1')
+        with tracing.span('child', parent=parent) as child:
+            pass
+        self.assertEqual('trace1', child.context.trace_id)
+        span = _spans(self.events())[0]
+        self.assertEqual('span1', span['args']['parent_id'])
+
+    def test_async_span(self):
+        span = tracing.start_span('task', category='task')
+        span.finish(error=True)
+        span.finish()
+        events = [e for e in self.events() if e['ph'] != 'M']
+        self.assertEqual(['b', 'e'], [e['ph'] for e in events])
+        self.assertEqual(events[0]['id'], events[1]['id'])
+        self.assertTrue(events[0]['args']['error'])
+
+    def test_error(self):
+        def _failing():
+            with tracing.span('failing'):
+                raise RuntimeError('x')
+        self.assertRaises(RuntimeError, _failing)
+        self.assertIn('RuntimeError',
+                      _spans(self.events())[0]['args']['error'])
+
+    def test_default_parent(self):
+        children = []
+
+        def _in_thread():
+            with tracing.span('child') as child:
+                children.append(child)
+
+        with tracing.span('task', default=True) as task:
+            thread = threading.Thread(target=_in_thread)
+            thread.start()
+            thread.join()
+        self.assertEqual(task.context.trace_id, children[0].context.trace_id)
+        self.assertIsNone(self.tracer.current())
+
+    def test_append(self):
+        with tracing.span('first'):
+            pass
+        self.tracer.close()
+        other = tracing.Tracer(self.trace_file)
+        with other.span('second'):
+            pass
+        other.close()
+        self.assertEqual(['first', 'second'],
+                         [e['name'] for e in _spans(self.events())])
+
+
+class TestNullTracer(testtools.TestCase):
+    def test_null_tracer(self):
+        tracer = tracing.NullTracer()
+        with tracer.span('x') as span:
+            self.assertIsNone(span.context)
+        tracer.start_span('y').finish()
+        self.assertIsNone(tracer.current())
+
+
+class TestPropagation(_TracingTestBase):
+    def test_context_roundtrip(self):
+        context = tracing.SpanContext('trace1', 'span1')
+        self.assertEqual(
+            context, tracing.SpanContext.from_dict(context.to_dict()))
+        self.assertEqual(
+            context, tracing.SpanContext.from_headers(context.to_headers()))
+        self.assertIsNone(tracing.SpanContext.from_dict(None))
+        self.assertIsNone(tracing.SpanContext.from_headers(None))
+
+    def test_task_sent_with_trace(self):
+        dispatcher = _TaskDispatcher()
+        workflow_task = mock.Mock()
+        workflow_task.name = 'plugin.op'
+        cloudify_context = {}
+        task = {
+            'id': 't1',
+            'queue': 'agent1',
+            'target': 'agent1',
+            'task': {'cloudify_task': {'kwargs': {
+                '__cloudify_context': cloudify_context}}},
+            'handler': mock.Mock(),
+            'client': mock.Mock()
+        }
+        with mock.patch('cloudify.workflows.workflow_context.is_agent_alive',
+                        return_value=True):
+            with tracing.span('workflow') as workflow:
+                dispatcher.send_task(workflow_task, task)
+
+        sent = tracing.SpanContext.from_dict(
+            cloudify_context[tracing.TRACE_KEY])
+        self.assertEqual(workflow.context.trace_id, sent.trace_id)
+        self.assertEqual(task['span'].context, sent)
+        _, kwargs = task['handler'].publish.call_args
+        self.assertEqual(sent.to_headers(), kwargs['headers'])
+
+    def test_consumer_continues_trace(self):
+        handled_in = []
+
+        class _Consumer(amqp_client.TaskConsumer):
+            def handle_task(self, full_task):
+                handled_in.append(tracing.current())
+                return {'ok': True}
+
+        consumer = _Consumer('agent1')
+        consumer._connection = mock.Mock()
+        parent = tracing.SpanContext('trace1', 'span1')
+        properties = pika.BasicProperties(headers=parent.to_headers())
+        consumer._process_message(mock.Mock(), properties, {}, 1)
+        self.assertEqual('trace1', handled_in[0].trace_id)
+        span = _spans(self.events())[0]
+        self.assertEqual('span1', span['args']['parent_id'])
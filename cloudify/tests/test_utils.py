@@ -14,6 +14,8 @@
 #    * limitations under the License.
 
 import os
+import copy
+import json
 import mock
 import shutil
 import logging
@@ -190,6 +192,49 @@ class TestPluginInstallationTaskExecutionFuncs(TestCase):
         self.sequence_mock.add.assert_called_with('send_event', 'execute_task')
 
 
+class TestFreeze(TestCase):
+    def test_freeze_nested(self):
+        value = {'a': [1, {'b': 2}], 'c': 'd'}
+        frozen = utils.freeze(value)
+        self.assertEqual(value, frozen)
+        self.assertIsInstance(frozen, utils.FrozenDict)
+        self.assertIsInstance(frozen['a'], utils.FrozenList)
+        self.assertIsInstance(frozen['a'][1], utils.FrozenDict)
+        self.assertEqual(json.dumps(value, sort_keys=True),
+                         json.dumps(frozen, sort_keys=True))
+
+    def test_frozen_is_isolated(self):
+        value = {'a': [1]}
+        frozen = utils.freeze(value)
+        value['a'].append(2)
+        value['b'] = 3
+        self.assertEqual({'a': [1]}, frozen)
+
+    def test_frozen_is_read_only(self):
+        frozen = utils.freeze({'a': [1]})
+        self.assertRaises(TypeError, frozen.__setitem__, 'b', 1)
+        self.assertRaises(TypeError, frozen.update, {'b': 1})
+        self.assertRaises(TypeError, frozen.pop, 'a')
+        self.assertRaises(TypeError, frozen['a'].append, 2)
+        self.assertRaises(TypeError, frozen['a'].__setitem__, 0, 2)
+
+    def test_freeze_frozen_is_shared(self):
+        frozen = utils.freeze({'a': [1]})
+        self.assertIs(frozen, utils.freeze(frozen))
+        self.assertIs(frozen['a'], utils.freeze({'x': frozen})['x']['a'])
+
+    def test_copy_is_mutable(self):
+        frozen = utils.freeze({'a': [1, {'b': 2}]})
+        copied = copy.deepcopy(frozen)
+        self.assertEqual(frozen, copied)
+        self.assertIs(type(copied), dict)
+        self.assertIs(type(copied['a']), list)
+        self.assertIs(type(copied['a'][1]), dict)
+        copied['a'][1]['b'] = 3
+        self.assertEqual(2, frozen['a'][1]['b'])
+        self.assertIs(type(copy.copy(frozen)), dict)
+
+
 class TestRestUtils(object):
     def test_get_folder_size_and_files(self):
         temp_dir = tempfile.mkdtemp()
@@ -0,0 +1,289 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Lightweight tracing of tasks, across processes.
+
+A span is a timed piece of work, eg. a workflow, sending a task, handling
+it on the agent, running the operation subprocess, or a REST call. Spans
+have a trace id, shared by all the spans of the same trace, and a span id;
+every span knows the id of its parent. The ids of the current span are
+passed on in the cloudify context (under TRACE_KEY) and in AMQP message
+headers, so that spans in other processes join the same trace.
+
+Spans are only recorded when the CLOUDIFY_TRACE_FILE environment variable
+is set. The file gets the spans in the Chrome trace event format, which
+chrome://tracing and Perfetto can open. The path can contain {pid}, but
+several processes can also share the same file: events are appended, and
+the JSON array is left unterminated, which the viewers accept.
+"""
+
+import binascii
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+TRACE_FILE_ENV = 'CLOUDIFY_TRACE_FILE'
+
+# the cloudify context key, and the AMQP headers, carrying the span ids
+TRACE_KEY = 'trace'
+TRACE_ID_HEADER = 'cloudify-trace-id'
+SPAN_ID_HEADER = 'cloudify-span-id'
+
+
+def _new_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+def _now_us():
+    return int(time.time() * 1e6)
+
+
+class SpanContext(namedtuple('SpanContext', 'trace_id span_id')):
+    """Ids of a span, which are passed on to its children"""
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict) or not data.get('trace_id'):
+            return None
+        return cls(data['trace_id'], data.get('span_id'))
+
+    def to_headers(self):
+        return {TRACE_ID_HEADER: self.trace_id,
+                SPAN_ID_HEADER: self.span_id}
+
+    @classmethod
+    def from_headers(cls, headers):
+        if not isinstance(headers, dict) or \
+                not headers.get(TRACE_ID_HEADER):
+            return None
+        return cls(headers[TRACE_ID_HEADER], headers.get(SPAN_ID_HEADER))
+
+
+class Span(object):
+    """A recorded span. Call .finish() when its work is done.
+
+    Spans used as context managers (see Tracer.span) are recorded as
+    happening on the thread that ran them. Other spans can be finished
+    on any thread, and are recorded as async events.
+    """
+    __slots__ = ('_tracer', 'name', 'category', 'context', 'parent_id',
+                 'start', 'args', 'thread_id', '_finished')
+
+    def __init__(self, tracer, name, category, parent, args):
+        self._tracer = tracer
+        self.name = name
+        self.category = category
+        self.context = SpanContext(
+            parent.trace_id if parent else _new_id(16), _new_id(8))
+        self.parent_id = parent.span_id if parent else None
+        self.args = args
+        self.thread_id = None
+        self.start = _now_us()
+        self._finished = False
+
+    def finish(self, **args):
+        if self._finished:
+            return
+        self._finished = True
+        self.args.update(args)
+        self._tracer._record(self, _now_us())
+
+
+class _NullSpan(object):
+    context = None
+
+    def finish(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Records spans to a Chrome trace file"""
+    enabled = True
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._local = threading.local()
+        self._seen_threads = set()
+        # the span that threads without a current span of their own use
+        # as the parent, eg. the operation, for calls from the ctx proxy
+        self._default = None
+
+    def current(self):
+        """Context of the current span of this thread, if any"""
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            return stack[-1].context
+        if self._default is not None:
+            return self._default.context
+        return None
+
+    def start_span(self, name, category='cloudify', parent=None, **args):
+        """Start a span, which is a child of parent, or of the current span
+
+        :param parent: a SpanContext
+        :param args: additional data to record
+        """
+        return Span(self, name, category, parent or self.current(), args)
+
+    @contextmanager
+    def span(self, name, category='cloudify', parent=None, default=False,
+             **args):
+        """A span of the work done in this block, on this thread.
+
+        :param default: make this the parent of spans started by threads
+                        that have no current span, while the block runs
+        """
+        span = self.start_span(name, category, parent, **args)
+        span.thread_id = threading.current_thread().ident
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+        if default:
+            previous_default, self._default = self._default, span
+        try:
+            yield span
+        except BaseException as e:
+            span.args['error'] = repr(e)
+            raise
+        finally:
+            if default:
+                self._default = previous_default
+            stack.pop()
+            span.finish()
+
+    def _events(self, span, end):
+        args = dict(span.args,
+                    trace_id=span.context.trace_id,
+                    span_id=span.context.span_id,
+                    parent_id=span.parent_id)
+        event = {'name': span.name, 'cat': span.category,
+                 'pid': os.getpid(), 'args': args}
+        if span.thread_id is not None:
+            event.update(ph='X', ts=span.start, dur=end - span.start,
+                         tid=span.thread_id)
+            return [event]
+        async_end = dict(event, ph='e', ts=end, id=span.context.span_id,
+                         tid=0)
+        event.update(ph='b', ts=span.start, id=span.context.span_id, tid=0)
+        del async_end['args']
+        return [event, async_end]
+
+    def _metadata(self, thread):
+        """Names of the process and the thread, the first time they're seen
+
+        :param thread: the thread that ran the span, if it was synchronous
+        """
+        events = []
+        if not self._seen_threads:
+            self._seen_threads.add(0)
+            events.append({'name': 'process_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': 0,
+                           'args': {'name': ' '.join(sys.argv[:2])}})
+        if thread is not None and thread.ident not in self._seen_threads:
+            self._seen_threads.add(thread.ident)
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': thread.ident,
+                           'args': {'name': thread.name}})
+        return events
+
+    def _open(self):
+        try:
+            fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            # the file exists already, possibly written by another process
+            return open(self._path, 'a')
+        trace_file = os.fdopen(fd, 'w')
+        trace_file.write('[\n')
+        return trace_file
+
+    def _record(self, span, end):
+        events = self._events(span, end)
+        with self._lock:
+            thread = threading.current_thread() \
+                if span.thread_id is not None else None
+            events = self._metadata(thread) + events
+            if self._file is None:
+                self._file = self._open()
+            self._file.write(''.join(json.dumps(event) + ',\n'
+                                     for event in events))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class NullTracer(object):
+    """Used when tracing is disabled: nothing is recorded or passed on"""
+    enabled = False
+
+    def current(self):
+        return None
+
+    def start_span(self, name, category='cloudify', parent=None, **args):
+        return _NULL_SPAN
+
+    @contextmanager
+    def span(self, name, category='cloudify', parent=None, default=False,
+             **args):
+        yield _NULL_SPAN
+
+    def close(self):
+        pass
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """The tracer of this process, as configured by the environment"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                path = os.environ.get(TRACE_FILE_ENV)
+                if path:
+                    _tracer = Tracer(path.format(pid=os.getpid()))
+                else:
+                    _tracer = NullTracer()
+    return _tracer
+
+
+def current():
+    return get_tracer().current()
+
+
+def start_span(name, category='cloudify', parent=None, **args):
+    return get_tracer().start_span(name, category, parent, **args)
+
+
+def span(name, category='cloudify', parent=None, default=False, **args):
+    return get_tracer().span(name, category, parent, default, **args)
@@ -15,6 +15,7 @@
 
 import os
 import ssl
+import copy
 import sys
 import time
 import pika
@@ -36,7 +37,7 @@ from dsl_parser.constants import PLUGIN_INSTALL_KEY, PLUGIN_NAME_KEY
 
 from cloudify import constants
 from cloudify.state import workflow_ctx, ctx
-from cloudify._compat import StringIO, parse_version
+from cloudify._compat import StringIO, parse_version, text_type
 from cloudify.constants import SUPPORTED_ARCHIVE_TYPES
 from cloudify.amqp_client import BlockingRequestResponseHandler
 from cloudify.exceptions import CommandExecutionException, NonRecoverableError
@@ -762,6 +763,71 @@ def wait_for(callable_obj,
         time.sleep(3)
 
 
+def _frozen_mutator(self, *args, **kwargs):
+    raise TypeError('{0} object is read-only'.format(type(self).__name__))
+
+
+class FrozenDict(dict):
+    """A read-only dict, which can be shared without being copied.
+
+    Mutating methods raise a TypeError. copy.copy and copy.deepcopy
+    return regular (mutable) dicts, so that code which needs to change
+    the data can always get its own copy.
+    """
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = \
+        setdefault = update = _frozen_mutator
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict((key, copy.deepcopy(value, memo))
+                    for key, value in self.items())
+
+    def __reduce__(self):
+        return self.__class__, (dict(self), )
+
+
+class FrozenList(list):
+    """A read-only list, the list counterpart of FrozenDict"""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = \
+        insert = pop = remove = reverse = sort = clear = _frozen_mutator
+    # python 2 slice assignment
+    __setslice__ = __delslice__ = _frozen_mutator
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in self]
+
+    def __reduce__(self):
+        return self.__class__, (list(self), )
+
+
+_IMMUTABLE_TYPES = (type(None), bool, int, float, bytes, text_type,
+                    FrozenDict, FrozenList)
+
+
+def freeze(value):
+    """Make a read-only copy of value, to be shared instead of deep-copied.
+
+    Plain dicts and lists are recursively converted to FrozenDict and
+    FrozenList, while immutable and already-frozen values are returned
+    as-is, so freezing a frozen value is free. Anything else is deep-copied.
+    """
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return value
+    value_type = type(value)
+    if value_type is dict:
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if value_type is list:
+        return FrozenList(freeze(item) for item in value)
+    if value_type is tuple:
+        return tuple(freeze(item) for item in value)
+    return copy.deepcopy(value)
+
+
 class OutputConsumer(object):
     def __init__(self, out, logger, prefix):
         self.out = out
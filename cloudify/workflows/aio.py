@@ -0,0 +1,176 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""asyncio workflows.
+
+A workflow function can be a coroutine function. It is then run in an
+event loop, in the workflow thread, and the results of the tasks that it
+runs can be awaited:
+
+    @workflow
+    async def my_workflow(ctx, **kwargs):
+        results = [instance.execute_operation('my.op')
+                   for instance in ctx.node_instances]
+        await asyncio.gather(*results)
+
+Awaiting a result doesn't block the loop: the task wakes the loop up
+when it terminates, and retries are scheduled on the loop, so that any
+number of tasks can be awaited at the same time.
+
+Async workflows don't use graph mode. The workflow context is available
+in the loop's thread, and in calls made using run_blocking, which is
+meant for blocking calls, eg. to the REST service.
+
+When the execution is cancelled, the workflow coroutine is cancelled,
+ie. asyncio.CancelledError is raised in it, so it can clean up.
+"""
+
+import time
+
+try:
+    import asyncio
+except ImportError:
+    # python 2
+    asyncio = None
+
+from cloudify.state import current_workflow_ctx
+from cloudify.workflows import api
+
+# how often to check for cancel requests, in seconds
+CANCEL_CHECK_INTERVAL = 1
+
+
+def iscoroutine(obj):
+    return asyncio is not None and asyncio.iscoroutine(obj)
+
+
+def result_future(result, loop=None):
+    """An asyncio future of a WorkflowTaskResult
+
+    The task is handled like WorkflowTaskResult.get does, including
+    retries, but without blocking the loop.
+    """
+    loop = loop or asyncio.get_event_loop()
+    future = loop.create_future()
+    _AwaitedResult(result, future, loop).watch()
+    return future
+
+
+class _AwaitedResult(object):
+    """Completes the future of a result, running on the loop's thread"""
+
+    def __init__(self, result, future, loop):
+        self._result = result
+        self._future = future
+        self._loop = loop
+
+    def watch(self):
+        if self._future.done():
+            # the future was cancelled: whoever waits for all the tasks
+            # at the end of the workflow will handle this one
+            return
+        if self._result.done():
+            self._complete()
+        elif self._result._retry_at is not None:
+            self._loop.call_later(
+                max(0, self._result._retry_at - time.time()), self._retry)
+        else:
+            task = self._result.task
+            task.on_terminated(lambda _: self._wake_up(task))
+
+    def _wake_up(self, task):
+        """Called by the thread that terminated the task"""
+        try:
+            self._loop.call_soon_threadsafe(self._terminated, task)
+        except RuntimeError:
+            # the loop was closed: the workflow is done already, and
+            # nothing is waiting for the task anymore
+            if not self._loop.is_closed():
+                raise
+
+    def _terminated(self, task):
+        if self._result.task is task and not self._result.done():
+            self._step(self._result._handle_terminated)
+
+    def _retry(self):
+        if not self._future.done():
+            self._step(self._result._retry)
+
+    def _step(self, func):
+        try:
+            func()
+        except Exception as e:
+            self._future.set_exception(e)
+        else:
+            self.watch()
+
+    def _complete(self):
+        try:
+            value = self._result.get()
+        except Exception as e:
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(value)
+
+
+def run_blocking(func, *args, **kwargs):
+    """Run a blocking function in a thread, not blocking the loop.
+
+    The function can use the workflow context.
+
+    :return: a future of the function's return value
+    """
+    loop = asyncio.get_event_loop()
+    ctx = current_workflow_ctx.get_ctx()
+    parameters = current_workflow_ctx.get_parameters()
+
+    def _with_ctx():
+        with current_workflow_ctx.push(ctx, parameters):
+            return func(*args, **kwargs)
+    return loop.run_in_executor(None, _with_ctx)
+
+
+def run(coro):
+    """Run the workflow coroutine in a new event loop, until it's done.
+
+    :return: the coroutine's return value
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        main = asyncio.ensure_future(coro, loop=loop)
+        loop.call_soon(_check_cancel_request, loop, main)
+        try:
+            return loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            if api.has_cancel_request():
+                raise api.ExecutionCancelled()
+            raise
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def _check_cancel_request(loop, main):
+    if main.done():
+        return
+    if api.has_cancel_request():
+        main.cancel()
+    else:
+        loop.call_later(CANCEL_CHECK_INTERVAL,
+                        _check_cancel_request, loop, main)
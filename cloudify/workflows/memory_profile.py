@@ -0,0 +1,230 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Memory profiling of workflow executions.
+
+Enable it by starting the execution with the reserved _profile_memory
+parameter (eg. `cfy executions start install -p _profile_memory=true`,
+which needs allow_custom_parameters). It isn't passed to the workflow
+function. The report is sent in a workflow_memory_profile event, and if
+CLOUDIFY_MEMORY_PROFILE_DIR is set in the environment of the process
+running the workflow, also written to <execution id>.json under it.
+
+When enabled, allocations are traced using tracemalloc, and sampled at
+a few points of the execution:
+    - graph_execute: when a tasks graph starts executing, ie. after it
+      was built or restored
+    - mid_execution: when half of the graph's tasks have terminated
+    - end: when the workflow function has returned
+
+Every sample contains the traced memory, grouped by the module that
+allocated it (the innermost frame in cloudify, dsl_parser or
+cloudify_rest_client, or else the innermost frame at all), and the
+number of live objects grouped by type. Only the top consumers are
+kept, so that the report fits in an event.
+
+Each phase is sampled once, so the overhead of sampling is bounded; the
+overhead of tracing itself grows with TRACEBACK_FRAMES.
+"""
+
+import gc
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# how many frames to store for every allocation: more frames make it
+# more likely to find the cloudify module responsible, at a higher cost
+TRACEBACK_FRAMES = 10
+
+# how many modules and types to include in every sample
+TOP_CONSUMERS = 20
+
+# if set, the reports are also written to files in this directory
+MEMORY_PROFILE_DIR_ENV = 'CLOUDIFY_MEMORY_PROFILE_DIR'
+
+OWN_PACKAGES = ('cloudify', 'dsl_parser', 'cloudify_rest_client',
+                'script_runner')
+
+available = tracemalloc is not None
+
+# allocations made by the profiling itself
+_IGNORED_MODULES = ('tracemalloc', __name__)
+
+
+def report_path(execution_id):
+    """Where to write the report of the execution, if anywhere"""
+    directory = os.environ.get(MEMORY_PROFILE_DIR_ENV)
+    if not directory:
+        return None
+    return os.path.join(directory, '{0}.json'.format(
+        os.path.basename(str(execution_id))))
+
+
+def _max_rss():
+    """Peak RSS of this process in bytes, if known"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _ModuleNames(object):
+    """Convert source filenames to module names, caching the results"""
+
+    def __init__(self):
+        self._roots = sorted(
+            (os.path.abspath(path or os.curdir) for path in sys.path),
+            key=len, reverse=True)
+        self._names = {}
+
+    def get(self, filename):
+        name = self._names.get(filename)
+        if name is None:
+            name = self._names[filename] = self._module_name(filename)
+        return name
+
+    def _module_name(self, filename):
+        path = os.path.abspath(filename)
+        for root in self._roots:
+            if path.startswith(root + os.sep):
+                path = path[len(root) + 1:]
+                break
+        path = os.path.splitext(path)[0]
+        if path.endswith('__init__'):
+            path = os.path.dirname(path)
+        return path.replace(os.sep, '.')
+
+
+def _is_own(module):
+    return module.split('.', 1)[0] in OWN_PACKAGES
+
+
+def _allocating_module(traceback, module_names):
+    frames = list(traceback)
+    if sys.version_info >= (3, 7):
+        # since 3.7, tracebacks are sorted from the oldest frame
+        frames.reverse()
+    innermost = None
+    for frame in frames:
+        module = module_names.get(frame.filename)
+        if innermost is None:
+            innermost = module
+        if _is_own(module):
+            return module
+    return innermost or '<unknown>'
+
+
+def _type_name(obj_type):
+    return '{0}.{1}'.format(obj_type.__module__, obj_type.__name__)
+
+
+class ExecutionMemoryProfile(object):
+    """Samples of the memory use during a workflow execution.
+
+    Creating this starts tracing allocations; call .stop() when
+    the execution is done.
+    """
+    enabled = True
+
+    def __init__(self, frames=TRACEBACK_FRAMES, top=TOP_CONSUMERS):
+        self._top = top
+        self._lock = threading.Lock()
+        self._samples = []
+        self._sampled_phases = set()
+        self._module_names = _ModuleNames()
+        # if something else already traces allocations, leave it running
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start(frames)
+
+    def sample(self, phase):
+        """Take a sample, unless the phase was already sampled"""
+        with self._lock:
+            if phase in self._sampled_phases or not tracemalloc.is_tracing():
+                return
+            self._sampled_phases.add(phase)
+            start = time.time()
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            self._samples.append({
+                'phase': phase,
+                'traced': current,
+                'traced_peak': peak,
+                'max_rss': _max_rss(),
+                'modules': self._modules(snapshot),
+                'types': self._types(),
+                'duration': round(time.time() - start, 3)
+            })
+
+    def _modules(self, snapshot):
+        sizes, counts = Counter(), Counter()
+        for stat in snapshot.statistics('traceback'):
+            module = _allocating_module(stat.traceback, self._module_names)
+            if module in _IGNORED_MODULES:
+                continue
+            sizes[module] += stat.size
+            counts[module] += stat.count
+        return [{'module': module, 'size': size, 'count': counts[module]}
+                for module, size in sizes.most_common(self._top)]
+
+    def _types(self):
+        counts = Counter(type(obj) for obj in gc.get_objects())
+        return [{'type': _type_name(obj_type), 'count': count}
+                for obj_type, count in counts.most_common(self._top)]
+
+    def stop(self):
+        if self._started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def report(self):
+        """The samples, suitable for sending in an event"""
+        with self._lock:
+            return {'samples': list(self._samples)}
+
+    def write(self, path):
+        """Write the report to path, as JSON"""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NullMemoryProfile(object):
+    """Used when memory profiling is disabled"""
+    enabled = False
+
+    def sample(self, phase):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self):
+        return None
+
+    def write(self, path):
+        pass
@@ -0,0 +1,485 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Offline simulation of executing a tasks graph.
+
+The simulator replays a TaskDependencyGraph using a simulated clock,
+without sending any tasks: durations of the operations are drawn from
+the given distributions instead. This predicts how long executing the
+graph would take (the makespan), which tasks it was waiting for (the
+critical path), and how loaded every agent would be.
+
+The simulation follows TaskDependencyGraph.execute: terminated tasks are
+only noticed, and the tasks depending on them are only sent, once per
+poll_interval. Agents run a limited number of operations at once, and
+queue the rest in the order they were sent.
+
+Example, predicting an install, from inside a local workflow:
+
+    graph = lifecycle_graph(ctx.node_instances)
+    durations = DurationModel({
+        'cloudify.interfaces.lifecycle.create': lognormal(30, 0.5),
+        'cloudify.interfaces.lifecycle.configure': uniform(5, 20)
+    }, seed=42)
+    result = Simulator(durations, agent_concurrency=5).run(graph)
+    print(result.makespan)
+"""
+
+import heapq
+import math
+import random
+from collections import deque
+
+from cloudify.constants import MGMTWORKER_QUEUE
+from cloudify.plugins.lifecycle import LifecycleProcessor
+from cloudify.state import workflow_ctx
+from cloudify.workflows.tasks_graph import POLL_INTERVAL, TaskDependencyGraph
+
+# agent name used for local tasks which aren't operations, eg. setting
+# the node instance state. These run in the workflow's local task threads
+LOCAL_TASKS = 'local-tasks'
+
+DEFAULT_OPERATION_DURATION = 1
+DEFAULT_LOCAL_TASK_DURATION = 0.05
+DEFAULT_AGENT_CONCURRENCY = 5
+DEFAULT_POLL_INTERVAL = POLL_INTERVAL
+
+
+def uniform(low, high):
+    """Durations distributed uniformly between low and high"""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """Durations distributed log-normally.
+
+    Operation durations usually have a long tail, which this reflects.
+    """
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+def empirical(samples):
+    """Durations drawn from actually measured durations"""
+    samples = list(samples)
+    return lambda rng: rng.choice(samples)
+
+
+class DurationModel(object):
+    """Durations of the tasks of a simulated graph.
+
+    :param durations: dict of operation name (or task name, for tasks
+                      which aren't operations) to either a number, or
+                      a distribution: a function taking a random.Random,
+                      and returning a duration
+    :param default: duration of operations not in durations
+    :param local_default: duration of local tasks which aren't operations
+                          and are not in durations
+    :param seed: seed for drawing the durations, so that simulations can
+                 be repeated
+    """
+
+    def __init__(self, durations=None, default=DEFAULT_OPERATION_DURATION,
+                 local_default=DEFAULT_LOCAL_TASK_DURATION, seed=None):
+        self._durations = durations or {}
+        self._default = default
+        self._local_default = local_default
+        self._rng = random.Random(seed)
+
+    def duration(self, task):
+        _, operation = task.metrics_labels
+        if operation in self._durations:
+            duration = self._durations[operation]
+        elif task.name in self._durations:
+            duration = self._durations[task.name]
+        elif _is_operation(task):
+            duration = self._default
+        else:
+            duration = self._local_default
+        if callable(duration):
+            duration = duration(self._rng)
+        return max(0, duration)
+
+
+def _is_operation(task):
+    return bool((task.cloudify_context or {}).get('operation'))
+
+
+def task_agent(task):
+    """Name of the agent that would run the task.
+
+    Operations run either on the management worker, or on the agent of
+    their host. Local workflows run operations in-process, but they are
+    simulated as if they were running on those agents, too.
+    """
+    cloudify_context = task.cloudify_context or {}
+    if not _is_operation(task):
+        return LOCAL_TASKS
+    if not task.is_local() and task.target:
+        return task.target
+    if cloudify_context.get('executor') == 'central_deployment_agent':
+        return MGMTWORKER_QUEUE
+    return cloudify_context.get('host_id') or MGMTWORKER_QUEUE
+
+
+class _SimulatedTask(object):
+    __slots__ = ('task', 'id', 'dependencies', 'dependents', 'subgraph',
+                 'members', 'remaining', 'agent', 'duration', 'sent',
+                 'started', 'finished', 'cause', 'last_member')
+
+    def __init__(self, task):
+        self.task = task
+        self.id = task.id
+        self.dependencies = 0
+        self.dependents = []
+        self.subgraph = None
+        # tasks contained in this task, if it is a subgraph
+        self.members = []
+        self.remaining = 0
+        self.agent = None
+        self.duration = 0
+        self.sent = None
+        self.started = None
+        self.finished = None
+        # the simulated task this one was waiting for, before it was sent
+        self.cause = None
+        # for subgraphs: the member which terminated last
+        self.last_member = None
+
+    def describe(self):
+        cloudify_context = self.task.cloudify_context or {}
+        return {
+            'id': self.id,
+            'name': self.task.name,
+            'node_instance': cloudify_context.get('node_id'),
+            'operation': (cloudify_context.get('operation') or {}).get(
+                'name'),
+            'agent': self.agent,
+            'sent': self.sent,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class _Agent(object):
+    __slots__ = ('name', 'concurrency', 'running', 'queue', 'tasks',
+                 'busy_time', 'peak_in_flight', 'peak_queued')
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.running = 0
+        self.queue = deque()
+        self.tasks = 0
+        self.busy_time = 0
+        self.peak_in_flight = 0
+        self.peak_queued = 0
+
+    def has_capacity(self):
+        return self.concurrency is None or self.running < self.concurrency
+
+    def summary(self, makespan):
+        concurrency = self.concurrency or self.peak_in_flight or 1
+        return {
+            'tasks': self.tasks,
+            'concurrency': self.concurrency,
+            'peak_in_flight': self.peak_in_flight,
+            'peak_queued': self.peak_queued,
+            'busy_time': self.busy_time,
+            'utilization': (float(self.busy_time) / (makespan * concurrency)
+                            if makespan else 0)
+        }
+
+
+class SimulationResult(object):
+    def __init__(self, makespan, critical_path, agents, tasks):
+        self.makespan = makespan
+        # descriptions of the tasks which, one after another, determined
+        # the makespan. Gaps between them are spent waiting for the
+        # graph's polling, or for a free slot on the agent
+        self.critical_path = critical_path
+        self.agents = agents
+        self.tasks = tasks
+
+    def to_dict(self):
+        return {
+            'makespan': self.makespan,
+            'tasks': self.tasks,
+            'critical_path': self.critical_path,
+            'agents': self.agents
+        }
+
+
+class Simulator(object):
+    """Predicts the execution of a tasks graph.
+
+    :param durations: a DurationModel
+    :param agent_concurrency: how many operations can every agent run at
+                              once, None for no limit
+    :param agents_concurrency: dict of agent name to concurrency, for
+                               agents with a different limit. The local
+                               tasks "agent" is LOCAL_TASKS
+    :param local_task_threads: concurrency of local tasks, same as the
+                               local_task_thread_pool_size of the workflow
+    :param poll_interval: how often does the graph check for terminated
+                          tasks; use 0 to model the ideal engine
+    """
+
+    def __init__(self, durations=None, agent_concurrency=(
+                 DEFAULT_AGENT_CONCURRENCY), agents_concurrency=None,
+                 local_task_threads=1, poll_interval=DEFAULT_POLL_INTERVAL):
+        self._durations = durations or DurationModel()
+        self._agent_concurrency = agent_concurrency
+        self._agents_concurrency = dict(agents_concurrency or {})
+        self._agents_concurrency.setdefault(LOCAL_TASKS, local_task_threads)
+        self._poll_interval = poll_interval
+
+    def run(self, graph):
+        """Simulate executing graph.
+
+        The graph itself is not changed, and no tasks are sent.
+
+        :param graph: a TaskDependencyGraph
+        :return: a SimulationResult
+        """
+        return _Simulation(self, graph).run()
+
+    def _agent(self, name):
+        return _Agent(name, self._agents_concurrency.get(
+            name, self._agent_concurrency))
+
+
+class _Simulation(object):
+    def __init__(self, simulator, graph):
+        self._simulator = simulator
+        self._poll_interval = simulator._poll_interval
+        self._agents = {}
+        # (finish time, sequence, simulated task) of running tasks
+        self._running = []
+        self._sequence = 0
+        self._tasks = self._load(graph, simulator._durations)
+        self._unfinished = len(self._tasks)
+        self._now = 0
+        self._last = None
+
+    def _load(self, graph, durations):
+        tasks = {}
+        for task in graph.tasks_iter():
+            tasks[task.id] = _SimulatedTask(task)
+        for sim in tasks.values():
+            task = sim.task
+            # src depends on dst, see TaskDependencyGraph.add_dependency
+            dependencies = graph.graph.succ.get(sim.id, {})
+            sim.dependencies = len(dependencies)
+            for dependency in dependencies:
+                tasks[dependency].dependents.append(sim)
+            if task.containing_subgraph is not None:
+                sim.subgraph = tasks[task.containing_subgraph.id]
+                sim.subgraph.members.append(sim)
+            if not task.is_subgraph and not task.is_nop():
+                sim.agent = task_agent(task)
+                sim.duration = durations.duration(task)
+        for sim in tasks.values():
+            sim.remaining = len(sim.members)
+        return tasks
+
+    def run(self):
+        now = 0
+        # simulated tasks which terminated, and will be handled by the
+        # graph at the next poll
+        terminated = []
+        for sim in self._tasks.values():
+            if sim.sent is None and self._is_executable(sim):
+                self._send(sim, now, terminated)
+        while self._unfinished:
+            if terminated:
+                # a subgraph or a NOP task has terminated during the last
+                # poll, the graph will notice it at the next one
+                now = self._next_poll(now, after=True)
+            elif self._running:
+                now = self._next_poll(self._running[0][0])
+            else:
+                raise RuntimeError(
+                    'Cannot simulate the graph: {0} tasks can never run '
+                    '(is there a dependency cycle?)'.format(
+                        self._unfinished))
+            while self._running and self._running[0][0] <= now:
+                finished_at, _, sim = heapq.heappop(self._running)
+                self._finish(sim, finished_at)
+                terminated.append(sim)
+            handled, terminated = terminated, []
+            for sim in handled:
+                self._handle_terminated(sim, now, terminated)
+        self._now = now
+        return self._result()
+
+    def _next_poll(self, when, after=False):
+        if not self._poll_interval:
+            return when
+        polls = when / self._poll_interval
+        if after:
+            polls = math.floor(polls + 1e-9) + 1
+        else:
+            polls = math.ceil(polls - 1e-9)
+        return polls * self._poll_interval
+
+    def _is_executable(self, sim):
+        while sim is not None:
+            if sim.dependencies:
+                return False
+            sim = sim.subgraph
+        return True
+
+    def _send(self, sim, now, terminated):
+        sim.sent = now
+        if sim.agent is None:
+            # subgraphs and NOP tasks terminate immediately, unless the
+            # subgraph still has members to run
+            sim.started = now
+            if sim.members:
+                for member in sim.members:
+                    if member.sent is None and self._is_executable(member):
+                        member.cause = sim
+                        self._send(member, now, terminated)
+            else:
+                self._finish(sim, now)
+                terminated.append(sim)
+            return
+        agent = self._agents.get(sim.agent)
+        if agent is None:
+            agent = self._agents[sim.agent] = \
+                self._simulator._agent(sim.agent)
+        agent.tasks += 1
+        agent.peak_in_flight = max(
+            agent.peak_in_flight, agent.running + len(agent.queue) + 1)
+        if agent.has_capacity():
+            self._start(agent, sim, now)
+        else:
+            agent.queue.append(sim)
+            agent.peak_queued = max(agent.peak_queued, len(agent.queue))
+
+    def _start(self, agent, sim, now):
+        agent.running += 1
+        agent.busy_time += sim.duration
+        sim.started = now
+        self._sequence += 1
+        heapq.heappush(self._running,
+                       (now + sim.duration, self._sequence, sim))
+
+    def _finish(self, sim, now):
+        sim.finished = now
+        self._unfinished -= 1
+        if self._last is None or now >= self._last.finished:
+            self._last = sim
+        if sim.agent is None:
+            return
+        # the agent doesn't wait for the graph's polling to start the
+        # next queued operation
+        agent = self._agents[sim.agent]
+        agent.running -= 1
+        if agent.queue:
+            self._start(agent, agent.queue.popleft(), now)
+
+    def _handle_terminated(self, sim, now, terminated):
+        for dependent in sim.dependents:
+            dependent.dependencies -= 1
+            if not dependent.dependencies and dependent.sent is None:
+                dependent.cause = sim
+                if self._is_executable(dependent):
+                    self._send(dependent, now, terminated)
+        subgraph = sim.subgraph
+        if subgraph is not None:
+            subgraph.remaining -= 1
+            subgraph.last_member = sim
+            if not subgraph.remaining:
+                self._finish(subgraph, now)
+                terminated.append(subgraph)
+
+    def _critical_path(self):
+        path = []
+        # walk back from the task that terminated last: a subgraph ended
+        # when its last member did, and every task was sent when its
+        # cause either terminated, or - for the containing subgraph -
+        # was sent
+        sim, terminated = self._last, True
+        while sim is not None:
+            if sim.agent is not None:
+                path.append(sim.describe())
+            if terminated and sim.last_member is not None:
+                sim = sim.last_member
+            else:
+                cause = sim.cause
+                terminated = not _contains(cause, sim)
+                sim = cause
+        path.reverse()
+        return path
+
+    def _result(self):
+        # the graph is done once it noticed the last task terminated
+        makespan = self._now
+        return SimulationResult(
+            makespan=makespan,
+            critical_path=self._critical_path(),
+            agents=dict((name, agent.summary(makespan))
+                        for name, agent in self._agents.items()),
+            tasks=len(self._tasks))
+
+
+def _contains(subgraph, sim):
+    while sim is not None:
+        if sim.subgraph is subgraph:
+            return True
+        sim = sim.subgraph
+    return False
+
+
+class _PlannedGraph(TaskDependencyGraph):
+    """A graph which is only built, and not executed"""
+
+    def execute(self):
+        pass
+
+
+def lifecycle_graph(node_instances, related_nodes=None, uninstall=False,
+                    **kwargs):
+    """Build the graph a LifecycleProcessor would execute.
+
+    This must be called with a current workflow context, which should be
+    a local or a dry-run one, so that the graph isn't stored. The context
+    is in graph mode while the graph is built, so that no tasks are
+    executed, and is switched back afterwards.
+
+    :param node_instances: node instances to install or uninstall
+    :param related_nodes: node instances which are kept intact
+    :param uninstall: build the uninstall graph instead of install
+    :param kwargs: passed to LifecycleProcessor
+    :return: the graph, which can be passed to Simulator.run
+    """
+    ctx = workflow_ctx._get_current_object()
+    graph = _PlannedGraph(ctx)
+    processor = LifecycleProcessor(graph,
+                                   node_instances=set(node_instances),
+                                   related_nodes=set(related_nodes or []),
+                                   **kwargs)
+    graph_mode = ctx.internal.graph_mode
+    ctx.internal.graph_mode = True
+    try:
+        if uninstall:
+            processor.uninstall()
+        else:
+            processor.install()
+    finally:
+        ctx.internal.graph_mode = graph_mode
+    return graph
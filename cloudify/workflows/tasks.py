@@ -13,13 +13,17 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import heapq
+import itertools
+import logging
 import sys
+import threading
 import time
 import uuid
 
-from cloudify import exceptions, logs
+from cloudify import exceptions, logs, metrics
 from cloudify._compat import queue, reraise
-from cloudify.workflows import api
+from cloudify.workflows import aio, api
 from cloudify.manager import (
     get_rest_client,
     get_node_instance,
@@ -51,6 +55,50 @@ DEFAULT_SUBGRAPH_TOTAL_RETRIES = 0
 DEFAULT_SEND_TASK_EVENTS = True
 DISPATCH_TASK = 'cloudify.dispatch.dispatch'
 
+logger = logging.getLogger(__name__)
+
+local_task_queue_latency = metrics.histogram(
+    'cloudify_local_task_queue_seconds',
+    'Time local tasks waited for a free local task processing thread')
+
+
+# guards the termination callbacks of all tasks: registering them is rare
+# enough that a single lock doesn't contend
+_termination_lock = threading.Lock()
+
+
+class _Terminated(object):
+    """Set once a task has terminated.
+
+    WorkflowTask.terminated used to be a queue.Queue holding a single item,
+    so get() and empty() are kept for callers using it that way; unlike
+    with the queue, get() can be called more than once.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    def get(self, block=True, timeout=None):
+        if not self.wait(timeout if block else 0):
+            raise queue.Empty()
+        return True
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        return not self.is_set()
+
 
 def retry_failure_handler(task):
     """Basic on_success/on_failure handler that always returns retry"""
@@ -104,8 +152,9 @@ class WorkflowTask(object):
         self.retry_interval = retry_interval
         self.timeout = timeout
         self.timeout_recoverable = timeout_recoverable
-        self.terminated = queue.Queue(maxsize=1)
+        self.terminated = _Terminated()
         self.is_terminated = False
+        self._termination_callbacks = None
         self.workflow_context = workflow_context
         self.send_task_events = send_task_events
         self.containing_subgraph = None
@@ -115,6 +164,8 @@ class WorkflowTask(object):
         # by the task graph before reached, overridden by the task
         # graph during retries
         self.execute_after = time.time()
+        # timestamp of sending the task, used for timings
+        self.sent_at = None
         self.stored = False
 
         # ID of the task that is being retried by this task
@@ -207,16 +258,43 @@ class WorkflowTask(object):
         self._state = state
         if state in TERMINATED_STATES:
             self.is_terminated = True
-            self.terminated.put_nowait(True)
+            self.terminated.set()
+            with _termination_lock:
+                callbacks = self._termination_callbacks or []
+                self._termination_callbacks = None
+            for callback in callbacks:
+                # the state is set by the thread handling responses: don't
+                # let a callback break that, or the other callbacks
+                try:
+                    callback(self)
+                except Exception:
+                    logger.exception('Error in a termination callback of '
+                                     'task %s', self.id)
 
     def _update_stored_state(self, state):
         self.workflow_context.update_operation(self.id, state=state)
 
     def wait_for_terminated(self, timeout=None):
-        if self.is_terminated:
-            return
+        """Wait for the task to terminate.
+
+        :raise queue.Empty: if it didn't terminate before the timeout
+        """
         self.terminated.get(timeout=timeout)
 
+    def on_terminated(self, callback):
+        """Call callback with this task, once it has terminated.
+
+        If the task has terminated already, callback is called right away.
+        Otherwise, it is called by the thread that sets the terminal state.
+        """
+        with _termination_lock:
+            if not self.is_terminated:
+                if self._termination_callbacks is None:
+                    self._termination_callbacks = []
+                self._termination_callbacks.append(callback)
+                return
+        callback(self)
+
     def handle_task_terminated(self):
         if self.get_state() in (TASK_FAILED, TASK_RESCHEDULED):
             handler_result = self._handle_task_not_succeeded()
@@ -342,6 +420,17 @@ class WorkflowTask(object):
     def is_subgraph(self):
         return False
 
+    @property
+    def metrics_labels(self):
+        """Plugin and operation name, to label metrics of this task with.
+
+        Tasks that aren't operations use their name as the operation name.
+        """
+        cloudify_context = self.cloudify_context or {}
+        plugin = cloudify_context.get('plugin') or {}
+        operation = cloudify_context.get('operation') or {}
+        return plugin.get('name') or '', operation.get('name') or self.name
+
     def _should_resume(self):
         """Has this task already been sent and should be resumed?"""
         return (
@@ -456,6 +545,11 @@ class RemoteWorkflowTask(WorkflowTask):
         # 1) this is the first execution of this task (state=pending)
         # 2) this is a resume (state=sent|started) and the task is a central
         #    deployment agent task
+        timings = self.workflow_context.internal.timings
+        with timings.measure('task_send', task_name=self.name):
+            return self._apply_async()
+
+    def _apply_async(self):
         should_send = self._state == TASK_PENDING
         if self._state == TASK_PENDING:
             self.set_state(TASK_SENDING)
@@ -471,6 +565,7 @@ class RemoteWorkflowTask(WorkflowTask):
                     TASK_SENDING, self)
                 self.set_state(TASK_SENT)
                 self.workflow_context.internal.handler.send_task(self, task)
+                self.sent_at = time.time()
             self.async_result = RemoteWorkflowTaskResult(self, async_result)
         except (exceptions.NonRecoverableError,
                 exceptions.RecoverableError) as e:
@@ -711,11 +806,18 @@ class LocalWorkflowTask(WorkflowTask):
         :return: A wrapper for the task result
         """
 
+        timings = self.workflow_context.internal.timings
+
         def local_task_wrapper():
+            if self.sent_at is not None:
+                queued = time.time() - self.sent_at
+                local_task_queue_latency.observe(queued)
+                timings.add('local_task_queue', queued, task_name=self.name)
             try:
                 self.workflow_context.internal.send_task_event(TASK_STARTED,
                                                                self)
-                result = self.local_task(**self.kwargs)
+                with timings.measure('local_task', task_name=self.name):
+                    result = self.local_task(**self.kwargs)
                 self.workflow_context.internal.send_task_event(
                     TASK_SUCCEEDED, self, event={'result': str(result)})
                 self.async_result._holder.result = result
@@ -731,7 +833,12 @@ class LocalWorkflowTask(WorkflowTask):
 
         self.workflow_context.internal.send_task_event(TASK_SENDING, self)
         self.set_state(TASK_SENT)
-        self.workflow_context.internal.add_local_task(local_task_wrapper)
+        self.sent_at = time.time()
+        # tasks of the same node instance must run in order, eg. setting
+        # its state to 'creating' can't happen after 'created'
+        self.workflow_context.internal.add_local_task(
+            local_task_wrapper,
+            ordering_key=self.node.id if self.node is not None else None)
 
         return self.async_result
 
@@ -815,29 +922,64 @@ class WorkflowTaskResult(object):
 
     def __init__(self, task):
         self.task = task
+        # (result, exc_info) once the task is done, including retries
+        self._outcome = None
+        # when the task failed and is to be retried: the new task, and
+        # the time to send it at
+        self._retried_task = None
+        self._retry_at = None
 
     def _process(self, retry_on_failure):
         if self.task.workflow_context.internal.graph_mode:
             return self._get()
+        while self._outcome is None:
+            if self._retry_at is not None:
+                self._sleep(self._retry_at - time.time())
+                self._retry()
+            else:
+                self._wait_for_task_terminated()
+                self._handle_terminated(retry_on_failure)
+        result, exc_info = self._outcome
+        if exc_info is not None:
+            reraise(*exc_info)
+        return result
+
+    def done(self):
+        """Whether the task is done, and won't be retried anymore.
+
+        Only meaningful when not in graph mode, see
+        CloudifyWorkflowContext.as_completed
+        """
+        return self._outcome is not None
+
+    def _handle_terminated(self, retry_on_failure=True):
+        """Run the task's termination handlers: either store the outcome,
+        or prepare the retry
+        """
+        handler_result = self.task.handle_task_terminated()
         task_graph = self.task.workflow_context.internal.task_graph
-        while True:
-            self._wait_for_task_terminated()
-            handler_result = self.task.handle_task_terminated()
-            task_graph.remove_task(self.task)
-            try:
-                result = self._get()
-                if handler_result.action != HandlerResult.HANDLER_RETRY:
-                    return result
-            except Exception:
-                if (not retry_on_failure or
-                        handler_result.action == HandlerResult.HANDLER_FAIL):
-                    raise
-            self._sleep(handler_result.retry_after)
-            self.task = handler_result.retried_task
-            task_graph.add_task(self.task)
-            self._check_execution_cancelled()
-            self.task.apply_async()
-            self._refresh_state()
+        task_graph.remove_task(self.task)
+        try:
+            result = self._get()
+            if handler_result.action != HandlerResult.HANDLER_RETRY:
+                self._outcome = (result, None)
+                return
+        except Exception:
+            if (not retry_on_failure or
+                    handler_result.action == HandlerResult.HANDLER_FAIL):
+                self._outcome = (None, sys.exc_info())
+                return
+        self._retried_task = handler_result.retried_task
+        self._retry_at = time.time() + (handler_result.retry_after or 0)
+
+    def _retry(self):
+        self.task, self._retried_task = self._retried_task, None
+        self._retry_at = None
+        task_graph = self.task.workflow_context.internal.task_graph
+        task_graph.add_task(self.task)
+        self._check_execution_cancelled()
+        self.task.apply_async()
+        self._refresh_state()
 
     @staticmethod
     def _check_execution_cancelled():
@@ -869,6 +1011,10 @@ class WorkflowTaskResult(object):
         """
         return self._process(retry_on_failure)
 
+    def __await__(self):
+        """Wait for the result in an async workflow, see workflows.aio"""
+        return aio.result_future(self).__await__()
+
     def _get(self):
         raise NotImplementedError('Implemented by subclasses')
 
@@ -939,6 +1085,100 @@ class LocalWorkflowTaskResult(WorkflowTaskResult):
             return self._holder.result
 
 
+def as_completed(results):
+    """Yield the task results, in the order that they complete.
+
+    A result is complete when its task has terminated and won't be
+    retried anymore; call .get() on it to obtain the value, or to raise
+    the error. Tasks that are to be retried are resent when their retry
+    interval passes, while waiting for the other results.
+
+    This is only usable outside of graph mode, ie. with the results
+    returned by execute_operation/execute_task, and the results must
+    not be waited for from another thread at the same time.
+
+    :param results: WorkflowTaskResult objects
+    """
+    results = list(results)
+    if any(r.task.workflow_context.internal.graph_mode for r in results):
+        raise RuntimeError('as_completed cannot be used in graph mode')
+    # results whose task terminated, put there by the thread that set
+    # the task state; the task is passed along with the result, because
+    # by the time the result is taken off the queue, it might have been
+    # retried already
+    terminated = queue.Queue()
+    # (retry_at, ordinal, result) of the results waiting for a retry
+    retries = []
+    ordinal = itertools.count()
+    pending = 0
+
+    def _watch(result):
+        task = result.task
+        task.on_terminated(lambda _: terminated.put((result, task)))
+
+    for result in results:
+        if result.done():
+            yield result
+        elif result._retry_at is not None:
+            heapq.heappush(retries, (result._retry_at, next(ordinal), result))
+            pending += 1
+        else:
+            _watch(result)
+            pending += 1
+
+    while pending:
+        WorkflowTaskResult._check_execution_cancelled()
+        now = time.time()
+        if retries and retries[0][0] <= now:
+            _, _, result = heapq.heappop(retries)
+            result._retry()
+            _watch(result)
+            continue
+        timeout = 1
+        if retries:
+            timeout = min(timeout, retries[0][0] - now)
+        try:
+            result, task = terminated.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if result.task is not task or result.done():
+            continue
+        result._handle_terminated()
+        if result.done():
+            pending -= 1
+            yield result
+        else:
+            heapq.heappush(retries, (result._retry_at, next(ordinal), result))
+
+
+def wait_all(results):
+    """Wait for all the task results, and return their values.
+
+    Tasks are handled in the order that they complete, so that retries are
+    resent as early as possible. If any task failed, its error is raised
+    after all the tasks are done.
+
+    :param results: WorkflowTaskResult objects
+    :return: list of the values of the results, in the order given
+    """
+    results = list(results)
+    for _ in as_completed(results):
+        pass
+    return [result.get() for result in results]
+
+
+def wait_any(results):
+    """Wait for the first of the task results to complete, and return it.
+
+    :param results: WorkflowTaskResult objects
+    :return: the WorkflowTaskResult that completed, or None if there
+             were no results
+    """
+    for result in as_completed(results):
+        return result
+    return None
+
+
 class StubAsyncResult(object):
     """Stub async result that always returns None"""
     result = None
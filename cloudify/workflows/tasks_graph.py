@@ -20,11 +20,21 @@ from functools import wraps
 
 import networkx as nx
 
+from cloudify import metrics
 from cloudify.workflows import api
 from cloudify.workflows import tasks
 from cloudify.state import workflow_ctx
 from cloudify.exceptions import NonRecoverableError
 
+# how long does the graph sleep between checks for terminated tasks
+POLL_INTERVAL = 0.1
+
+task_duration = metrics.histogram(
+    'cloudify_workflow_task_seconds',
+    'Time from sending a workflow task, until the workflow handled its '
+    'termination',
+    labelnames=('type', 'plugin', 'operation'))
+
 
 def make_or_get_graph(f):
     """Decorate a graph-creating function with this, to automatically
@@ -32,16 +42,21 @@ def make_or_get_graph(f):
     """
     @wraps(f)
     def _inner(*args, **kwargs):
+        timings = workflow_ctx.internal.timings
         if workflow_ctx.dry_run:
             kwargs.pop('name', None)
-            return f(*args, **kwargs)
+            with timings.measure('graph_build'):
+                return f(*args, **kwargs)
         name = kwargs.pop('name')
         graph = workflow_ctx.get_tasks_graph(name)
         if not graph:
-            graph = f(*args, **kwargs)
-            graph.store(name=name)
+            with timings.measure('graph_build'):
+                graph = f(*args, **kwargs)
+            with timings.measure('graph_store'):
+                graph.store(name=name)
         else:
-            graph = TaskDependencyGraph.restore(workflow_ctx, graph)
+            with timings.measure('graph_restore'):
+                graph = TaskDependencyGraph.restore(workflow_ctx, graph)
         return graph
     return _inner
 
@@ -195,8 +210,15 @@ class TaskDependencyGraph(object):
         occurs, the method might return even while there's some operations\
         still being executed.
         """
+        with self.ctx.internal.timings.measure('graph_execute'):
+            return self._execute()
+
+    def _execute(self):
         # clear error, in case the tasks graph has been reused
         self._error = None
+        memory_profile = self.ctx.internal.memory_profile
+        memory_profile.sample('graph_execute')
+        mid_execution = len(self.graph.node) // 2
 
         while self._error is None:
 
@@ -211,14 +233,20 @@ class TaskDependencyGraph(object):
             for task in self._terminated_tasks():
                 self._handle_terminated_task(task)
 
+            if memory_profile.enabled and \
+                    len(self.graph.node) <= mid_execution:
+                memory_profile.sample('mid_execution')
+
             # if there was an error when handling terminated tasks, don't
             # continue on to sending new tasks in handle_executable
             if self._error:
                 break
 
-            # handle all executable tasks
-            for task in self._executable_tasks():
-                self._handle_executable_task(task)
+            # handle all executable tasks; the ones going to the same agent
+            # might be sent together, if the workflow context allows it
+            with self.ctx.internal.handler.batch_tasks():
+                for task in self._executable_tasks():
+                    self._handle_executable_task(task)
 
             # no more tasks to process, time to move on
             if len(self.graph.node) == 0:
@@ -227,7 +255,7 @@ class TaskDependencyGraph(object):
                 return
             # sleep some and do it all over again
             else:
-                time.sleep(0.1)
+                time.sleep(POLL_INTERVAL)
 
         # if we got here, we had an error in a task, and we're just waiting
         # for other tasks to return, but not sending new tasks
@@ -240,7 +268,7 @@ class TaskDependencyGraph(object):
             if not any(self._sent_tasks()):
                 break
             else:
-                time.sleep(0.1)
+                time.sleep(POLL_INTERVAL)
         raise self._error
 
     @staticmethod
@@ -301,6 +329,11 @@ class TaskDependencyGraph(object):
 
     def _handle_terminated_task(self, task):
         """Handle terminated task"""
+        if task.sent_at is not None:
+            task_duration.observe(
+                time.time() - task.sent_at,
+                'local' if task.is_local() else 'remote',
+                *task.metrics_labels)
         handler_result = task.handle_task_terminated()
 
         dependents = self.graph.predecessors(task.id)
@@ -0,0 +1,146 @@
+########
+# Copyright (c) 2020 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Per-phase timing of workflow executions.
+
+Phases recorded by the workflow engine:
+    - graph_build: creating a tasks graph (eg. by the LifecycleProcessor)
+    - graph_store, graph_restore: storing/restoring a tasks graph
+    - graph_execute: running a tasks graph to completion
+    - task_send: preparing and sending a remote task, including the
+      REST calls to find the agent, and the AMQP publish
+    - task_remote: from sending a remote task until its response arrived,
+      ie. AMQP transit, queueing on the agent, and running the operation
+    - local_task_queue: time a local task spent waiting for a free
+      local task processing thread
+    - local_task: running a local task, usually REST calls such as
+      updating the node instance state
+    - agent_queue: time a remote task waited on the agent for a free
+      worker thread
+    - agent_handle: handling a remote task on the agent, including
+      running the operation
+    - agent_*: other timings the agent's task handler reported in the
+      response, if any (see cloudify.dispatch.TaskHandler.timings)
+
+The agent_ timings are added to every response by
+cloudify.amqp_client.TaskConsumer.
+"""
+
+import threading
+import time
+
+
+class _Measurement(object):
+    __slots__ = ('_timings', '_phase', '_task_name', '_start')
+
+    def __init__(self, timings, phase, task_name):
+        self._timings = timings
+        self._phase = phase
+        self._task_name = task_name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._timings.add(self._phase, time.time() - self._start,
+                          task_name=self._task_name)
+
+
+class _NullMeasurement(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_MEASUREMENT = _NullMeasurement()
+
+
+def _record(phases, phase, duration):
+    stats = phases.get(phase)
+    if stats is None:
+        phases[phase] = [1, duration, duration]
+    else:
+        stats[0] += 1
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+
+
+def _format(phases):
+    return dict((phase, {
+        'count': count,
+        'total': round(total, 3),
+        'avg': round(total / count, 3),
+        'max': round(max_duration, 3)
+    }) for phase, (count, total, max_duration) in phases.items())
+
+
+class ExecutionTimings(object):
+    """Durations of the phases of a workflow execution.
+
+    Every duration is aggregated for the whole execution, and also
+    per task name (eg. per operation), when given.
+    """
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._task_phases = {}
+
+    def add(self, phase, duration, task_name=None):
+        with self._lock:
+            _record(self._phases, phase, duration)
+            if task_name is not None:
+                _record(self._task_phases.setdefault(task_name, {}),
+                        phase, duration)
+
+    def measure(self, phase, task_name=None):
+        """Context manager adding the duration of its block to phase"""
+        return _Measurement(self, phase, task_name)
+
+    def summary(self, top_tasks=10):
+        """Aggregated timings, suitable for sending in an event.
+
+        :param top_tasks: only include this many task names, the ones
+                          with the longest total time
+        """
+        with self._lock:
+            phases = _format(self._phases)
+            by_total = sorted(
+                self._task_phases.items(),
+                key=lambda item: sum(s[1] for s in item[1].values()),
+                reverse=True)
+            tasks = dict((name, _format(task_phases))
+                         for name, task_phases in by_total[:top_tasks])
+        return {'phases': phases, 'tasks': tasks}
+
+
+class NullTimings(object):
+    """Timings that aren't recorded: used when timings are disabled"""
+    enabled = False
+
+    def add(self, phase, duration, task_name=None):
+        pass
+
+    def measure(self, phase, task_name=None):
+        return _NULL_MEASUREMENT
+
+    def summary(self, top_tasks=10):
+        return None
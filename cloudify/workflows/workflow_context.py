@@ -16,14 +16,17 @@ from __future__ import absolute_import
 
 import functools
 import copy
+from collections import deque
+from contextlib import contextmanager
 import uuid
 import threading
 import time
 import logging
+import weakref
 
 from proxy_tools import proxy
 
-from cloudify import amqp_client, context
+from cloudify import amqp_client, context, metrics, tracing
 from cloudify._compat import queue
 from cloudify.manager import (get_bootstrap_context,
                               get_rest_client,
@@ -43,13 +46,18 @@ from cloudify.workflows.tasks import (TASK_FAILED,
                                       _GetNodeInstanceStateTask,
                                       _SendNodeEventTask,
                                       _SendWorkflowEventTask,
-                                      _UpdateExecutionStatusTask)
+                                      _UpdateExecutionStatusTask,
+                                      as_completed,
+                                      wait_all,
+                                      wait_any)
 from cloudify.constants import MGMTWORKER_QUEUE
 from cloudify import utils, logs, exceptions
 from cloudify.state import current_workflow_ctx
 from cloudify.workflows import events
 from cloudify.error_handling import deserialize_known_exception
 from cloudify.workflows.tasks_graph import TaskDependencyGraph
+from cloudify.workflows.timings import ExecutionTimings, NullTimings
+from cloudify.workflows import memory_profile
 from cloudify.amqp_client_utils import AMQPWrappedThread
 from cloudify.logs import (CloudifyWorkflowLoggingHandler,
                            CloudifyWorkflowNodeLoggingHandler,
@@ -59,7 +67,7 @@ from cloudify.logs import (CloudifyWorkflowLoggingHandler,
                            send_sys_wide_wf_event)
 from cloudify.models_states import DeploymentModificationState
 
-from cloudify.utils import is_agent_alive
+from cloudify.utils import is_agent_alive, freeze
 
 
 try:
@@ -67,9 +75,61 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 
 DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE = 1
 
+# how many changed node instances to fetch in a single request, when
+# refreshing node instances: bounds the length of the request URL
+REFRESH_FETCH_CHUNK_SIZE = 100
+
+# how many deployment contexts to build concurrently, when prefetching
+DEFAULT_DEPLOYMENTS_PREFETCH_WORKERS = 10
+
+# how many node instances the cached deployment contexts hold at most,
+# in total: least recently used contexts are dropped above it
+DEFAULT_DEPLOYMENTS_CACHE_INSTANCES = 100000
+
+# type hierarchies, interned: every distinct hierarchy is kept once, as a
+# frozenset shared by all the nodes and relationships of that type
+_type_hierarchies = {}
+
+
+def _type_hierarchy_set(type_hierarchy):
+    """The interned frozenset of type_hierarchy, for O(1) derivation checks"""
+    key = tuple(type_hierarchy or ())
+    hierarchy = _type_hierarchies.get(key)
+    if hierarchy is None:
+        hierarchy = _type_hierarchies.setdefault(key, frozenset(key))
+    return hierarchy
+
+
+def _raw_node_type_hierarchies(raw_node):
+    """The type hierarchy sets of raw_node, and of its relationships.
+
+    They're computed once per raw node and kept on it, so that checks
+    on a node that was already seen don't convert its lists again.
+
+    :return: a tuple of the node's set, and a list of its relationships'
+             sets, in the order of raw_node.relationships
+    """
+    hierarchies = getattr(raw_node, '_type_hierarchy_sets', None)
+    if hierarchies is None:
+        hierarchies = (
+            _type_hierarchy_set(raw_node.get('type_hierarchy')),
+            [_type_hierarchy_set(relationship['type_hierarchy'])
+             for relationship in raw_node.get('relationships') or ()])
+        try:
+            raw_node._type_hierarchy_sets = hierarchies
+        except AttributeError:
+            # a plain dict: nowhere to keep them
+            pass
+    return hierarchies
+
 
 class CloudifyWorkflowRelationshipInstance(object):
     """
@@ -81,6 +141,8 @@ class CloudifyWorkflowRelationshipInstance(object):
     :param relationship_instance: A relationship dict from a NodeInstance
            instance (of the rest client model)
     """
+    __slots__ = ('ctx', 'node_instance', '_nodes_and_instances',
+                 '_relationship_instance', '_relationship')
 
     def __init__(self, ctx, node_instance, nodes_and_instances,
                  relationship_instance):
@@ -158,13 +220,19 @@ class CloudifyWorkflowRelationship(object):
     :param nodes_and_instances: a WorkflowNodesAndInstancesContainer instance
     :param relationship: a relationship dict from a Node instance (of the
            rest client mode)
+    :param type_hierarchy: the relationship's type hierarchy as a set, if
+           it's known already
     """
+    __slots__ = ('ctx', 'node', '_nodes_and_instances', '_relationship',
+                 '_type_hierarchy')
 
-    def __init__(self, ctx, node, nodes_and_instances, relationship):
+    def __init__(self, ctx, node, nodes_and_instances, relationship,
+                 type_hierarchy=None):
         self.ctx = ctx
         self.node = node
         self._nodes_and_instances = nodes_and_instances
         self._relationship = relationship
+        self._type_hierarchy = type_hierarchy
 
     @property
     def target_id(self):
@@ -195,7 +263,10 @@ class CloudifyWorkflowRelationship(object):
         :param other_relationship: a string like
                cloudify.relationships.contained_in
         """
-        return other_relationship in self._relationship["type_hierarchy"]
+        if self._type_hierarchy is None:
+            self._type_hierarchy = _type_hierarchy_set(
+                self._relationship['type_hierarchy'])
+        return other_relationship in self._type_hierarchy
 
 
 class CloudifyWorkflowNodeInstance(object):
@@ -207,25 +278,23 @@ class CloudifyWorkflowNodeInstance(object):
     :param node_instance: a NodeInstance (rest client response model)
     :param nodes_and_instances: a WorkflowNodesAndInstancesContainer instance
     """
+    __slots__ = ('ctx', '_node', '_node_instance', '_nodes_and_instances',
+                 '_relationship_instances', '_logger')
 
     def __init__(self, ctx, node, node_instance, nodes_and_instances):
         self.ctx = ctx
         self._node = node
         self._node_instance = node_instance
-        # Directly contained node instances. Filled in the context's __init__()
-        self._contained_instances = []
-        self._relationship_instances = OrderedDict(
-            (relationship_instance['target_id'],
-                CloudifyWorkflowRelationshipInstance(
-                    self.ctx, self, nodes_and_instances,
-                    relationship_instance))
-            for relationship_instance in node_instance.relationships)
-
-        # adding the node instance to the node instances map
-        node._node_instances[self.id] = self
-
+        self._nodes_and_instances = nodes_and_instances
+        # created on first access, see .relationships
+        self._relationship_instances = None
         self._logger = None
 
+    def _update(self, node_instance):
+        """Replace the node instance data, after it was refreshed"""
+        self._node_instance = node_instance
+        self._relationship_instances = None
+
     def set_state(self, state):
         """
         Set the node state
@@ -307,6 +376,13 @@ class CloudifyWorkflowNodeInstance(object):
     @property
     def relationships(self):
         """The node relationships"""
+        if self._relationship_instances is None:
+            self._relationship_instances = OrderedDict(
+                (relationship_instance['target_id'],
+                    CloudifyWorkflowRelationshipInstance(
+                        self.ctx, self, self._nodes_and_instances,
+                        relationship_instance))
+                for relationship_instance in self._node_instance.relationships)
         return iter(self._relationship_instances.values())
 
     @property
@@ -341,10 +417,7 @@ class CloudifyWorkflowNodeInstance(object):
         """
         Returns node instances directly contained in this instance (children)
         """
-        return self._contained_instances
-
-    def _add_contained_node_instance(self, node_instance):
-        self._contained_instances.append(node_instance)
+        return self._nodes_and_instances._get_contained_instances(self.id)
 
     def get_contained_subgraph(self):
         """
@@ -365,15 +438,16 @@ class CloudifyWorkflowNode(object):
     :param node: a Node instance (rest client response model)
     :param nodes_and_instances: a WorkflowNodesAndInstancesContainer instance
     """
+    __slots__ = ('ctx', '_node', '_nodes_and_instances', '_relationships',
+                 '_type_hierarchy')
 
     def __init__(self, ctx, node, nodes_and_instances):
         self.ctx = ctx
         self._node = node
-        self._relationships = OrderedDict(
-            (relationship['target_id'], CloudifyWorkflowRelationship(
-                self.ctx, self, nodes_and_instances, relationship))
-            for relationship in node.relationships)
-        self._node_instances = {}
+        self._nodes_and_instances = nodes_and_instances
+        # created on first access, see .relationships
+        self._relationships = None
+        self._type_hierarchy = None
 
     @property
     def id(self):
@@ -390,6 +464,15 @@ class CloudifyWorkflowNode(object):
         """The node type hierarchy"""
         return self._node.type_hierarchy
 
+    def is_derived_from(self, type_name):
+        """
+        :param type_name: a string like cloudify.nodes.Compute
+        :return: whether the node's type is type_name, or derived from it
+        """
+        if self._type_hierarchy is None:
+            self._type_hierarchy = _raw_node_type_hierarchies(self._node)[0]
+        return type_name in self._type_hierarchy
+
     @property
     def properties(self):
         """The node properties"""
@@ -424,7 +507,7 @@ class CloudifyWorkflowNode(object):
     @property
     def relationships(self):
         """The node relationships"""
-        return iter(self._relationships.values())
+        return iter(self._get_relationships().values())
 
     @property
     def operations(self):
@@ -434,11 +517,22 @@ class CloudifyWorkflowNode(object):
     @property
     def instances(self):
         """The node instances"""
-        return iter(self._node_instances.values())
+        return self._nodes_and_instances._get_instances_of(self.id)
 
     def get_relationship(self, target_id):
         """Get a node relationship by its target id"""
-        return self._relationships.get(target_id)
+        return self._get_relationships().get(target_id)
+
+    def _get_relationships(self):
+        if self._relationships is None:
+            _, hierarchies = _raw_node_type_hierarchies(self._node)
+            self._relationships = OrderedDict(
+                (relationship['target_id'], CloudifyWorkflowRelationship(
+                    self.ctx, self, self._nodes_and_instances, relationship,
+                    type_hierarchy))
+                for relationship, type_hierarchy
+                in zip(self._node.relationships, hierarchies))
+        return self._relationships
 
 
 class _WorkflowContextBase(object):
@@ -455,6 +549,9 @@ class _WorkflowContextBase(object):
         self._subgraph_retries = ctx.get('subgraph_retries',
                                          DEFAULT_SUBGRAPH_TOTAL_RETRIES)
         self._logger = None
+        # operation inputs, frozen once and shared by all tasks executing
+        # that operation; id(op_struct) -> (op_struct, frozen inputs)
+        self._frozen_operation_inputs = {}
 
         if self.local:
             storage = ctx.pop('storage')
@@ -535,6 +632,36 @@ class _WorkflowContextBase(object):
     def wait_after_fail(self):
         return self._context.get('wait_after_fail', 600)
 
+    @property
+    def batch_operations(self):
+        """Group operations sent to the same agent at once into batches.
+
+        Only enable this when all the agents support batch messages.
+        """
+        return self._context.get('batch_operations', False)
+
+    @property
+    def collect_timings(self):
+        """Record per-phase timings, see cloudify.workflows.timings"""
+        return self._context.get('collect_timings', False)
+
+    @property
+    def profile_memory(self):
+        """Sample the memory use, see cloudify.workflows.memory_profile
+
+        Enabled by the _profile_memory execution parameter, which the
+        dispatcher moves into the context.
+        """
+        return self._context.get('profile_memory', False)
+
+    @property
+    def memory_profile_path(self):
+        """Also write the memory profile report to this local file
+
+        It's under CLOUDIFY_MEMORY_PROFILE_DIR, if that is set.
+        """
+        return memory_profile.report_path(self.execution_id)
+
     @property
     def logger(self):
         """A logger for this workflow"""
@@ -594,7 +721,7 @@ class _WorkflowContextBase(object):
                   if p['name'] == plugin_name][0]
         operation_mapping = op_struct['operation']
         has_intrinsic_functions = op_struct['has_intrinsic_functions']
-        operation_properties = op_struct.get('inputs', {})
+        operation_properties = self._get_operation_inputs(op_struct)
         operation_executor = op_struct['executor']
         operation_total_retries = op_struct['max_retries']
         operation_retry_interval = op_struct['retry_interval']
@@ -668,6 +795,13 @@ class _WorkflowContextBase(object):
             timeout=operation_timeout,
             timeout_recoverable=operation_timeout_recoverable)
 
+    def _get_operation_inputs(self, op_struct):
+        cached = self._frozen_operation_inputs.get(id(op_struct))
+        if cached is None or cached[0] is not op_struct:
+            cached = (op_struct, freeze(op_struct.get('inputs', {})))
+            self._frozen_operation_inputs[id(op_struct)] = cached
+        return cached[1]
+
     @staticmethod
     def _merge_dicts(merged_from, merged_into, allow_override=False):
         result = copy.copy(merged_into)
@@ -734,9 +868,12 @@ class _WorkflowContextBase(object):
         :param kwargs: optional kwargs to be passed to the task
         :param node_context: Used internally by node.execute_operation
         """
-        # Should deepcopy cause problems here, remove it, but please make
-        # sure that WORKFLOWS_WORKER_PAYLOAD is not global in manager repo
-        kwargs = copy.deepcopy(kwargs) or {}
+        # kwargs values are frozen instead of deep-copied: the task can't
+        # be affected by the caller changing them later, and already-frozen
+        # values (eg. operation inputs) are shared between tasks for free.
+        # Operation handlers get a mutable copy when the task is dispatched.
+        kwargs = dict((key, freeze(value))
+                      for key, value in (kwargs or {}).items())
         task_id = str(uuid.uuid4())
         cloudify_context = self._build_cloudify_context(
             task_id,
@@ -865,6 +1002,32 @@ class _WorkflowContextBase(object):
             self.internal.task_graph.add_task(task)
             return task.apply_async()
 
+    def as_completed(self, results):
+        """Yield the results of tasks, in the order that they complete.
+
+        Use this to react to each task as soon as it finishes, eg. when
+        running a large number of operations concurrently.
+        See cloudify.workflows.tasks.as_completed.
+
+        :param results: results returned by execute_operation/execute_task
+        """
+        return as_completed(results)
+
+    def wait_all(self, results):
+        """Wait for all the results of tasks, and return their values.
+
+        :param results: results returned by execute_operation/execute_task
+        :return: list of the values of the results, in the order given
+        """
+        return wait_all(results)
+
+    def wait_any(self, results):
+        """Wait for the first of the results to complete, and return it.
+
+        :param results: results returned by execute_operation/execute_task
+        """
+        return wait_any(results)
+
     def get_operations(self, graph_id):
         return self.internal.handler.get_operations(graph_id)
 
@@ -897,31 +1060,40 @@ class _WorkflowContextBase(object):
 
 
 class WorkflowNodesAndInstancesContainer(object):
+    """The nodes and node instances of a deployment.
 
-    def __init__(self, workflow_context, raw_nodes, raw_node_instances):
-        self._nodes = dict(
-            (node.id, CloudifyWorkflowNode(workflow_context, node, self))
-            for node in raw_nodes)
-
-        self._node_instances = dict(
-            (instance.id, CloudifyWorkflowNodeInstance(
-                workflow_context, self._nodes[instance.node_id], instance,
-                self))
-            for instance in raw_node_instances)
+    The workflow node and node instance objects are created when they're
+    first accessed, so that the cost of a workflow that only uses a few
+    node instances doesn't depend on the size of the deployment.
+    """
 
-        for inst in self._node_instances.values():
-            for rel in inst.relationships:
-                if rel.relationship.is_derived_from(
-                        "cloudify.relationships.contained_in"):
-                    rel.target_node_instance._add_contained_node_instance(inst)
+    def __init__(self, workflow_context, raw_nodes, raw_node_instances):
+        self._workflow_context = workflow_context
+        self._raw_nodes = OrderedDict((node.id, node) for node in raw_nodes)
+        self._nodes = {}
+        self._set_raw_node_instances(raw_node_instances)
+
+    def _set_raw_node_instances(self, raw_node_instances):
+        self._raw_node_instances = OrderedDict(
+            (instance.id, instance) for instance in raw_node_instances)
+        self._node_instances = {}
+        # node id -> ids of its instances
+        self._node_instance_ids = {}
+        for instance in self._raw_node_instances.values():
+            self._node_instance_ids.setdefault(
+                instance.node_id, []).append(instance.id)
+        # node instance id -> ids of the instances directly contained
+        # in it; computed when first needed
+        self._contained_instance_ids = None
 
     @property
     def nodes(self):
-        return iter(self._nodes.values())
+        return (self.get_node(node_id) for node_id in self._raw_nodes)
 
     @property
     def node_instances(self):
-        return iter(self._node_instances.values())
+        return (self.get_node_instance(instance_id)
+                for instance_id in self._raw_node_instances)
 
     def get_node(self, node_id):
         """
@@ -931,7 +1103,15 @@ class WorkflowNodesAndInstancesContainer(object):
         :return: a CloudifyWorkflowNode instance for the node or None if
                  not found
         """
-        return self._nodes.get(node_id)
+        node = self._nodes.get(node_id)
+        if node is None:
+            raw_node = self._raw_nodes.get(node_id)
+            if raw_node is None:
+                return None
+            # setdefault, so that concurrent callers get the same object
+            node = self._nodes.setdefault(node_id, CloudifyWorkflowNode(
+                self._workflow_context, raw_node, self))
+        return node
 
     def get_node_instance(self, node_instance_id):
         """
@@ -941,22 +1121,117 @@ class WorkflowNodesAndInstancesContainer(object):
         :return: a CloudifyWorkflowNode instance for the node or None if
                  not found
         """
-        return self._node_instances.get(node_instance_id)
+        instance = self._node_instances.get(node_instance_id)
+        if instance is None:
+            raw_instance = self._raw_node_instances.get(node_instance_id)
+            if raw_instance is None:
+                return None
+            instance = self._node_instances.setdefault(
+                node_instance_id, CloudifyWorkflowNodeInstance(
+                    self._workflow_context,
+                    self.get_node(raw_instance.node_id),
+                    raw_instance,
+                    self))
+        return instance
+
+    def _get_instances_of(self, node_id):
+        return (self.get_node_instance(instance_id)
+                for instance_id in self._node_instance_ids.get(node_id, []))
+
+    def _get_contained_instances(self, node_instance_id):
+        if self._contained_instance_ids is None:
+            self._contained_instance_ids = self._find_contained_instances()
+        return [self.get_node_instance(instance_id) for instance_id in
+                self._contained_instance_ids.get(node_instance_id, [])]
+
+    def _find_contained_instances(self):
+        """Map instance ids to the ids of the instances contained in them
+
+        This only uses the raw nodes and instances, so that it doesn't
+        require creating the objects of all the instances.
+        """
+        # node id -> ids of the nodes that it's contained in
+        containers = {}
+        for node_id, raw_node in self._raw_nodes.items():
+            _, hierarchies = _raw_node_type_hierarchies(raw_node)
+            containers[node_id] = set(
+                relationship['target_id']
+                for relationship, type_hierarchy
+                in zip(raw_node.relationships or (), hierarchies)
+                if 'cloudify.relationships.contained_in' in type_hierarchy)
+        contained = {}
+        for instance in self._raw_node_instances.values():
+            node_containers = containers.get(instance.node_id)
+            if not node_containers:
+                continue
+            for relationship in instance.relationships:
+                if relationship['target_name'] in node_containers and \
+                        relationship['target_id'] in self._raw_node_instances:
+                    contained.setdefault(
+                        relationship['target_id'], []).append(instance.id)
+        return contained
+
+    def _update_raw_node_instances(self, changed, current_ids):
+        """Patch the node instances in place.
+
+        The objects of the node instances that were updated keep their
+        identity, and get the new data.
+
+        :param changed: raw node instances that were added or updated
+        :param current_ids: ids of all the node instances that exist now;
+                            the others were removed
+        """
+        removed = [instance_id for instance_id in self._raw_node_instances
+                   if instance_id not in current_ids]
+        for instance_id in removed:
+            raw_instance = self._raw_node_instances.pop(instance_id)
+            self._node_instances.pop(instance_id, None)
+            self._node_instance_ids[raw_instance.node_id].remove(instance_id)
+        for raw_instance in changed:
+            if raw_instance.id not in self._raw_node_instances:
+                self._node_instance_ids.setdefault(
+                    raw_instance.node_id, []).append(raw_instance.id)
+            self._raw_node_instances[raw_instance.id] = raw_instance
+            instance = self._node_instances.get(raw_instance.id)
+            if instance is not None:
+                instance._update(raw_instance)
+        if removed or changed:
+            self._contained_instance_ids = None
+
+    def _is_changed(self, raw_instance):
+        known = self._raw_node_instances.get(raw_instance.id)
+        return known is None or raw_instance.version is None or \
+            known.version != raw_instance.version
 
     def refresh_node_instances(self):
+        """Update the node instances that changed since they were fetched.
+
+        Only the ids and versions of all the node instances are listed,
+        and only the instances that were added or whose version changed
+        are fetched in full.
+        """
         if self.local:
             storage = self.internal.handler.storage
             raw_node_instances = storage.get_node_instances()
+            current_ids = set(instance.id for instance in raw_node_instances)
+            changed = [instance for instance in raw_node_instances
+                       if self._is_changed(instance)]
         else:
             rest = get_rest_client()
-            raw_node_instances = rest.node_instances.list(
+            versions = rest.node_instances.list(
                 deployment_id=self.deployment.id,
+                _include=['id', 'version'],
                 _get_all_results=True)
-        self._node_instances = dict(
-            (instance.id, CloudifyWorkflowNodeInstance(
-                self, self._nodes[instance.node_id], instance,
-                self))
-            for instance in raw_node_instances)
+            current_ids = set(instance.id for instance in versions)
+            changed_ids = [instance.id for instance in versions
+                           if self._is_changed(instance)]
+            changed = []
+            for i in range(0, len(changed_ids), REFRESH_FETCH_CHUNK_SIZE):
+                changed.extend(rest.node_instances.list(
+                    deployment_id=self.deployment.id,
+                    id=changed_ids[i:i + REFRESH_FETCH_CHUNK_SIZE],
+                    _get_all_results=True))
+        self._update_raw_node_instances(changed, current_ids)
 
 
 class CloudifyWorkflowContext(
@@ -1021,43 +1296,212 @@ class CloudifySystemWideWorkflowContext(_WorkflowContextBase):
         self._dep_contexts = None
 
     class _ManagedCloudifyWorkflowContext(CloudifyWorkflowContext):
+        def __init__(self, ctx, contexts):
+            super(CloudifySystemWideWorkflowContext.
+                  _ManagedCloudifyWorkflowContext, self).__init__(ctx)
+            # the _DeploymentContexts caching this context
+            self._contexts = contexts
+            # how many blocks are using this context: it must not be
+            # dropped from the cache, and rebuilt, while in use. Only
+            # changed and checked under the cache's lock
+            self._users = 0
+
         def __enter__(self):
+            self._contexts._acquire(self._context['deployment_id'], self)
             self.internal.start_local_tasks_processing()
 
         def __exit__(self, *args, **kwargs):
             self.internal.stop_local_tasks_processing()
+            self._contexts._release(self)
 
     @property
     def deployments_contexts(self):
-        if self._dep_contexts is None:
-            self._dep_contexts = {}
+        """Workflow contexts of all the deployments, by deployment id
 
+        See _DeploymentContexts. To load many of them in advance,
+        use deployments_contexts.prefetch()
+        """
+        if self._dep_contexts is None:
             rest = get_rest_client(tenant=self.tenant_name)
             deployments_list = rest.deployments.list(
                 _include=['id', 'blueprint_id'],
                 _get_all_results=True
             )
-            for dep in deployments_list:
-                # Failure to deepcopy will cause snapshot restore context hack
-                # to be reset just before it's needed.
-                dep_ctx = copy.deepcopy(self._context)
-                dep_ctx['tenant']['name'] = self.tenant_name
-                dep_ctx['deployment_id'] = dep.id
-                dep_ctx['blueprint_id'] = dep.blueprint_id
-
-                def lazily_loaded_ctx(dep_ctx):
-                    def lazy_ctx():
-                        if not hasattr(lazy_ctx, '_cached_ctx'):
-                            lazy_ctx._cached_ctx = \
-                                self._ManagedCloudifyWorkflowContext(dep_ctx)
-                        return lazy_ctx._cached_ctx
-
-                    return proxy(lazy_ctx)
-
-                self._dep_contexts[dep.id] = lazily_loaded_ctx(dep_ctx)
+            self._dep_contexts = _DeploymentContexts(
+                self, deployments_list,
+                max_instances=self._context.get(
+                    'deployments_cache_instances',
+                    DEFAULT_DEPLOYMENTS_CACHE_INSTANCES))
         return self._dep_contexts
 
 
+class _DeploymentContexts(Mapping):
+    """Workflow contexts of deployments, by deployment id.
+
+    The values are proxies: a context is only built when it's first
+    used, or when it's prefetched. Built contexts are kept in a LRU cache,
+    bounded by the total number of their node instances. Contexts that
+    are in use - entered using `with` - are never dropped from the cache;
+    others are rebuilt if they're used again after being dropped.
+
+    A dropped context that is still referenced, eg. by a node or a node
+    instance object that a caller kept, is used again instead, so that
+    there's only ever one context of every deployment, and the objects
+    it returns are those the caller already has.
+
+    :param workflow_context: the CloudifySystemWideWorkflowContext
+    :param deployments: the deployments (rest client model)
+    :param max_instances: bound of the cache, in node instances
+    """
+
+    def __init__(self, workflow_context, deployments, max_instances):
+        self._workflow_context = workflow_context
+        self._deployments = OrderedDict((dep.id, dep) for dep in deployments)
+        self._max_instances = max_instances
+        self._proxies = {}
+        # deployment id -> (context, its number of node instances),
+        # least recently used first
+        self._cache = OrderedDict()
+        self._cached_instances = 0
+        # deployment id -> context that was dropped from the cache, for
+        # as long as it's referenced elsewhere
+        self._dropped = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, deployment_id):
+        if deployment_id not in self._deployments:
+            raise KeyError(deployment_id)
+        ctx_proxy = self._proxies.get(deployment_id)
+        if ctx_proxy is None:
+            ctx_proxy = self._proxies.setdefault(
+                deployment_id, proxy(functools.partial(self._get,
+                                                       deployment_id)))
+        return ctx_proxy
+
+    def __iter__(self):
+        return iter(self._deployments)
+
+    def __len__(self):
+        return len(self._deployments)
+
+    def prefetch(self, deployment_ids=None,
+                 workers=DEFAULT_DEPLOYMENTS_PREFETCH_WORKERS):
+        """Build the contexts of the deployments concurrently.
+
+        Failures are only logged: the context is built again when it's
+        used, and then the error is raised.
+
+        :param deployment_ids: the deployments to build the contexts of;
+                               all of them by default. Prefetching more
+                               deployments than the cache holds is wasted
+        :param workers: how many contexts to build at the same time
+        """
+        if deployment_ids is None:
+            deployment_ids = list(self._deployments)
+        pending = queue.Queue()
+        for deployment_id in deployment_ids:
+            if deployment_id not in self._cache:
+                pending.put(deployment_id)
+
+        def _prefetch():
+            while True:
+                try:
+                    deployment_id = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._get(deployment_id)
+                except Exception as e:
+                    self._workflow_context.logger.warning(
+                        'Failed prefetching deployment %s: %s',
+                        deployment_id, e)
+
+        threads = [threading.Thread(target=_prefetch,
+                                    name='deployment-prefetch-{0}'.format(i))
+                   for i in range(min(workers, pending.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _get(self, deployment_id):
+        with self._lock:
+            cached = self._cache.pop(deployment_id, None)
+            if cached is not None:
+                self._cache[deployment_id] = cached
+                return cached[0]
+            dep_ctx = self._dropped.pop(deployment_id, None)
+            if dep_ctx is not None:
+                self._add(deployment_id, dep_ctx)
+                return dep_ctx
+        # building is slow, so it's done without holding the lock
+        dep_ctx = self._build(deployment_id)
+        with self._lock:
+            if deployment_id in self._cache:
+                # built concurrently by another thread
+                return self._cache[deployment_id][0]
+            self._add(deployment_id, dep_ctx)
+        return dep_ctx
+
+    def _add(self, deployment_id, dep_ctx):
+        """Cache the context. Must be called holding the lock."""
+        instances = len(dep_ctx._raw_node_instances)
+        self._cache[deployment_id] = (dep_ctx, instances)
+        self._cached_instances += instances
+        self._evict()
+
+    def _build(self, deployment_id):
+        dep = self._deployments[deployment_id]
+        # Failure to deepcopy will cause snapshot restore context hack
+        # to be reset just before it's needed.
+        dep_ctx = copy.deepcopy(self._workflow_context._context)
+        dep_ctx['tenant']['name'] = self._workflow_context.tenant_name
+        dep_ctx['deployment_id'] = dep.id
+        dep_ctx['blueprint_id'] = dep.blueprint_id
+        return self._workflow_context._ManagedCloudifyWorkflowContext(
+            dep_ctx, self)
+
+    def _acquire(self, deployment_id, dep_ctx):
+        """Mark the context as in use, so that it's kept in the cache.
+
+        It might have been dropped after it was looked up, but before
+        it was entered; then it's cached again, so that it's the context
+        of the deployment used from now on.
+        """
+        with self._lock:
+            dep_ctx._users += 1
+            self._dropped.pop(deployment_id, None)
+            cached = self._cache.pop(deployment_id, None)
+            if cached is None or cached[0] is not dep_ctx:
+                if cached is not None:
+                    self._cached_instances -= cached[1]
+                cached = (dep_ctx, len(dep_ctx._raw_node_instances))
+                self._cached_instances += cached[1]
+            self._cache[deployment_id] = cached
+            self._evict()
+
+    def _release(self, dep_ctx):
+        with self._lock:
+            dep_ctx._users -= 1
+
+    def _evict(self):
+        """Drop least recently used contexts, until the cache fits.
+
+        The most recently used context is always kept. Must be called
+        holding the lock.
+        """
+        for deployment_id in list(self._cache)[:-1]:
+            if self._cached_instances <= self._max_instances:
+                break
+            dep_ctx, instances = self._cache[deployment_id]
+            if dep_ctx._users:
+                continue
+            del self._cache[deployment_id]
+            self._cached_instances -= instances
+            self._dropped[deployment_id] = dep_ctx
+
+
 class CloudifyWorkflowContextInternal(object):
 
     def __init__(self, workflow_context, handler):
@@ -1065,6 +1509,14 @@ class CloudifyWorkflowContextInternal(object):
         self.handler = handler
         self._bootstrap_context = None
         self._graph_mode = False
+        if workflow_context.collect_timings:
+            self.timings = ExecutionTimings()
+        else:
+            self.timings = NullTimings()
+        if workflow_context.profile_memory and memory_profile.available:
+            self.memory_profile = memory_profile.ExecutionMemoryProfile()
+        else:
+            self.memory_profile = memory_profile.NullMemoryProfile()
         # the graph is always created internally for events to work properly
         # when graph mode is turned on this instance is returned to the user.
         subgraph_task_config = self.get_subgraph_task_configuration()
@@ -1136,15 +1588,26 @@ class CloudifyWorkflowContextInternal(object):
     def stop_local_tasks_processing(self):
         self.local_tasks_processor.stop()
 
-    def add_local_task(self, task):
-        self.local_tasks_processor.add_task(task)
+    def add_local_task(self, task, ordering_key=None):
+        self.local_tasks_processor.add_task(task, ordering_key=ordering_key)
 
 
 class LocalTasksProcessing(object):
+    """Run local tasks in a pool of thread_pool_size threads.
+
+    Tasks with the same ordering key (eg. the tasks of a node instance:
+    setting its state, sending its events) run one at a time, in the
+    order they were added. Other tasks run concurrently.
+    """
 
     def __init__(self, workflow_ctx, thread_pool_size=1):
         self._local_tasks_queue = queue.Queue()
         self._local_task_processing_pool = []
+        # tasks waiting for the previous task with the same ordering key
+        # to finish; a key is in here while any of its tasks is queued
+        # or running
+        self._ordered_tasks = {}
+        self._ordered_tasks_lock = threading.Lock()
         self._is_local_context = workflow_ctx.local
         for i in range(thread_pool_size):
             name = 'Task-Processor-{0}'.format(i + 1)
@@ -1169,8 +1632,37 @@ class LocalTasksProcessing(object):
     def stop(self):
         self.stopped = True
 
-    def add_task(self, task):
-        self._local_tasks_queue.put(task)
+    def add_task(self, task, ordering_key=None):
+        if ordering_key is None:
+            self._local_tasks_queue.put(task)
+            return
+        with self._ordered_tasks_lock:
+            waiting = self._ordered_tasks.get(ordering_key)
+            if waiting is not None:
+                waiting.append(task)
+                return
+            self._ordered_tasks[ordering_key] = deque()
+        self._local_tasks_queue.put(self._ordered(task, ordering_key))
+
+    def _ordered(self, task, ordering_key):
+        """Wrap task, so that when it's done, the next one with the same
+        ordering key is queued
+        """
+        def _run_ordered():
+            try:
+                task()
+            finally:
+                self._ordered_task_done(ordering_key)
+        return _run_ordered
+
+    def _ordered_task_done(self, ordering_key):
+        with self._ordered_tasks_lock:
+            waiting = self._ordered_tasks[ordering_key]
+            if not waiting:
+                del self._ordered_tasks[ordering_key]
+                return
+            task = waiting.popleft()
+        self._local_tasks_queue.put(self._ordered(task, ordering_key))
 
     def _process_local_task(self, workflow_ctx):
         # see CFY-1442
@@ -1208,6 +1700,14 @@ class CloudifyWorkflowContextHandler(object):
     def get_task(self, workflow_task, queue=None, target=None, tenant=None):
         raise NotImplementedError('Implemented by subclasses')
 
+    @contextmanager
+    def batch_tasks(self):
+        """Tasks sent in this block may be grouped into batches.
+
+        By default, every task is sent as soon as it's ready.
+        """
+        yield
+
     @property
     def operation_cloudify_context(self):
         raise NotImplementedError('Implemented by subclasses')
@@ -1266,19 +1766,36 @@ class _AsyncResult(object):
         self._task = task
         self.result = self.NOTSET
         self.error = False
+        self._done = threading.Event()
+
+    def set_result(self, result, error=False):
+        self.result = result
+        self.error = error
+        self._done.set()
 
     def get(self):
-        while self.result is self.NOTSET:
-            time.sleep(0.5)
+        # wait in short steps, so that the wait can still be interrupted
+        while not self._done.wait(1):
+            pass
         if self.error:
             raise self.result
         return self.result
 
 
+task_send_latency = metrics.histogram(
+    'cloudify_task_send_seconds',
+    'Time it took to send a remote task, including looking up the agent')
+operation_duration = metrics.histogram(
+    'cloudify_operation_seconds',
+    'Duration of operations run by agents, as reported by the agent',
+    labelnames=('plugin', 'operation'))
+
+
 class _TaskDispatcher(object):
     def __init__(self):
         self._tasks = {}
         self._logger = logging.getLogger('dispatch')
+        self._batches = threading.local()
 
     def make_subtask(self, tenant, target, task_id, queue, kwargs):
         task = {
@@ -1313,17 +1830,87 @@ class _TaskDispatcher(object):
         return client
 
     def send_task(self, workflow_task, task):
+        with task_send_latency.time():
+            self._send_task(workflow_task, task)
+
+    def _send_task(self, workflow_task, task):
         agent = task['target']
-        handler = task['handler']
         if task['target'] != MGMTWORKER_QUEUE \
                 and not is_agent_alive(agent, task['client'], connect=False):
             raise exceptions.RecoverableError(
                 'Timed out waiting for agent: {0}'.format(agent))
 
-        handler.publish(task['task'], routing_key='operation',
-                        correlation_id=task['id'])
+        self._start_span(workflow_task, task)
+        batch = getattr(self._batches, 'current', None)
+        if batch is not None:
+            batch.setdefault((task['queue'], task['target']), []).append(task)
+            return
+        self._publish(task)
         self._logger.debug('Task [{0}] sent'.format(task['id']))
 
+    def _start_span(self, workflow_task, task):
+        """Trace the task from sending it until its response arrived.
+
+        The span's ids are passed to the agent in the task's context,
+        and in the message headers.
+        """
+        tracer = tracing.get_tracer()
+        if not tracer.enabled:
+            return
+        span = tracer.start_span(workflow_task.name, category='task',
+                                 task_id=task['id'], target=task['target'])
+        task['span'] = span
+        kwargs = task['task']['cloudify_task']['kwargs']
+        kwargs['__cloudify_context'][tracing.TRACE_KEY] = \
+            span.context.to_dict()
+
+    def _publish(self, task):
+        publish_kwargs = {}
+        if 'span' in task:
+            publish_kwargs['headers'] = self._trace_headers(task)
+        task['handler'].publish(task['task'], routing_key='operation',
+                                correlation_id=task['id'], **publish_kwargs)
+
+    @staticmethod
+    def _trace_headers(task):
+        return task['span'].context.to_headers()
+
+    @contextmanager
+    def batch(self):
+        """Send tasks sent in this block per-agent, in batch messages.
+
+        The tasks are published when the block exits, one message for
+        all the tasks of each agent (or several, for more than
+        amqp_client.MAX_BATCH_SIZE tasks).
+        """
+        if getattr(self._batches, 'current', None) is not None:
+            yield
+            return
+        self._batches.current = OrderedDict()
+        try:
+            yield
+        finally:
+            batch, self._batches.current = self._batches.current, None
+            for batched_tasks in batch.values():
+                self._send_batch(batched_tasks)
+
+    def _send_batch(self, batched_tasks):
+        if len(batched_tasks) == 1:
+            self._publish(batched_tasks[0])
+        else:
+            publish_kwargs = {}
+            if any('span' in task for task in batched_tasks):
+                publish_kwargs['headers'] = dict(
+                    (task['id'], self._trace_headers(task))
+                    for task in batched_tasks)
+            # any of the tasks' handlers will do: they all publish to the
+            # same agent, and every task still gets its own response queue
+            batched_tasks[0]['handler'].publish_batch(
+                [(task['task'], task['id']) for task in batched_tasks],
+                routing_key='operation', **publish_kwargs)
+        self._logger.debug('Tasks [{0}] sent'.format(
+            ', '.join(task['id'] for task in batched_tasks)))
+
     def wait_for_result(self, workflow_task, task):
         result = _AsyncResult(task)
         client, handler = task['client'], task['handler']
@@ -1357,6 +1944,9 @@ class _TaskDispatcher(object):
                 return
             if workflow_task.is_terminated:
                 return
+            if task.get('span') is not None:
+                task['span'].finish(error=bool(response.get('error')))
+            self._record_timings(workflow_task, response)
 
             error = response.get('error')
             if error:
@@ -1365,22 +1955,37 @@ class _TaskDispatcher(object):
                     state = TASK_RESCHEDULED
                 else:
                     state = TASK_FAILED
-                _result = exception
-                result.error = True
+                # the result must be ready before the state is set, because
+                # setting the state wakes up whoever waits for the result
+                result.set_result(exception, error=True)
                 self._set_task_state(workflow_task, state)
             else:
                 state = TASK_SUCCEEDED
                 _result = response.get('result')
+                result.set_result(_result)
                 self._set_task_state(workflow_task, state, {'result': _result})
 
-            result.result = _result
-
             self._maybe_stop_client(client)
         except Exception:
             self._logger.error('Error occurred while processing task',
                                exc_info=True)
             raise
 
+    def _record_timings(self, workflow_task, response):
+        timings = workflow_task.workflow_context.internal.timings
+        agent_timings = response.get('timings') or {}
+        if 'operation' in agent_timings:
+            operation_duration.observe(agent_timings['operation'],
+                                       *workflow_task.metrics_labels)
+        if not timings.enabled:
+            return
+        if workflow_task.sent_at is not None:
+            timings.add('task_remote', time.time() - workflow_task.sent_at,
+                        task_name=workflow_task.name)
+        for phase, duration in agent_timings.items():
+            timings.add('agent_{0}'.format(phase), duration,
+                        task_name=workflow_task.name)
+
     def _maybe_stop_client(self, client):
         if self._tasks[client]:
             return
@@ -1417,6 +2022,11 @@ class RemoteContextHandler(CloudifyWorkflowContextHandler):
     def wait_for_result(self, workflow_task, task):
         return self._dispatcher.wait_for_result(workflow_task, task)
 
+    def batch_tasks(self):
+        if self.workflow_ctx.batch_operations:
+            return self._dispatcher.batch()
+        return super(RemoteContextHandler, self).batch_tasks()
+
     @property
     def operation_cloudify_context(self):
         return {'local': False,
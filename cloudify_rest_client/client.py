@@ -13,14 +13,16 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
-import json
 import logging
+import time
 
 import requests
 from base64 import urlsafe_b64encode
 from requests.packages import urllib3
 
-from cloudify import constants
+from cloudify import codec, constants
+from cloudify import metrics, tracing
+from cloudify._compat import urlparse
 
 from .utils import is_kerberos_env
 from cloudify_rest_client import exceptions
@@ -72,6 +74,21 @@ CLOUDIFY_TENANT_HEADER = 'Tenant'
 
 urllib3.disable_warnings(urllib3.exceptions.InsecurePlatformWarning)
 
+request_latency = metrics.histogram(
+    'cloudify_rest_request_seconds',
+    'Duration of REST requests to the manager',
+    labelnames=('method', 'endpoint'))
+
+
+def _request_endpoint(request_url):
+    """The first path element after the API version, eg. node-instances"""
+    path = urlparse(request_url).path.strip('/').split('/')
+    if len(path) > 1 and path[0] == 'api':
+        path = path[1:]
+    if len(path) > 1 and path[0][:1] == 'v' and path[0][1:2].isdigit():
+        path = path[1:]
+    return path[0]
+
 
 class HTTPClient(object):
 
@@ -172,14 +189,23 @@ class HTTPClient(object):
                     'Trying to create a client with kerberos, '
                     'but kerberos_env does not exist')
             auth = HTTPKerberosAuth()
-        response = requests_method(request_url,
-                                   data=body,
-                                   params=params,
-                                   headers=headers,
-                                   stream=stream,
-                                   verify=verify,
-                                   timeout=timeout or self.default_timeout_sec,
-                                   auth=auth)
+        method = requests_method.__name__.upper()
+        endpoint = _request_endpoint(request_url)
+        start = time.time()
+        try:
+            with tracing.span('{0} {1}'.format(method, endpoint),
+                              category='rest'):
+                response = requests_method(
+                    request_url,
+                    data=body,
+                    params=params,
+                    headers=headers,
+                    stream=stream,
+                    verify=verify,
+                    timeout=timeout or self.default_timeout_sec,
+                    auth=auth)
+        finally:
+            request_latency.observe(time.time() - start, method, endpoint)
         if self.logger.isEnabledFor(logging.DEBUG):
             for hdr, hdr_content in response.request.headers.items():
                 self.logger.debug('request header:  %s: %s'
@@ -197,7 +223,7 @@ class HTTPClient(object):
         if stream:
             return StreamedResponse(response)
 
-        response_json = response.json()
+        response_json = codec.loads(response.content)
 
         if response.history:
             response_json['history'] = response.history
@@ -243,7 +269,7 @@ class HTTPClient(object):
 
         # data is either dict, bytes data or None
         is_dict_data = isinstance(data, dict)
-        body = json.dumps(data) if is_dict_data else data
+        body = codec.dumps(data) if is_dict_data else data
         if self.logger.isEnabledFor(logging.DEBUG):
             log_message = 'Sending request: {0} {1}'.format(
                 requests_method.__name__.upper(),
@@ -47,7 +47,8 @@ setup(
     author='Cloudify',
     author_email='cosmo-admin@cloudify.co',
     packages=find_packages(exclude=('dsl_parser.tests*',
-                                    'script_runner.tests*',)),
+                                    'script_runner.tests*',
+                                    'benchmarks*')),
     include_package_data=True,
     license='LICENSE',
     description='Cloudify Common',